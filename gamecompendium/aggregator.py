@@ -1,26 +1,78 @@
+import asyncio
+import heapq
 import math
-from typing import NamedTuple
+from dataclasses import dataclass, field
+from typing import NamedTuple, Optional, Dict, Iterable
 
+from whoosh.idsets import DocIdSet
 from whoosh.matching import ListMatcher, AndMaybeMatcher
 from whoosh.query import Query
 from whoosh.searching import Searcher, Hit
 
+from uuid_map import UuidMap
 
-def random_access_score(query: Query, searcher: Searcher, uuid: str) -> tuple[int, float]:
+
+def random_access_score(query: Query, searcher: Searcher, uuid: str, uuid_map: Optional[UuidMap] = None,
+                        allow: Optional[DocIdSet] = None) -> tuple[int, float]:
     # Yes, I wrote this, but I think it's using arcane magic.
     # Staring too deep into a dynamically-typed codebase does this, be warned.
     # On a serious note, this IS efficient, the first time AndMaybeMatcher is called
     # it skips all the others ids (it calls matcher.skip_to(docid))
-    docid = searcher.document_number(uuid=uuid)
-    if docid:
+    if uuid_map is not None:
+        # Precomputed at index time, no term dictionary lookup
+        docid = uuid_map.document_number(uuid)
+    else:
+        docid = searcher.document_number(uuid=uuid)
+    if docid is not None and allow is not None and docid not in allow:
+        # Excluded by the filters (check filters.py), same as not present
+        docid = None
+    if docid is not None:
         for subsearcher, offset in searcher.leaf_searchers():
+            # docid is global, find the segment that contains it
+            if docid >= offset + subsearcher.doc_count_all():
+                continue
             m = query.matcher(subsearcher, context=searcher.context())
-            m = AndMaybeMatcher(ListMatcher([docid], [0]), m)
+            m = AndMaybeMatcher(ListMatcher([docid - offset], [0]), m)
             if m.is_active():
-                return m.id(), m.score()
+                return m.id() + offset, m.score()
     # Necessary in case of no hit for docid
     return -1, 0
 
+
+def random_access_scores(query: Query, searcher: Searcher, uuids: Iterable[str],
+                         uuid_map: Optional[UuidMap] = None) -> Dict[str, tuple[int, float]]:
+    """
+    Batched version of random_access_score, the query matcher is built once per segment and
+    the documents are visited in docnum order (so the matcher only moves forward).
+
+    :return: uuid -> (docnum, score) for every uuid present in the index (the score is 0 when it doesn't match)
+    """
+    docs = []
+    for uuid in uuids:
+        docid = uuid_map.document_number(uuid) if uuid_map is not None else searcher.document_number(uuid=uuid)
+        if docid is not None:
+            docs.append((docid, uuid))
+    docs.sort()
+
+    res = {}
+    i = 0
+    for subsearcher, offset in searcher.leaf_searchers():
+        end = offset + subsearcher.doc_count_all()
+        m = None
+        while i < len(docs) and docs[i][0] < end:
+            docid, uuid = docs[i]
+            i += 1
+            if m is None:
+                m = query.matcher(subsearcher, context=searcher.context())
+            score = 0
+            local_id = docid - offset
+            if m.is_active() and m.id() < local_id:
+                m.skip_to(local_id)
+            if m.is_active() and m.id() == local_id:
+                score = m.score()
+            res[uuid] = (docid, score)
+    return res
+
 # We use a normal Top-K threshold algorithm, but we need to change the scoring aggregation function.
 # Since we can't discriminate between how many sources an entity is found in (a game is still important
 # even if it's not sold on steam) we can't use a sum $Sc_a = sum(a)$, but we need to find something more complex.
@@ -57,30 +109,51 @@ def random_access_score(query: Query, searcher: Searcher, uuid: str) -> tuple[in
 # So our threshold function is both acceptable and minimal given our score aggregation function.
 
 
+# Approximate mode
+# On flat score distributions (many games with similar names) the threshold decreases slowly and the loop walks
+# deep into every source. The θ-approximation of the threshold algorithm (Fagin et al.) stops as soon as every top-k
+# score is >= threshold / θ (θ > 1): any entity we didn't see has a score <= threshold, so the results are a
+# θ-approximation of the top-k (no missed entity is better than θ times the worst returned one).
+# max_rows is a hard budget on the rows read from every source (the results are the best ones found within it).
+# Both are opt-in, θ = 1 and no budget is the exact algorithm.
+
+
 class AggregateHit(NamedTuple):
     # Hits from various searchers with their searcher name
     hits: list[tuple[Hit, str]]
     total_score: float
 
 
-def aggregate_search(query: Query, searchers_idxs: list[tuple[Searcher, str]], k: int, limit=math.inf) -> list[AggregateHit]:
+def aggregate_search(query: Query, searchers_idxs: list[tuple[Searcher, str]], k: int, limit=math.inf,
+                     uuid_maps: Optional[Dict[str, UuidMap]] = None,
+                     allows: Optional[Dict[str, DocIdSet]] = None,
+                     theta: float = 1.0, max_rows: Optional[int] = None) -> list[AggregateHit]:
     # Threshold algorithm
-    
+    # uuid_maps (index name -> UuidMap) are optional, searchers without one use term lookups for random access
+    # allows (index name -> allowed docnums, check filters.py) are optional too, an index without one allows everything
+    # theta and max_rows enable the approximate mode (check the comment above), the defaults are exact
+    if theta < 1:
+        raise ValueError(f"theta must be >= 1, not {theta}")
+    uuid_maps = uuid_maps or {}
+    allows = allows or {}
+    if max_rows is not None:
+        limit = min(limit, max_rows)
+
     results = []  # list[(result, searcher, index_name)]
     for s in searchers_idxs:
         # include searcher too for exclusion in subsequent score calculation from other searchers
         # include index name so every result can be associated with its origin index
-        results.append((s[0].search(query, limit=limit), s[0], s[1]))
+        results.append((s[0].search(query, limit=limit, filter=allows.get(s[1])), s[0], s[1]))
    
     topk = []
     # iterate for max length
     visited = set()
-    for i in range(max([len(res[0]) for res in results])):
+    for i in range(max([res[0].scored_length() for res in results])):
         threshold = 0
         
         # compute one "row" of results at a time, ie: all first results, then all second results
         for res, searcher, index_name in results:
-            if i < len(res):
+            if i < res.scored_length():
                 current_hit = res[i]
 
                 # update threshold
@@ -98,14 +171,16 @@ def aggregate_search(query: Query, searchers_idxs: list[tuple[Searcher, str]], k
 
                     for other_searcher, other_name in [src for src in searchers_idxs if src[0] != searcher]:
                         # get doc id and score
-                        found_index, found_score = random_access_score(query, other_searcher, current_hit['uuid'])
+                        found_index, found_score = random_access_score(query, other_searcher, current_hit['uuid'],
+                                                                       uuid_maps.get(other_name),
+                                                                       allows.get(other_name))
                         if found_index == -1:
                             continue  # Not present
                         # update score
                         top_score += found_score
                         index_count += 1
                         # find exact doc and append it
-                        el = other_searcher.ixreader.stored_fields(found_index)
+                        el = other_searcher.stored_fields(found_index)
                         doclist.append((el, other_name))
                     
                     # insert into topk results
@@ -116,9 +191,204 @@ def aggregate_search(query: Query, searchers_idxs: list[tuple[Searcher, str]], k
                     topk.remove(min(topk, key=lambda x: x.total_score))
         
         # check if threshold smaller than all top-k results and stop iterating in case
-        if len(topk) >= k and all(score >= threshold for hits, score in topk):
+        if len(topk) >= k and all(score >= threshold / theta for hits, score in topk):
             break
         
     return sorted(topk, key=lambda x: x.total_score, reverse=True)
-        
 
+
+# Paging
+# aggregate_search only returns the final top-k: the next page would mean running it again with a bigger k, paying
+# again for every random access and every aggregation of the previous pages.
+# aggregate_page runs the same threshold algorithm, but it stops as soon as the page is full and returns a cursor
+# with its state:
+# - the sorted access of every source, and its read depth (how many of its rows have been consumed)
+# - the visited uuids (entities already aggregated, returned or not)
+# - the buffer: entities already aggregated but not returned yet, with their final score
+# - the threshold of the last row read
+# An entity of the buffer can be returned once its score is >= the threshold (no unseen entity can beat it, check
+# the proof above), the next page continues from there: only the new rows are aggregated.
+# Whoosh doesn't have a resumable sorted access, every source is searched with a growing limit (SORTED_BATCH, then
+# doubled when a page reads past it). The cursor keeps those results, so the next page searches again only when it
+# reads past them: reading down to depth d costs O(d) in total, not O(d) per page.
+# The cursor lives in memory (the searchers of its sorted accesses must stay open), the caller keeps it between the
+# pages (App.run_query_page hands out a token of it). Cursors are bound to the query and to the index versions
+# (key), a cursor of another search is refused.
+
+SORTED_BATCH = 32
+
+
+class _SortedAccess:
+    def __init__(self, query: Query, searcher: Searcher, allow: Optional[DocIdSet]):
+        self.query = query
+        self.searcher = searcher
+        self.allow = allow
+        self.limit = 0
+        self._results = None
+
+    def hit(self, i: int) -> Optional[Hit]:
+        """i-th hit of the sorted access, None when the source has no more results"""
+        if self._results is None or i >= self._results.scored_length():
+            if self._results is not None and self._results.scored_length() < self.limit:
+                return None
+            self.limit = max(SORTED_BATCH, i + 1, self.limit * 2)
+            self._results = self.searcher.search(self.query, limit=self.limit, filter=self.allow)
+            if i >= self._results.scored_length():
+                return None
+        return self._results[i]
+
+
+@dataclass
+class AggregateCursor:
+    key: str
+    depths: Dict[str, int]
+    visited: set[str] = field(default_factory=set)
+    # Heap of (-score, uuid, [(index name, docnum)])
+    buffer: list[tuple[float, str, list[tuple[str, int]]]] = field(default_factory=list)
+    threshold: float = math.inf
+    exhausted: bool = False
+    # Index name -> sorted access, resumed by the next page
+    access: Dict[str, _SortedAccess] = field(default_factory=dict)
+
+
+def aggregate_page(query: Query, searchers_idxs: list[tuple[Searcher, str]], k: int, key: str,
+                   cursor: Optional[AggregateCursor] = None, uuid_maps: Optional[Dict[str, UuidMap]] = None,
+                   allows: Optional[Dict[str, DocIdSet]] = None) -> tuple[list[AggregateHit], Optional[AggregateCursor]]:
+    """
+    One page of the aggregated results (check the comment above), same scores as aggregate_search
+
+    :param key: identifies the query and the index versions, the cursor must have the same one
+    :param cursor: state of the previous page, None for the first page
+    :return: the results of the page and the cursor of the next one (None when there are no more results)
+    """
+    uuid_maps = uuid_maps or {}
+    allows = allows or {}
+    if cursor is None:
+        cursor = AggregateCursor(key, {name: 0 for _searcher, name in searchers_idxs})
+    elif cursor.key != key:
+        raise ValueError("The cursor belongs to another search (or the indexes changed)")
+    searchers = {name: searcher for searcher, name in searchers_idxs}
+    for searcher, name in searchers_idxs:
+        if name not in cursor.access:
+            cursor.access[name] = _SortedAccess(query, searcher, allows.get(name))
+    access = cursor.access
+
+    page = []
+    while len(page) < k:
+        if len(cursor.buffer) > 0 and -cursor.buffer[0][0] >= cursor.threshold:
+            neg_score, _uuid, instances = heapq.heappop(cursor.buffer)
+            hits = [(searchers[name].stored_fields(docnum), name) for name, docnum in instances]
+            page.append(AggregateHit(hits, -neg_score))
+            continue
+        if cursor.exhausted:
+            break
+
+        # Next row of the sorted accesses
+        row = [(name, hit) for name in searchers if (hit := access[name].hit(cursor.depths[name])) is not None]
+        if len(row) == 0:
+            cursor.exhausted = True
+            cursor.threshold = -math.inf
+            continue
+        cursor.threshold = max(hit.score for _name, hit in row)
+        for name, hit in row:
+            cursor.depths[name] += 1
+            uuid = hit['uuid']
+            if uuid in cursor.visited:
+                continue
+            cursor.visited.add(uuid)
+            top_score = hit.score
+            instances = [(name, hit.docnum)]
+            for other_name, other_searcher in searchers.items():
+                if other_name == name:
+                    continue
+                found_index, found_score = random_access_score(query, other_searcher, uuid,
+                                                               uuid_maps.get(other_name), allows.get(other_name))
+                if found_index == -1:
+                    continue
+                top_score += found_score
+                instances.append((other_name, found_index))
+            heapq.heappush(cursor.buffer, (-top_score / len(instances), uuid, instances))
+
+    if cursor.exhausted and len(cursor.buffer) == 0:
+        return page, None
+    return page, cursor
+
+
+# Remote sources
+# aggregate_search needs the searchers of all the sources in this process. aggregate_search_async runs the same
+# threshold algorithm on sources that might be in other processes or hosts (check remote.py), through three calls:
+#   sorted_access(query, filter, start, count) -> [(uuid, docnum, score)]  rows start..start+count of the source
+#   random_access(query, filter, uuids) -> {uuid: (docnum, score)}        only the uuids present (and allowed)
+#   stored_fields(docnums) -> [fields]
+# Every call is a round trip, so the rows are read in batches (ROW_BATCH, then doubled like SORTED_BATCH) and every
+# batch costs one sorted access and one (batched) random access per source, all the sources at the same time.
+# Reading a few rows more than the exact algorithm doesn't change the results: every seen entity has its exact
+# score, the stop condition is the same one checked at the end of the batch. Stored fields are only fetched for the
+# final top-k.
+# The filter is a query (evaluated by the source, with its cached bitsets), not a docnum set.
+
+ROW_BATCH = 16
+
+
+async def aggregate_search_async(query: Query, filter_q: Optional[Query], sources: list, k: int,
+                                 theta: float = 1.0, max_rows: Optional[int] = None) -> list[AggregateHit]:
+    """
+    Threshold algorithm over sources with the remote interface (check the comment above), same scores as
+    aggregate_search
+    """
+    if theta < 1:
+        raise ValueError(f"theta must be >= 1, not {theta}")
+    # uuid -> (score, [(index name, docnum)])
+    seen = {}  # type: Dict[str, tuple[float, list[tuple[str, int]]]]
+    exhausted = set()
+    depth = 0
+    batch = max(k, ROW_BATCH)
+    while len(exhausted) < len(sources):
+        count = batch if max_rows is None else min(batch, max_rows - depth)
+        if count <= 0:
+            break
+        active = [s for s in sources if s.name not in exhausted]
+        pages = await asyncio.gather(*[s.sorted_access(query, filter_q, depth, count) for s in active])
+        found = {}  # type: Dict[str, Dict[str, tuple[int, float]]]
+        threshold = 0
+        for source, page in zip(active, pages):
+            if len(page) < count:
+                exhausted.add(source.name)
+            if len(page) > 0:
+                threshold = max(threshold, page[-1][2])
+        # Row by row, like aggregate_search: the first instance of an entity is the one found first
+        for row in range(count):
+            for source, page in zip(active, pages):
+                if row < len(page) and page[row][0] not in seen:
+                    uuid, docnum, score = page[row]
+                    found.setdefault(uuid, {})[source.name] = (docnum, score)
+
+        async def lookup(source) -> Dict[str, tuple[int, float]]:
+            missing = [uuid for uuid, instances in found.items() if source.name not in instances]
+            return await source.random_access(query, filter_q, missing) if len(missing) > 0 else {}
+
+        for source, scores in zip(sources, await asyncio.gather(*[lookup(s) for s in sources])):
+            for uuid, (docnum, score) in scores.items():
+                found[uuid][source.name] = (docnum, score)
+        for uuid, instances in found.items():
+            total = sum(score for _docnum, score in instances.values())
+            seen[uuid] = (total / len(instances), [(name, docnum) for name, (docnum, _score) in instances.items()])
+
+        depth += count
+        batch *= 2
+        topk = heapq.nlargest(k, seen.values(), key=lambda entity: entity[0])
+        if len(topk) >= k and all(score >= threshold / theta for score, _instances in topk):
+            break
+
+    topk = heapq.nlargest(k, seen.values(), key=lambda entity: entity[0])
+    by_source = {}  # type: Dict[str, list[int]]
+    for _score, instances in topk:
+        for name, docnum in instances:
+            by_source.setdefault(name, []).append(docnum)
+    fetching = [s for s in sources if s.name in by_source]
+    fetched = await asyncio.gather(*[s.stored_fields(by_source[s.name]) for s in fetching])
+    fields = {}  # type: Dict[tuple[str, int], dict]
+    for source, docs in zip(fetching, fetched):
+        fields.update(((source.name, docnum), doc) for docnum, doc in zip(by_source[source.name], docs))
+    return [AggregateHit([(fields[(name, docnum)], name) for name, docnum in instances], score)
+            for score, instances in topk]
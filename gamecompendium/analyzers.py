@@ -1,4 +1,7 @@
-from whoosh.analysis import RegexTokenizer, default_pattern, LowercaseFilter, StopFilter, Analyzer
+import itertools
+
+from whoosh.analysis import RegexTokenizer, default_pattern, LowercaseFilter, StopFilter, Analyzer, Filter, \
+    StandardAnalyzer
 
 
 def keep_numbers_analyzer() -> Analyzer:
@@ -12,3 +15,22 @@ def keep_numbers_analyzer() -> Analyzer:
     ret = RegexTokenizer(expression=default_pattern)
     chain = ret | LowercaseFilter() | StopFilter(minsize=1)
     return chain
+
+
+class TokenLimitFilter(Filter):
+    """
+    Stops after the first `limit` tokens (whoosh only has a LimitFilter on the characters of each token)
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+
+    def __call__(self, tokens):
+        return itertools.islice(tokens, self.limit)
+
+
+def capped_analyzer(limit: int) -> Analyzer:
+    """
+    StandardAnalyzer that only indexes the first `limit` tokens of the text (used for long descriptions)
+    """
+    return StandardAnalyzer() | TokenLimitFilter(limit)
@@ -1,7 +1,11 @@
+import asyncio
+import hashlib
+import itertools
+import json
 import os
-from typing import Dict
-
-from tqdm import tqdm
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import Dict, Optional
 
 from whoosh_bugs import run as dont_delete_me_im_fixing_whoosh_bugs
 from whoosh.filedb.filestore import Storage, FileStorage
@@ -9,83 +13,438 @@ from whoosh.index import Index
 from whoosh.qparser import syntax, Plugin, QueryParser, MultifieldPlugin
 import re
 
+from whoosh.idsets import DocIdSet
+from whoosh.query import Query
 from whoosh.searching import Searcher
 
 from benchmark import BenchmarkSuite, BenchmarkResult
+from blocking import TitleBlocking
+from completion import CompletionIndex, Suggestion, split_query
+from spelling import SpellingIndex
+from filters import FilterCache, split_filters
+from progress import ProgressBoard, ProgressReporter
+from registry import EntityRegistry
 from resolver import EntityResolver, general_schema
+from title_index import TitleIndex
+from uuid_map import UuidMap, index_version
 
-from igdb import IgdbSource
-from source import Source
-from steam import SteamSource
+from schema_profiles import DEFAULT_PROFILE, profile_of, unpositioned_fields, without_phrases
+from source import Source, LazySource
 
 import aggregator
+import entities
+import registry
+import serving
+import shards
 
 INDEX_DIR = 'indexes'
+# Cursors of the paged queries kept in memory (check run_query_page), the oldest ones expire
+PAGE_CURSORS = 64
+# Name -> (module, class) of the default sources, modules are imported only to scrape or index (check LazySource)
+SOURCE_CLASSES = {
+    'igdb': ('igdb', 'IgdbSource'),
+    'steam': ('steam', 'SteamSource'),
+}
+
+
+def create_sources(dump_dir: Optional[str] = None, profiles: Optional[Dict[str, str]] = None) -> list[Source]:
+    """
+    Creates the default sources, reading the dumps from dump_dir (or from their default folder)
 
-DEFAULT_SOURCES = [
-    IgdbSource(),
-    SteamSource()
-]
+    :param profiles: source name -> schema profile used when it's indexed (check schema_profiles.py)
+    """
+    kwargs = {} if dump_dir is None else {'dump_dir': dump_dir}
+    profiles = profiles or {}
+    return [LazySource(name, module, class_name, profile=profiles.get(name, DEFAULT_PROFILE), **kwargs)
+            for name, (module, class_name) in SOURCE_CLASSES.items()]
+
+
+DEFAULT_SOURCES = create_sources()
 
 dont_delete_me_im_fixing_whoosh_bugs()
 
 
+# Indexing scheduler
+# Every source index is resolved against the indexes of its dependencies (by default all the sources added before
+# it, like the old sequential order), so sources that don't depend on each other can be indexed at the same time.
+# init runs a task per missing source: the task downloads the dump (if it's missing) while the dependencies are
+# still indexing, waits for them and then indexes the source. Scraping has no dependencies, all sources are scraped
+# concurrently. Every source reports its progress on its own line of a shared ProgressBoard.
+# With the entity registry every source is resolved against the registry, the registry updates of the sources
+# (remove the old instances, resolve, add the new ones) are serialized with a lock.
+# The CPU-bound part of reindex runs in an executor (check async_utils.run_in_executor) and only reports its progress
+# to the loop, so a source can index while another one downloads its dump.
+
+
 class App:
     sources: Dict[str, Source]
+    dependencies: Dict[str, list[str]]
     indexes: Dict[str, Index]
+    uuid_maps: Dict[str, UuidMap]
     storage: Storage
+    entity_index: Optional[Index]
+    use_entity_index: bool
+    registry: Optional[EntityRegistry]
     _searchers: list[tuple[Searcher, str]]
+    _entity_searcher: Optional[Searcher]
 
-    def __init__(self):
+    def __init__(self, index_dir: str = INDEX_DIR, readonly: bool = False):
+        """
+        :param readonly: only serve queries from the existing indexes (check serving.py), indexing is not allowed
+        """
         self.sources = {}
+        self.dependencies = {}
         self.indexes = {}
-        if not os.path.exists(INDEX_DIR):
-            os.mkdir(INDEX_DIR)
-        self.storage = FileStorage(INDEX_DIR)
+        self.uuid_maps = {}
+        self.index_dir = index_dir
+        self.readonly = readonly
+        if readonly:
+            self.storage = serving.readonly_storage(index_dir)
+        else:
+            if not os.path.exists(index_dir):
+                os.mkdir(index_dir)
+            self.storage = FileStorage(index_dir)
+        self.entity_index = None
+        # Serve queries from the entity index when it's available (and up to date)
+        self.use_entity_index = True
+        # Use a blocking stage in entity resolution (faster, but it might miss some matches)
+        self.resolver_blocking = False
+        # Reuse the entity of games with an unambiguous title without searching (optionally with near-duplicate titles)
+        self.resolver_titles = True
+        self.resolver_fuzzy_titles = False
+        # Maximum weight matching instead of the greedy backtracking (only to compare them, it's way slower)
+        self.resolver_exact = False
+        # Approximate top-k in entity resolution (theta > 1 and/or a budget of rows per source, check aggregator.py)
+        self.resolver_theta = 1.0
+        self.resolver_max_rows = None  # type: Optional[int]
+        # Resolve sources against the entity registry instead of all the previously indexed sources
+        self.use_registry = False
+        self.registry = None
+        self._registry_lock = None  # type: Optional[asyncio.Lock]
         self._searchers = []
+        self._entity_searcher = None
+        # Bitsets of the structured filters, per segment (check filters.py)
+        self.filter_cache = FilterCache()
+        self.completion = None  # type: Optional[CompletionIndex]
+        self.spelling = None  # type: Optional[SpellingIndex]
+        # Add the closest words to the misspelled query terms (check spelling.py)
+        self.typo_tolerance = True
+        # Approximate top-k of the query-time aggregation, exact by default (check aggregator.py)
+        self.theta = 1.0
+        self.max_rows = None  # type: Optional[int]
+        # Split every source in this many shards searched in parallel worker processes (check shards.py)
+        self.shards = 1
+        self.shard_indexes = {}  # type: Dict[str, list[Index]]
+        self.shard_maps = {}  # type: Dict[str, list[Optional[UuidMap]]]
+        self._shard_pool = None  # type: Optional[Executor]
+        # uuid maps of the searchers, the sharded sources use their own global ones
+        self._search_uuid_maps = {}  # type: Dict[str, object]
+        # Source name -> url of the source server that serves it (check remote.py)
+        self.remotes = {}  # type: Dict[str, str]
+        self._remote_client = None
+        # Token -> cursor of the next page, least recently used first
+        self._page_cursors = OrderedDict()  # type: OrderedDict[str, aggregator.AggregateCursor]
+        self._page_tokens = itertools.count()
 
-    def add_source(self, source: Source):
+    def add_source(self, source: Source, depends_on: Optional[list[str]] = None):
+        """
+        :param depends_on: names of the sources used to resolve the entities of this one,
+            None to use all the sources added before it
+        """
+        if depends_on is None:
+            depends_on = list(self.sources.keys())
+        for name in depends_on:
+            if name not in self.sources:
+                raise ValueError(f"Unknown dependency of {source.name}: {name}")
         self.sources[source.name] = source
+        self.dependencies[source.name] = depends_on
+
+    def add_remote(self, name: str, url: str):
+        """
+        Queries a source through its source server instead of a local index (check remote.py)
+        """
+        self.remotes[name] = url
 
     def add_default_sources(self):
         for source in DEFAULT_SOURCES:
             self.add_source(source)
 
-    async def _init_index(self, source: Source, force_reindex: bool = False, only_if_present: bool = False):
+    def _require_registry(self) -> EntityRegistry:
+        if self.registry is None:
+            self.registry = EntityRegistry.open(self.storage, self.index_dir)
+            if self.registry is None:
+                print("Building the entity registry")
+                self.registry = EntityRegistry.build(self.storage, self.index_dir, self.indexes)
+            else:
+                self.registry.refresh(self.indexes)
+        return self.registry
+
+    def _create_resolver(self, source: Source, resolvers: Dict[str, Index]) -> EntityResolver:
+        if self.use_registry:
+            entity_registry = self._require_registry()
+            previous_ids = entity_registry.remove_source(source.name)
+            indexes = [] if entity_registry.is_empty() else [entity_registry.index]
+            uuid_maps = {registry.INDEX_NAME: UuidMap.open_or_build(entity_registry.index, self.index_dir)}
+        else:
+            previous_ids = {}
+            indexes = list(resolvers.values())
+            uuid_maps = self.uuid_maps
+
+        candidates = None
+        if self.resolver_blocking and len(indexes) > 0:
+            candidates = TitleBlocking.build(indexes)
+        titles = None
+        if self.resolver_titles and len(indexes) > 0:
+            titles = TitleIndex.build(indexes, fuzzy=self.resolver_fuzzy_titles)
+        resolver = EntityResolver(*indexes, uuid_maps=uuid_maps, candidates=candidates, titles=titles,
+                                  exact=self.resolver_exact, theta=self.resolver_theta,
+                                  max_rows=self.resolver_max_rows)
+        resolver.previous_ids = previous_ids
+        return resolver
+
+    async def _init_index(self, source: Source, force_reindex: bool = False, only_if_present: bool = False,
+                          resolvers: Optional[Dict[str, Index]] = None, progress: Optional[ProgressReporter] = None):
+        """
+        :param resolvers: indexes used to resolve the entities of the source, None for all the open indexes
+        """
         if not force_reindex and self.storage.index_exists(source.name):
-            index = self.storage.open_index(indexname=source.name, schema=source.schema)
+            # Read it with the schema it was built with, it might have another profile
+            index = self.storage.open_index(indexname=source.name)
+            if index.schema != source.schema and not only_if_present:
+                print(f"{source.name} is indexed with the {profile_of(index.schema)} schema profile instead of "
+                      f"{profile_of(source.schema)}, reindex it with `index --force` to change it")
+        elif only_if_present:
+            return
+        elif self.readonly:
+            raise ValueError(f"{source.name} is not indexed, it can't be indexed in read-only mode")
+        elif self.use_registry:
+            if self._registry_lock is None:
+                self._registry_lock = asyncio.Lock()
+            async with self._registry_lock:
+                index = await self._reindex(source, {}, progress)
+                self.registry.add_source(source.name, index)
         else:
-            if only_if_present:
-                return
-            resolver = EntityResolver(*self.indexes.values())
-            print(f"Initializing {source.name} (with {len(self.indexes)} resolvers)")
-            index = self.storage.create_index(indexname=source.name, schema=source.schema)
-            await source.reindex(index, resolver)
-            print(f"Done, stats: {resolver.reused} reused / {resolver.generated} generated")
+            index = await self._reindex(source, dict(self.indexes) if resolvers is None else resolvers, progress)
 
         self.indexes[source.name] = index
+        if self.readonly:
+            # Without the map (out of date) random access uses term lookups
+            uuid_map = UuidMap.open(index, self.index_dir)
+            if uuid_map is not None:
+                self.uuid_maps[source.name] = uuid_map
+        else:
+            # Building the map reads the whole index, don't stop the other sources
+            self.uuid_maps[source.name] = await asyncio.to_thread(UuidMap.open_or_build, index, self.index_dir)
+        await self._init_shards(source.name)
+
+    async def _init_shards(self, name: str):
+        """
+        Opens the shards of a source index with the current shard count, rebuilding them when they're out of date
+        """
+        for uuid_map in self.shard_maps.pop(name, []):
+            if uuid_map is not None:
+                uuid_map.close()
+        self.shard_indexes.pop(name, None)
+        if self.shards <= 1:
+            return
+        index = self.indexes[name]
+        if self.readonly:
+            indexes = shards.open_shards(self.storage, self.index_dir, index, self.shards)
+            if indexes is None:
+                print(f"{name} has no shards (or they're out of date), build them with `index --shards {self.shards}`")
+                return
+            uuid_maps = [UuidMap.open(shard, self.index_dir) for shard in indexes]
+        else:
+            indexes = await asyncio.to_thread(shards.open_or_build_shards, self.storage, self.index_dir, index,
+                                              self.shards)
+            uuid_maps = [await asyncio.to_thread(UuidMap.open_or_build, shard, self.index_dir) for shard in indexes]
+        self.shard_indexes[name] = indexes
+        self.shard_maps[name] = uuid_maps
+
+    async def reshard(self, count: int):
+        """
+        Changes the shard count of all the sources (1 to search the source indexes)
+        """
+        self.close_searchers()
+        self.shards = count
+        for name in self.indexes:
+            await self._init_shards(name)
+
+    async def _reindex(self, source: Source, resolvers: Dict[str, Index],
+                       progress: Optional[ProgressReporter]) -> Index:
+        resolver = self._create_resolver(source, resolvers)
+        if self.use_registry:
+            print(f"Initializing {source.name} (with the entity registry)")
+        else:
+            print(f"Initializing {source.name} (with {len(resolvers)} resolvers)")
+        index = self.storage.create_index(indexname=source.name, schema=source.schema)
+        await source.reindex(index, resolver, progress)
+        print(f"{source.name} done, stats: {resolver.reused} reused / {resolver.generated} generated")
+        if resolver.candidates is not None:
+            print(f"Blocking: {resolver.blocked} games resolved by blocking / {resolver.searched} searched")
+        if resolver.titles is not None:
+            resolved = resolver.fast_path + resolver.blocked + resolver.searched
+            print(f"Title index: {resolver.fast_path}/{resolved} games resolved by the fast path, "
+                  f"resolution took {resolver.elapsed:.1f}s")
+        return index
+
+    async def scrape(self, update: bool, offline: bool = False):
+        """
+        :param offline: only use the cached API responses (check http_cache.py), to rebuild the dumps
+        """
+        import http_cache
+        cache = http_cache.get_cache()
+        cache.offline = offline
+        board = ProgressBoard()
+        try:
+            await asyncio.gather(*[source.scrape(update, board.reporter(source.name))
+                                   for source in self.sources.values()])
+        finally:
+            board.close()
+        print(f"HTTP cache: {cache.stats()}")
+
+    def _init_entity_index(self, rebuild: bool):
+        if rebuild:
+            print("Building entity index")
+            self.entity_index = entities.build_entity_index(self.storage, self.index_dir, self.indexes, self.uuid_maps)
+            return
+        self.entity_index = entities.open_entity_index(self.storage, self.index_dir, self.indexes)
+        if self.entity_index is None and self.storage.index_exists(entities.INDEX_NAME) \
+                and len(self.sources) == len(DEFAULT_SOURCES):
+            print("The entity index is out of date and won't be used, rebuild it with `index --entities`")
 
-    async def scrape(self, update: bool):
+    async def open(self):
+        """
+        Opens the sources that are already indexed, without indexing the missing ones
+        """
         for source in self.sources.values():
-            await source.scrape(update)
+            if source.name not in self.indexes:
+                await self._init_index(source, only_if_present=True)
+        self._init_entity_index(rebuild=False)
+        await self._init_title_sidecars()
 
-    async def init(self, force_reindex: bool = False):
+    async def init(self, force_reindex: bool = False, build_entities: bool = False):
         # Open sources that are already indexed
         if not force_reindex:
             for source in self.sources.values():
                 if source.name not in self.indexes:
                     await self._init_index(source, only_if_present=True)
 
-        # Open all the other sources (using previous sources as resolvers)
-        for source in self.sources.values():
-            if source.name not in self.indexes:
-                await self._init_index(source, force_reindex=force_reindex)
+        # Index all the other sources (using their dependencies as resolvers)
+        present = dict(self.indexes)
+        tasks = {}  # type: Dict[str, asyncio.Task]
+        board = ProgressBoard()
+
+        async def index_source(source: Source):
+            progress = board.reporter(source.name)
+            waiting = [tasks[name] for name in self.dependencies[source.name] if name in tasks]
+            if len(waiting) > 0:
+                # Download the dump while the dependencies are indexing
+                await source.scrape(False, progress)
+                await asyncio.gather(*waiting)
+            resolvers = {name: self.indexes[name] for name in self.dependencies[source.name]
+                         if name in self.indexes}
+            await self._init_index(source, force_reindex=force_reindex, resolvers=resolvers, progress=progress)
+
+        try:
+            for source in self.sources.values():
+                if source.name not in present:
+                    tasks[source.name] = asyncio.create_task(index_source(source))
+            await asyncio.gather(*tasks.values())
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            board.close()
+        # Keep the indexes in the order of the sources (tasks end in any order)
+        self.indexes = {name: self.indexes[name] for name in self.sources if name in self.indexes}
+
+        self._init_entity_index(rebuild=build_entities)
+        await self._init_title_sidecars()
+
+    async def _init_title_sidecars(self):
+        """
+        Opens the completion and spelling indexes (derived from the titles and the text of all the sources),
+        rebuilding them when the source indexes change
+        """
+        for sidecar in (self.completion, self.spelling):
+            if sidecar is not None:
+                sidecar.close()
+        self.completion = self.spelling = None
+        if self.readonly:
+            self.completion = CompletionIndex.open(self.indexes, self.index_dir)
+            self.spelling = SpellingIndex.open(self.indexes, self.index_dir)
+        elif len(self.indexes) > 0:
+            self.completion = await asyncio.to_thread(CompletionIndex.open_or_build, self.indexes, self.index_dir)
+            self.spelling = await asyncio.to_thread(SpellingIndex.open_or_build, self.indexes, self.index_dir)
+
+    def complete(self, prefix: str, k: int = 10) -> list[Suggestion]:
+        """
+        Titles starting with the prefix, for typeahead (check completion.py)
+        """
+        if self.completion is None:
+            return []
+        return self.completion.complete(prefix, k)
 
     def _require_searchers(self) -> list[tuple[Searcher, str]]:
         if len(self._searchers) != len(self.sources):
-            self._searchers = [(idx.searcher(), idxname) for idxname, idx in self.indexes.items()]
+            if len(self.shard_indexes) > 0 and self._shard_pool is None:
+                names = [shard.indexname for indexes in self.shard_indexes.values() for shard in indexes]
+                self._shard_pool = shards.create_pool(self.index_dir, names,
+                                                      min(self.shards, os.cpu_count() or 1))
+            self._searchers = []
+            self._search_uuid_maps = dict(self.uuid_maps)
+            for idxname, idx in self.indexes.items():
+                if idxname in self.shard_indexes:
+                    searcher = shards.ShardedSearcher(idxname, self.shard_indexes[idxname], self.shard_maps[idxname],
+                                                      self._shard_pool)
+                    self._search_uuid_maps[idxname] = searcher.uuid_map
+                else:
+                    searcher = idx.searcher()
+                self._searchers.append((searcher, idxname))
+            if self.entity_index is not None:
+                self._entity_searcher = self.entity_index.searcher()
         return self._searchers
 
+    def warm_up(self, prefetch: bool = False) -> None:
+        """
+        Opens the searchers, and optionally loads the hot structures of the indexes in memory (check serving.py)
+        """
+        searchers = self._require_searchers()
+        if not prefetch:
+            return
+        for searcher, name in searchers:
+            if isinstance(searcher, shards.ShardedSearcher):
+                for shard, shard_searcher in zip(self.shard_indexes[name], searcher.searchers):
+                    serving.prefetch_index(shard, shard_searcher, self.index_dir)
+            else:
+                serving.prefetch_index(self.indexes[name], searcher, self.index_dir)
+        if self._entity_searcher is not None:
+            serving.prefetch_index(self.entity_index, self._entity_searcher, self.index_dir)
+        for uuid_map in self.uuid_maps.values():
+            uuid_map.prefetch()
+        for uuid_maps in self.shard_maps.values():
+            for uuid_map in uuid_maps:
+                if uuid_map is not None:
+                    uuid_map.prefetch()
+        if self.completion is not None:
+            self.completion.prefetch()
+
+    def close_searchers(self):
+        for searcher, _name in self._searchers:
+            searcher.close()
+        if self._entity_searcher is not None:
+            self._entity_searcher.close()
+        self._searchers = []
+        self._entity_searcher = None
+        # Their sorted accesses read the closed searchers
+        self._page_cursors.clear()
+        if self._shard_pool is not None:
+            self._shard_pool.shutdown()
+            self._shard_pool = None
+        if self._remote_client is not None:
+            self._remote_client.close()
+            self._remote_client = None
+
     def create_parser(self) -> QueryParser:
         p = QueryParser(None, general_schema, group=syntax.OrGroup)
         fieldboosts = {
@@ -102,33 +461,135 @@ class App:
         }))
         return p
 
-    def run_query(self, query_txt: str, k: int = 5) -> list[aggregator.AggregateHit]:
+    def _parse_query(self, query_txt: str) -> tuple[Query, Optional[Query]]:
+        """
+        :return: (scored query, filter query or None)
+        """
         # Remove "1" from the end of queries, this helps since games are
         # always stored as "Portal" not "Portal 1"
         query_txt = re.sub(r"\s+[1I]$", "", query_txt.strip())
 
         qp = self.create_parser()
         query = qp.parse(query_txt)
-        #print(repr(query))
+        if self.typo_tolerance and self.spelling is not None:
+            query = self.spelling.rewrite(query)
+        # Fields indexed without positions (check schema_profiles.py) can't run phrase queries
+        query = without_phrases(query, unpositioned_fields(idx.schema for idx in self.indexes.values()))
+        # Structured constraints (genres, platforms, devs, dates) are cached bitsets, not scored clauses
+        return split_filters(query)
+
+    def _filter_searchers(self, filter_q: Optional[Query]) -> tuple[list[tuple[Searcher, str]], Dict[str, DocIdSet]]:
+        """
+        :return: the searchers with documents accepted by the filter, and their allowed docnums
+        """
         searchers = self._require_searchers()
-        topk_results = aggregator.aggregate_search(query, searchers, k)
+        if filter_q is None:
+            return searchers, {}
+        allows = {name: self.filter_cache.docs(searcher, filter_q) for searcher, name in searchers}
+        # An empty filter would disable the filtering in whoosh, and there's nothing to find there anyway
+        return [(searcher, name) for searcher, name in searchers if allows[name] is not None], allows
+
+    def run_query(self, query_txt: str, k: int = 5, use_entity_index: Optional[bool] = None) -> list[aggregator.AggregateHit]:
+        query, filter_q = self._parse_query(query_txt)
+        #print(repr(query), repr(filter_q))
+        searchers = self._require_searchers()
+        if len(self.remotes) > 0:
+            return self._run_remote_query(query, filter_q, k)
+        if use_entity_index is None:
+            use_entity_index = self.use_entity_index
+        if use_entity_index and self._entity_searcher is not None:
+            # Pre-aggregated entities, single index top-k
+            allow = None
+            if filter_q is not None:
+                allow = self.filter_cache.docs(self._entity_searcher, filter_q)
+                if allow is None:
+                    return []
+            return entities.entity_search(query, self._entity_searcher, searchers, k, self._search_uuid_maps, allow)
+        searchers, allows = self._filter_searchers(filter_q)
+        if len(searchers) == 0:
+            return []
+        topk_results = aggregator.aggregate_search(query, searchers, k, uuid_maps=self._search_uuid_maps,
+                                                   allows=allows, theta=self.theta, max_rows=self.max_rows)
         return topk_results
 
-    def evaluate(self, suite: BenchmarkSuite) -> list[BenchmarkResult]:
-        res = []
-        for bench in tqdm(suite.benchmarks):
-            topk = self.run_query(bench.query, 10)
-            data = {(s.source, s.id): s.relevance for s in bench.scores}
-            entries = []
-            for row in topk:
-                relevance = next((d for hit, source in row.hits if (d := data.get((source, hit['id']))) is not None), 0)
-                entries.append(relevance)
-            res.append(BenchmarkResult(bench, entries))
-        return res
+    def _run_remote_query(self, query: Query, filter_q: Optional[Query], k: int) -> list[aggregator.AggregateHit]:
+        """
+        Query-time aggregation with some sources served by source servers (check remote.py)
+        """
+        import remote
+        if self._remote_client is None:
+            self._remote_client = remote.RemoteClient()
+        sources = [remote.SearcherSource(searcher, name, self._search_uuid_maps.get(name), self.filter_cache)
+                   for searcher, name in self._require_searchers() if name not in self.remotes]
+        sources += [self._remote_client.searcher(name, url) for name, url in self.remotes.items()]
+        return self._remote_client.run(aggregator.aggregate_search_async(query, filter_q, sources, k, theta=self.theta,
+                                                                         max_rows=self.max_rows))
+
+    def run_query_page(self, query_txt: str, k: int = 5,
+                       cursor: Optional[str] = None) -> tuple[list[aggregator.AggregateHit], Optional[str]]:
+        """
+        Pages of the query-time aggregation (check aggregator.aggregate_page)
+
+        The cursors stay in memory with their sorted accesses (the last PAGE_CURSORS ones), the token only names one.
+        A token can be used once: the cursor moves on to the next page.
+
+        :param cursor: token returned with the previous page, None for the first page
+        :return: the results of the page and the token of the next page (None when there are no more results)
+        """
+        query, filter_q = self._parse_query(query_txt)
+        searchers, allows = self._filter_searchers(filter_q)
+        versions = sorted((name, index_version(ix)) for name, ix in self.indexes.items())
+        raw_key = json.dumps([repr(query), repr(filter_q), versions])
+        key = hashlib.blake2b(raw_key.encode('utf-8'), digest_size=12).hexdigest()
+        state = None
+        if cursor is not None:
+            state = self._page_cursors.pop(cursor, None)
+            if state is None:
+                raise ValueError("Unknown cursor (expired, already used, or of another process)")
+        if len(searchers) == 0:
+            return [], None
+        page, state = aggregator.aggregate_page(query, searchers, k, key, state, self._search_uuid_maps, allows)
+        if state is None:
+            return page, None
+        token = f"{key}.{next(self._page_tokens)}"
+        self._page_cursors[token] = state
+        if len(self._page_cursors) > PAGE_CURSORS:
+            self._page_cursors.popitem(last=False)
+        return page, token
+
+    def evaluate(self, suite: BenchmarkSuite, use_entity_index: Optional[bool] = None,
+                 workers: int = 1, use_cache: bool = True) -> list[BenchmarkResult]:
+        from evaluation import Evaluator
+        evaluator = Evaluator(self, workers=workers, use_cache=use_cache)
+        return evaluator.evaluate(suite, use_entity_index=use_entity_index)
+
+    def _completer(self):
+        matches = []
+
+        def complete(text: str, state: int) -> Optional[str]:
+            if state == 0:
+                head, title = split_query(text)
+                matches[:] = [head + s.title for s in self.complete(title)] if title.strip() else []
+            return matches[state] if state < len(matches) else None
+        return complete
 
     def prompt(self):
         # Eager searcher initialization (reduces first interaction time)
         self._require_searchers()
+        try:
+            import readline
+        except ImportError:
+            readline = None
+        if readline is not None and self.completion is not None:
+            # Tab completes the title being typed (the whole line is passed to the completer)
+            readline.set_completer(self._completer())
+            readline.set_completer_delims('')
+            readline.parse_and_bind('tab: complete')
+        # Query-time aggregation can be paged: an empty line shows the next page of the last query
+        paging = (not self.use_entity_index or self._entity_searcher is None) and len(self.remotes) == 0
+        last_query = None
+        cursor = None
+        shown = 0
         while True:
             try:
                 query_txt = input(">")
@@ -137,12 +598,19 @@ class App:
             except EOFError:
                 return
 
-            topk_results = self.run_query(query_txt)
+            if query_txt.strip() == '' and cursor is not None:
+                topk_results, cursor = self.run_query_page(last_query, 5, cursor)
+            elif paging:
+                topk_results, cursor = self.run_query_page(query_txt, 5)
+                last_query = query_txt
+                shown = 0
+            else:
+                topk_results = self.run_query(query_txt)
             topk_results.reverse()
             # print process
             for itr, el in enumerate(topk_results):
                 print("\n\n\n***********************")
-                print(f"Result n. {len(topk_results) - itr}: ")
+                print(f"Result n. {shown + len(topk_results) - itr}: ")
                 print("***********************")
                 for hit, source in el.hits:
                     print("------------------------")
@@ -166,6 +634,9 @@ class App:
                 print(f"Score {el.total_score}")
                 print(".................")
             print("___________________________________________________________________________")
+            shown += len(topk_results)
+            if cursor is not None:
+                print("(empty line for more results)")
             
             
 class FieldBoosterPlugin(Plugin):
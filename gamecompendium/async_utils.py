@@ -1,6 +1,10 @@
-from typing import TypeVar, Awaitable
+import asyncio
+from concurrent.futures import Executor
+from typing import TypeVar, Awaitable, Callable, Optional
 import traceback
 
+from progress import ProgressChannel, ProgressReporter
+
 T = TypeVar('T')
 
 
@@ -11,3 +15,30 @@ async def soft_log_exceptions(wrapped: Awaitable[T]) -> T:
         print(f"Oops, exception occurred!")
         traceback.print_exc()
 
+
+async def run_in_executor(fn: Callable[..., T], *args, progress: ProgressReporter,
+                          executor: Optional[Executor] = None) -> T:
+    """
+    Runs blocking (CPU-bound) code without stopping the event loop
+
+    fn is called with a ProgressChannel as last argument, it should report its progress only through it (and stop
+    with CancelledError when asked to, progress.update already checks it).
+    When the calling task is cancelled the worker is asked to stop and awaited, so that it never outlives the task
+    (ex. with an index writer still open).
+
+    :param executor: executor running fn, None for the default thread pool of the loop
+    """
+    loop = asyncio.get_running_loop()
+    channel = ProgressChannel(loop, progress)
+    future = loop.run_in_executor(executor, fn, *args, channel)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        channel.cancel()
+        await asyncio.wait([future])
+        if not future.cancelled():
+            # Retrieve it, the worker stopped because we asked it to
+            future.exception()
+        raise
+    finally:
+        channel.flush()
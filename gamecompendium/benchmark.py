@@ -26,6 +26,8 @@ class BenchmarkSuite:
 class BenchmarkResult:
     query: Benchmark
     raw: list[int]
+    # Query time (in seconds), None if the run was cached
+    elapsed: Optional[float] = None
 
 
 # query portal 2 # comment
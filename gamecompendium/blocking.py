@@ -0,0 +1,87 @@
+import datetime
+from typing import Protocol, Optional, Iterable, Dict
+
+from whoosh.index import Index
+
+from analyzers import keep_numbers_analyzer
+
+# Candidate generation ("blocking") for the entity resolver.
+# EntityResolver.compute runs a full top-k aggregation for every game, but most games can only match a handful of
+# entities, the ones with similar names. A blocking index is a cheap in-memory structure that finds these
+# candidates, then only the survivors are scored with the real resolver query (by random access).
+# When the blocking stage doesn't find anything, or the block is too big to be useful, the resolver falls back
+# to the full search.
+#
+# TitleBlocking uses the tokens of the name (the same tokens the name field is indexed with):
+# - the candidates are the entities sharing the rarest token of the name (ex. "witcher" for "The Witcher 3")
+# - when the block is still too big it's intersected with the next rarest tokens
+# - then with the entities of the same developers or release years (if known)
+
+
+class CandidateGenerator(Protocol):
+    """Finds the candidate entities of a game, before they're scored by the resolver"""
+
+    def candidates(self, name: str, dev_companies: list[str], release_date: Optional[datetime.datetime]) -> Optional[set[str]]:
+        """
+        :return: the UUIDs of the candidate entities, or None if the full search should be used
+        """
+
+
+class TitleBlocking(CandidateGenerator):
+    def __init__(self, max_block: int = 64):
+        # Maximum number of candidates, bigger blocks are narrowed down (or discarded)
+        self.max_block = max_block
+        self.analyzer = keep_numbers_analyzer()
+        # token -> uuids of the entities having that token in their name
+        self.by_token = {}  # type: Dict[str, set[str]]
+        # developer -> uuids
+        self.by_dev = {}  # type: Dict[str, set[str]]
+        # release year -> uuids
+        self.by_year = {}  # type: Dict[int, set[str]]
+
+    def _tokens(self, name: str) -> list[str]:
+        return list(dict.fromkeys(t.text for t in self.analyzer(name)))
+
+    def add(self, uuid: str, name: str, dev_companies: Iterable[str], release_date: Optional[datetime.datetime]) -> None:
+        for token in self._tokens(name):
+            self.by_token.setdefault(token, set()).add(uuid)
+        for dev in dev_companies:
+            self.by_dev.setdefault(dev, set()).add(uuid)
+        if release_date is not None:
+            self.by_year.setdefault(release_date.year, set()).add(uuid)
+
+    @staticmethod
+    def build(indexes: Iterable[Index], max_block: int = 64) -> 'TitleBlocking':
+        """
+        Builds the blocking index from the stored fields of already indexed sources
+        """
+        res = TitleBlocking(max_block)
+        for index in indexes:
+            with index.reader() as reader:
+                for fields in reader.all_stored_fields():
+                    devs = fields['devs'].split(',') if fields.get('devs') else []
+                    res.add(fields['uuid'], fields.get('name') or '', devs, fields.get('date'))
+        return res
+
+    def candidates(self, name: str, dev_companies: list[str], release_date: Optional[datetime.datetime]) -> Optional[set[str]]:
+        blocks = [self.by_token[t] for t in self._tokens(name) if t in self.by_token]
+        if len(blocks) == 0:
+            return None
+        blocks.sort(key=len)
+
+        res = blocks[0]
+        for block in blocks[1:]:
+            if len(res) <= self.max_block:
+                break
+            res = res & block
+
+        if len(res) > self.max_block and len(dev_companies) > 0:
+            devs = set().union(*(self.by_dev.get(d, ()) for d in dev_companies))
+            res = res & devs
+        if len(res) > self.max_block and release_date is not None:
+            years = set().union(*(self.by_year.get(y, ()) for y in range(release_date.year - 1, release_date.year + 2)))
+            res = res & years
+
+        if len(res) == 0 or len(res) > self.max_block:
+            return None
+        return res
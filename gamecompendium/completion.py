@@ -0,0 +1,328 @@
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from typing import Optional, Dict, NamedTuple, Iterable
+
+from whoosh.index import Index
+
+from title_index import plain_words
+from uuid_map import index_version
+
+# Title autocomplete
+# A prefix query (`name:port*`) expands the prefix against the whole name lexicon and then runs the threshold
+# algorithm on every source: way too slow to run at every keystroke. The completion index answers
+# "which games start with these characters?" without touching the indexes.
+# It's built from the names of the entities of all the sources (one suggestion per distinct normalized title),
+# every title is normalized (title_index.plain_words, roman numerals are kept as typed) and inserted once for every
+# word it contains ("grand theft auto v", "theft auto v", "auto v", "v") so "auto" completes "Grand Theft Auto V".
+# Suggestions are ranked by:
+# - matching the start of the title before matching a later word
+# - number of sources with the game (we have no sales or ratings, a game known everywhere is the most popular)
+# - shorter titles first ("Portal 2" before "Portal 2 - Soundtrack")
+# packed together in a single integer weight.
+#
+# The sidecar is a flat file in the index folder, memory-mapped and searched in place like the uuid maps:
+#   header: magic, version of the source indexes, entry count, title count, top table count
+#   entries: key offsets[count + 1], title[count], weight[count]  (sorted by key)
+#   titles: offsets[titles + 1]
+#   top table: key offsets[top + 1], TOP_K entries for every prefix  (sorted by prefix)
+#   blobs: entry keys, titles ("uuid name"), table prefixes  (UTF-8)
+# Every prefix matches a contiguous range of the sorted keys. Small ranges (up to SCAN_LIMIT entries) are scanned,
+# every prefix with a bigger range has its top entries precomputed in the top table, so a lookup never reads more
+# than SCAN_LIMIT weights. Offsets point in the blob section, all the integers are unsigned 32 bit.
+
+HEADER = struct.Struct('=4s4xqIIII')
+MAGIC = b'GCAC'
+SIDECAR_NAME = 'completion.bin'
+TOP_K = 10
+SCAN_LIMIT = 256
+NO_ENTRY = 0xFFFFFFFF
+
+QUERY_OPERATORS = ('AND', 'OR', 'NOT', 'ANDNOT', 'ANDMAYBE')
+
+MAX_SOURCES = 1023
+MAX_LENGTH = 1023
+
+
+class Suggestion(NamedTuple):
+    title: str
+    uuid: str
+    weight: int
+
+
+def completion_key(text: str) -> str:
+    return ' '.join(plain_words(text))
+
+
+def split_query(text: str) -> tuple[str, str]:
+    """
+    Splits a query typed in the prompt in (head, title being typed): the title is what follows the last
+    field or operator ("genres:rpg port" => ("genres:rpg ", "port"))
+    """
+    words = text.split(' ')
+    last = max((i for i, w in enumerate(words) if ':' in w or w in QUERY_OPERATORS), default=-1)
+    return ' '.join(words[:last + 1] + ['']) if last >= 0 else '', ' '.join(words[last + 1:])
+
+
+def _weight(title_start: bool, sources: int, length: int) -> int:
+    return (int(title_start) << 20) | (min(sources, MAX_SOURCES) << 10) | (MAX_LENGTH - min(length, MAX_LENGTH))
+
+
+def completion_version(indexes: Dict[str, Index]) -> int:
+    versions = ','.join(f"{name}:{index_version(ix)}" for name, ix in sorted(indexes.items()))
+    return int.from_bytes(hashlib.blake2b(versions.encode('utf-8'), digest_size=8).digest(), 'little') >> 1
+
+
+def sidecar_path(folder: str) -> str:
+    return os.path.join(folder, SIDECAR_NAME)
+
+
+def _collect_titles(indexes: Dict[str, Index]) -> list[tuple[str, str, int]]:
+    """
+    :return: (title, uuid, number of sources) for every distinct normalized title, different entities with the
+             same title (unresolved duplicates, remakes...) are suggested once, with the entity found in most sources
+    """
+    entities = {}  # type: Dict[str, Dict[str, str]]  # uuid -> normalized title -> display title
+    sources = {}  # type: Dict[str, set[str]]
+    for name, index in indexes.items():
+        with index.reader() as reader:
+            for _docnum, stored in reader.iter_docs():
+                title = stored.get('name')
+                if not title:
+                    continue
+                uuid = stored['uuid']
+                entities.setdefault(uuid, {}).setdefault(completion_key(title), title)
+                sources.setdefault(uuid, set()).add(name)
+    titles = {}  # type: Dict[str, tuple[str, str, int]]
+    for uuid, entity_titles in entities.items():
+        for key, title in entity_titles.items():
+            if key not in titles or titles[key][2] < len(sources[uuid]):
+                titles[key] = (title, uuid, len(sources[uuid]))
+    return list(titles.values())
+
+
+def _top(entries: Iterable[int], weights: list[int], titles: list[int], k: int = TOP_K) -> list[int]:
+    """Best k entries with distinct titles (a title can match a prefix with more than one of its words)"""
+    res = []
+    seen = set()
+    for e in sorted(entries, key=weights.__getitem__, reverse=True):
+        if titles[e] in seen:
+            continue
+        seen.add(titles[e])
+        res.append(e)
+        if len(res) == k:
+            break
+    return res
+
+
+def _top_table(keys: list[bytes], weights: list[int], titles: list[int]) -> list[tuple[bytes, list[int]]]:
+    table = []
+    # (start, end, depth): the keys in start:end share their first `depth` bytes
+    stack = [(0, len(keys), 0)]
+    while stack:
+        start, end, depth = stack.pop()
+        if end - start <= SCAN_LIMIT:
+            continue
+        if depth > 0:
+            table.append((keys[start][:depth], _top(range(start, end), weights, titles)))
+        # Split by the next byte (keys equal to the prefix come first and have no next byte)
+        i = start
+        while i < end and len(keys[i]) <= depth:
+            i += 1
+        while i < end:
+            byte = keys[i][depth]
+            j = i
+            while j < end and keys[j][depth] == byte:
+                j += 1
+            stack.append((i, j, depth + 1))
+            i = j
+    table.sort()
+    return table
+
+
+def _int_count(count: int, title_count: int, top_count: int) -> int:
+    return count * 3 + 1 + title_count + 1 + top_count + 1 + top_count * TOP_K
+
+
+def string_offsets(blobs: list[bytes], base: int) -> array:
+    offsets = array('I', [base])
+    for b in blobs:
+        offsets.append(offsets[-1] + len(b))
+    return offsets
+
+
+class StringTable:
+    """Read-only sequence of the UTF-8 strings of a blob (for bisect)"""
+
+    def __init__(self, data: memoryview, offsets: memoryview):
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return bytes(self._data[self._offsets[i]:self._offsets[i + 1]])
+
+
+class CompletionIndex:
+    """
+    Read-only top-k prefix search on the titles of all the entities (check the comment at the top)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as fd:
+            self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version, count, title_count, top_count, _ = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"Invalid completion index: {path}")
+        self._data = memoryview(self._mmap)
+        ints = self._data[HEADER.size:HEADER.size + _int_count(count, title_count, top_count) * 4].cast('I')
+        self._views = [ints]
+        pos = 0
+
+        def take(n: int) -> memoryview:
+            nonlocal pos
+            pos += n
+            self._views.append(ints[pos - n:pos])
+            return self._views[-1]
+
+        self._keys = StringTable(self._data, take(count + 1))
+        self._titles = take(count)
+        self._weights = take(count)
+        self._title_strings = StringTable(self._data, take(title_count + 1))
+        self._top_keys = StringTable(self._data, take(top_count + 1))
+        self._top = take(top_count * TOP_K)
+
+    def __len__(self) -> int:
+        return len(self._title_strings)
+
+    def _suggestion(self, entry: int) -> Suggestion:
+        uuid, title = self._title_strings[self._titles[entry]].decode('utf-8').split(' ', 1)
+        return Suggestion(title, uuid, self._weights[entry])
+
+    def complete(self, prefix: str, k: int = TOP_K) -> list[Suggestion]:
+        """
+        Best titles starting with the prefix (or with a word starting with it)
+
+        :param k: number of suggestions, at most TOP_K
+        """
+        key = completion_key(prefix)
+        if key == '':
+            return []
+        if prefix[-1:].isspace():
+            # "portal " shouldn't complete "portals"
+            key += ' '
+        key = key.encode('utf-8')
+        start = bisect.bisect_left(self._keys, key)
+        end = bisect.bisect_left(self._keys, key + b'\xff', lo=start)
+        if end - start <= SCAN_LIMIT:
+            entries = _top(range(start, end), self._weights, self._titles, k)
+        else:
+            i = bisect.bisect_left(self._top_keys, key)
+            if i == len(self._top_keys) or self._top_keys[i] != key:
+                raise ValueError(f"Corrupted completion index: {self.path}")
+            entries = [e for e in self._top[i * TOP_K:i * TOP_K + k] if e != NO_ENTRY]
+        return [self._suggestion(e) for e in entries]
+
+    @staticmethod
+    def build(indexes: Dict[str, Index], path: str) -> None:
+        """
+        Writes the completion sidecar of the current version of the indexes
+        """
+        titles = _collect_titles(indexes)
+        entries = []
+        for title_id, (title, _uuid, sources) in enumerate(titles):
+            words = completion_key(title).split(' ')
+            length = len(title)
+            for i in range(len(words)):
+                entries.append((' '.join(words[i:]).encode('utf-8'), title_id, _weight(i == 0, sources, length)))
+        entries.sort()
+        keys = [e[0] for e in entries]
+        title_ids = [e[1] for e in entries]
+        weights = [e[2] for e in entries]
+        table = _top_table(keys, weights, title_ids)
+
+        title_blobs = [f"{uuid} {title}".encode('utf-8') for title, uuid, _sources in titles]
+        table_blobs = [prefix for prefix, _top_entries in table]
+        blob_start = HEADER.size + _int_count(len(keys), len(title_blobs), len(table)) * 4
+        key_offsets = string_offsets(keys, blob_start)
+        title_offsets = string_offsets(title_blobs, key_offsets[-1])
+        table_offsets = string_offsets(table_blobs, title_offsets[-1])
+        top = array('I')
+        for _prefix, top_entries in table:
+            top.extend(top_entries + [NO_ENTRY] * (TOP_K - len(top_entries)))
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fd:
+            fd.write(HEADER.pack(MAGIC, completion_version(indexes), len(keys), len(title_blobs), len(table), 0))
+            key_offsets.tofile(fd)
+            array('I', title_ids).tofile(fd)
+            array('I', weights).tofile(fd)
+            title_offsets.tofile(fd)
+            table_offsets.tofile(fd)
+            top.tofile(fd)
+            for blobs in (keys, title_blobs, table_blobs):
+                fd.write(b''.join(blobs))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def open(indexes: Dict[str, Index], folder: str) -> Optional['CompletionIndex']:
+        """
+        Opens the completion sidecar, None if it's missing or out of date
+        """
+        path = sidecar_path(folder)
+        if not os.path.exists(path):
+            return None
+        completion = CompletionIndex(path)
+        if completion.version == completion_version(indexes):
+            return completion
+        completion.close()
+        return None
+
+    @staticmethod
+    def open_or_build(indexes: Dict[str, Index], folder: str) -> 'CompletionIndex':
+        completion = CompletionIndex.open(indexes, folder)
+        if completion is not None:
+            return completion
+        path = sidecar_path(folder)
+        CompletionIndex.build(indexes, path)
+        return CompletionIndex(path)
+
+    def prefetch(self) -> None:
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            self._mmap.madvise(mmap.MADV_WILLNEED)
+        sum(self._mmap[i] for i in range(0, len(self._mmap), mmap.PAGESIZE))
+
+    def close(self) -> None:
+        self._keys = self._title_strings = self._top_keys = None
+        self._titles = self._weights = self._top = None
+        for view in reversed(self._views):
+            view.release()
+        self._data.release()
+        self._mmap.close()
+
+
+def _benchmark(folder: str, prefixes: list[str], repeat: int = 1000):
+    """
+    Micro-benchmark: completion latency of some prefixes on the completion index of an index folder
+    """
+    completion = CompletionIndex(sidecar_path(folder))
+    print(f"{len(completion)} titles")
+    for prefix in prefixes:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            res = completion.complete(prefix)
+        elapsed = (time.perf_counter() - start) / repeat
+        print(f"{prefix!r}: {elapsed * 1e6:.1f}us {[s.title for s in res[:5]]}")
+
+
+if __name__ == '__main__':
+    # python completion.py indexes port "grand th" a
+    _benchmark(sys.argv[1], sys.argv[2:])
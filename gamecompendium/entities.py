@@ -0,0 +1,142 @@
+import json
+import os
+from typing import Dict, Optional
+
+from whoosh import fields
+from whoosh.filedb.filestore import Storage
+from whoosh.idsets import DocIdSet
+from whoosh.index import Index
+from whoosh.query import Query
+from whoosh.searching import Searcher
+
+from aggregator import AggregateHit
+from analyzers import keep_numbers_analyzer
+from schema_profiles import keyword_field
+from uuid_map import UuidMap, index_version
+
+# Query-time aggregation (aggregator.py) is flexible but every query pays for the threshold algorithm and
+# for the random accesses to the other sources.
+# Once the entities are resolved we can also "pre-aggregate" them: the entity index has one document per uuid
+# that contains the score-relevant fields of all its instances, a query becomes a single-index top-k and the
+# source documents are fetched only for the k results (through the uuid maps).
+# Scores are not the same as the aggregated ones (BM25 runs on the merged text instead of averaging the per-source
+# scores), use `evaluate --compare-entities` to check how it changes the ranking quality.
+#
+# The entity index is derived data: it records the versions of the source indexes it was built from and it's
+# only used when they all match the current ones.
+
+INDEX_NAME = 'entities'
+
+schema = fields.Schema(
+    uuid=fields.ID(stored=True, unique=True),
+    name=fields.TEXT(analyzer=keep_numbers_analyzer()),
+    storyline=fields.TEXT(),
+    summary=fields.TEXT(),
+    genres=keyword_field(stored=False),
+    platforms=keyword_field(stored=False),
+    devs=keyword_field(stored=False),
+    date=fields.DATETIME(),
+)
+
+TEXT_FIELDS = ('name', 'storyline', 'summary', 'genres', 'platforms', 'devs')
+# Comma separated keywords (check schema_profiles.keyword_field)
+KEYWORD_FIELDS = ('genres', 'platforms', 'devs')
+
+
+def _versions_path(folder: str) -> str:
+    return os.path.join(folder, f"{INDEX_NAME}.sources")
+
+
+def _merge_instances(instances: list[dict]) -> dict:
+    doc = {}
+    for field in TEXT_FIELDS:
+        # Deduplicate values, if both sources call it "Portal 2" we don't want to double its frequency
+        values = dict.fromkeys(v for i in instances if (v := i.get(field)))
+        if len(values) > 0:
+            doc[field] = (',' if field in KEYWORD_FIELDS else '\n').join(values)
+    dates = [d for i in instances if (d := i.get('date')) is not None]
+    if len(dates) > 0:
+        doc['date'] = min(dates)
+    return doc
+
+
+def build_entity_index(storage: Storage, folder: str, indexes: Dict[str, Index], uuid_maps: Dict[str, UuidMap]) -> Index:
+    """
+    Builds the entity index, merging the instances of every entity found in the source indexes
+
+    :param storage: storage where the entity index will be created
+    :param folder: folder of the storage (used for the version sidecar)
+    :param indexes: source name -> source index
+    :param uuid_maps: source name -> uuid map of the source index
+    :return: the new entity index
+    """
+    from tqdm import tqdm  # Only to build it, the query path never does
+
+    index = storage.create_index(schema, indexname=INDEX_NAME)
+    readers = {name: ix.reader() for name, ix in indexes.items()}
+    try:
+        with index.writer() as writer:
+            total = sum(r.doc_count() for r in readers.values())
+            visited = set()
+            with tqdm(total=total, dynamic_ncols=True) as progress:
+                for name, reader in readers.items():
+                    for _docnum, stored in reader.iter_docs():
+                        progress.update(1)
+                        uuid = stored['uuid']
+                        if uuid in visited:
+                            continue
+                        visited.add(uuid)
+                        instances = [stored]
+                        # Random access the instances in the other sources
+                        for other_name, other_reader in readers.items():
+                            if other_name == name:
+                                continue
+                            docnum = uuid_maps[other_name].document_number(uuid)
+                            if docnum is not None:
+                                instances.append(other_reader.stored_fields(docnum))
+                        writer.add_document(uuid=uuid, **_merge_instances(instances))
+    finally:
+        for r in readers.values():
+            r.close()
+
+    with open(_versions_path(folder), 'wt') as fd:
+        json.dump({name: index_version(ix) for name, ix in indexes.items()}, fd)
+    return index
+
+
+def open_entity_index(storage: Storage, folder: str, indexes: Dict[str, Index]) -> Optional[Index]:
+    """
+    Opens the entity index only if it's built from the exact same source indexes (same sources and versions)
+    """
+    if not storage.index_exists(INDEX_NAME):
+        return None
+    try:
+        with open(_versions_path(folder), 'rt') as fd:
+            versions = json.load(fd)
+    except FileNotFoundError:
+        return None
+    if versions != {name: index_version(ix) for name, ix in indexes.items()}:
+        return None
+    index = storage.open_index(indexname=INDEX_NAME)
+    if index.schema != schema:
+        return None
+    return index
+
+
+def entity_search(query: Query, entity_searcher: Searcher, searchers_idxs: list[tuple[Searcher, str]], k: int,
+                  uuid_maps: Dict[str, UuidMap], allow: Optional[DocIdSet] = None) -> list[AggregateHit]:
+    """
+    Single-index top-k on the entity index, the results have the same shape of aggregator.aggregate_search
+
+    :param allow: entity docnums accepted by the filters (check filters.py), None to accept everything
+    """
+    res = []
+    for hit in entity_searcher.search(query, limit=k, filter=allow):
+        uuid = hit['uuid']
+        hits = []
+        for searcher, name in searchers_idxs:
+            docnum = uuid_maps[name].document_number(uuid)
+            if docnum is not None:
+                hits.append((searcher.stored_fields(docnum), name))
+        res.append(AggregateHit(hits, hit.score))
+    return res
@@ -0,0 +1,303 @@
+import asyncio
+import hashlib
+import json
+import math
+import multiprocessing.util
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, TextIO, Dict
+
+from tqdm import tqdm
+
+from benchmark import BenchmarkSuite, BenchmarkResult, Benchmark
+from uuid_map import index_version
+
+# Evaluation engine
+# Searching is by far the slowest part of an evaluation, while the metrics are cheap and change often.
+# So we split them: a "run" is the raw ranked list of a query (for every rank: the instances (source, id) and the
+# score), runs are computed in a process pool (every worker has its own App with warm searchers) and cached
+# on disk. The cache key contains the query, k, the search variant and the version of every index,
+# so re-indexing invalidates it but changing the metrics doesn't.
+# Runs can also be exported in TREC format to be used with external tools (ex. trec_eval).
+# Latency is never cached: a cached run was timed by another process, under the contention of the pool, maybe with
+# other indexes. Latencies are measured by time_modes, serially in this process, every mode in the same pass.
+
+CACHE_FILE = 'evaluation.cache'
+# Everything >= 2 is "relevant" (used for everything except DCG-related stuff)
+RELEVANCE_THRESHOLD = 2
+
+
+@dataclass
+class RankedRow:
+    # Instances of the entity: (source, id)
+    hits: list[tuple[str, str]]
+    score: float
+
+
+@dataclass
+class Run:
+    rows: list[RankedRow]
+    # Query time (in seconds), None for the runs read from the cache
+    elapsed: Optional[float] = None
+
+
+@dataclass
+class QueryMetrics:
+    dcg: float
+    ideal_dcg: float
+    ndcg: float
+    # Precision at every relevant document found (natural recall levels)
+    natural_precision: list[float]
+    total_relevant: int
+    # Interpolated precision at the 10 standard recall levels
+    standard_precision: list[float]
+    average_precision: float
+    average_interpolated_precision: float
+
+
+def compute_discounted_cumulative_gain(data: list[int]) -> float:
+    if len(data) == 0:
+        return 0
+    return data[0] + sum([(data[i] / math.log(i + 1, 2)) for i in range(1, len(data))])
+
+
+def compute_metrics(result: BenchmarkResult) -> QueryMetrics:
+    dcg = compute_discounted_cumulative_gain(result.raw)
+    ideal_list = sorted([x.relevance for x in result.query.scores], reverse=True)
+    ideal_dcg = compute_discounted_cumulative_gain(ideal_list)
+
+    natural_pr = []
+    tot_rel = sum([x.relevance >= RELEVANCE_THRESHOLD for x in result.query.scores])
+    for i, entry in enumerate(result.raw):
+        if entry >= RELEVANCE_THRESHOLD:
+            natural_pr.append((len(natural_pr) + 1) / (i + 1))
+
+    precisions = [0.0] * 10
+    for i in range(10):
+        precisions[i] = max([value for j, value in enumerate(natural_pr) if (j + 1) / tot_rel >= (i + 1) / 10], default=0)
+
+    return QueryMetrics(
+        dcg=dcg,
+        ideal_dcg=ideal_dcg,
+        ndcg=dcg / ideal_dcg,
+        natural_precision=natural_pr,
+        total_relevant=tot_rel,
+        standard_precision=precisions,
+        average_precision=sum(natural_pr) / tot_rel,
+        average_interpolated_precision=sum(precisions) / 10,
+    )
+
+
+def print_report(results: list[BenchmarkResult]) -> None:
+    interp_precisions = [0.0] * 10
+    metrics = [compute_metrics(el) for el in results]
+    for el, m in zip(results, metrics):
+        print(f"{el.query.query} : {[x.relevance for x in el.query.scores]} {el.raw}")
+        print(f"DCG: {m.dcg}")
+        print(f"IDEAL DCG: {m.ideal_dcg}")
+        print(f"NDCG: {m.ndcg}")
+        print("Natural precision: ")
+        print(" | ".join([f"{(i + 1) / m.total_relevant}:{value}" for i, value in enumerate(m.natural_precision)]))
+        print("Standard precision: ")
+        print(" | ".join([f"{(i + 1) / 10}:{value}" for i, value in enumerate(m.standard_precision)]))
+        print(f"Average non-interpolated precision: {m.average_precision}")
+        print(f"Average interpolated precision: {m.average_interpolated_precision}")
+        print("\n")
+        for i, value in enumerate(m.standard_precision):
+            interp_precisions[i] += value
+
+    mean_avg = sum(m.average_interpolated_precision for m in metrics) / len(results)
+    print(f"Mean average precision: {mean_avg}")
+    print("Average Standard precision: ")
+    print(" | ".join([f"{(key + 1) / 10}:{value / len(results)}" for key, value in enumerate(interp_precisions)]))
+
+
+def mean_ndcg(results: list[BenchmarkResult]) -> float:
+    return sum(compute_metrics(el).ndcg for el in results) / len(results)
+
+
+def write_trec_run(fd: TextIO, suite: BenchmarkSuite, runs: list[Run], tag: str) -> None:
+    """
+    Writes runs in the TREC format: "qid Q0 docno rank score tag"
+
+    Query ids are the 1-based position of the query in the suite, docno is the first instance of the entity
+    ("source:id").
+    """
+    for qid, (bench, run) in enumerate(zip(suite.benchmarks, runs), start=1):
+        for rank, row in enumerate(run.rows, start=1):
+            source, doc_id = row.hits[0]
+            fd.write(f"{qid} Q0 {source}:{doc_id} {rank} {row.score} {tag}\n")
+
+
+def judge(bench: Benchmark, run: Run) -> BenchmarkResult:
+    """Applies the benchmark relevance judgements to a run"""
+    data = {(s.source, s.id): s.relevance for s in bench.scores}
+    entries = []
+    for row in run.rows:
+        relevance = next((d for source, hit_id in row.hits if (d := data.get((source, hit_id))) is not None), 0)
+        entries.append(relevance)
+    return BenchmarkResult(bench, entries, run.elapsed)
+
+
+# --------------------------------- Worker process ---------------------------------
+# Every worker opens its own App once (initializer) and keeps the searchers warm for all its queries
+
+_worker_app = None
+
+
+# App settings that change the results of the queries (copied to the workers, part of the cache keys)
+QUERY_SETTINGS = ('use_entity_index', 'typo_tolerance', 'theta', 'max_rows', 'shards')
+
+
+def _init_worker(index_dir: str, sources: list, settings: Dict[str, object]) -> None:
+    global _worker_app
+    from app import App
+
+    # The indexes (and their uuid maps) are already built by the parent process
+    app = App(index_dir, readonly=True)
+    for source in sources:
+        app.add_source(source)
+    # Before opening the indexes: the shards are opened with them
+    for name, value in settings.items():
+        setattr(app, name, value)
+    asyncio.run(app.open())
+    app._require_searchers()
+    _worker_app = app
+    # A worker with shards runs its own shard pool: shut it down before multiprocessing waits for its processes at
+    # exit, and before the queues of the pool are closed (priority 10), or its workers never get the stop sentinels
+    multiprocessing.util.Finalize(app, app.close_searchers, exitpriority=100)
+
+
+def query_settings(app) -> Dict[str, object]:
+    return {name: getattr(app, name) for name in QUERY_SETTINGS}
+
+
+def _run_query(app, query: str, k: int) -> Run:
+    start = time.perf_counter()
+    topk = app.run_query(query, k)
+    elapsed = time.perf_counter() - start
+    rows = [RankedRow([(source, hit['id']) for hit, source in row.hits], row.total_score) for row in topk]
+    return Run(rows, elapsed)
+
+
+def _worker_run_query(query: str, k: int) -> Run:
+    return _run_query(_worker_app, query, k)
+
+
+class Evaluator:
+    """
+    Runs benchmark suites against an App, with a process pool and a persistent cache of the raw runs
+    """
+
+    def __init__(self, app, workers: int = 1, use_cache: bool = True):
+        self.app = app
+        self.workers = workers
+        self.use_cache = use_cache
+        self.cache_path = os.path.join(app.index_dir, CACHE_FILE)
+        self._cache = None  # type: Optional[Dict[str, dict]]
+
+    def _load_cache(self) -> Dict[str, dict]:
+        if self._cache is None:
+            self._cache = {}
+            if self.use_cache and os.path.isfile(self.cache_path):
+                with open(self.cache_path, 'rt') as fd:
+                    self._cache = json.load(fd)
+        return self._cache
+
+    def _save_cache(self) -> None:
+        if not self.use_cache:
+            return
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'wt') as fd:
+            json.dump(self._cache, fd)
+        os.replace(tmp_path, self.cache_path)
+
+    def _cache_key(self, query: str, k: int, variant: str) -> str:
+        versions = sorted((name, index_version(ix)) for name, ix in self.app.indexes.items())
+        if self.app.entity_index is not None:
+            versions.append(('entities', index_version(self.app.entity_index)))
+        raw = json.dumps([query, k, variant, versions])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def search(self, suite: BenchmarkSuite, k: int = 10, use_entity_index: Optional[bool] = None) -> list[Run]:
+        """
+        Computes the raw runs of every query of the suite (reusing the cached ones)
+        """
+        if use_entity_index is None:
+            use_entity_index = self.app.use_entity_index
+        variant = 'entities' if use_entity_index and self.app.entity_index is not None else 'aggregate'
+        if self.app.typo_tolerance and self.app.spelling is not None:
+            variant += '+typos'
+        if variant.startswith('aggregate') and (self.app.theta != 1 or self.app.max_rows is not None):
+            variant += f"+theta={self.app.theta},rows={self.app.max_rows}"
+        if self.app.shards > 1:
+            # Every shard scores with its own statistics, the rankings change
+            variant += f"+shards={self.app.shards}"
+        cache = self._load_cache()
+        keys = [self._cache_key(b.query, k, variant) for b in suite.benchmarks]
+        missing = [i for i, key in enumerate(keys) if key not in cache]
+
+        if len(missing) > 0:
+            queries = [suite.benchmarks[i].query for i in missing]
+            if self.workers <= 1:
+                self.app.use_entity_index, previous = use_entity_index, self.app.use_entity_index
+                self.app._require_searchers()
+                try:
+                    runs = [_run_query(self.app, q, k) for q in tqdm(queries)]
+                finally:
+                    self.app.use_entity_index = previous
+            else:
+                settings = {**query_settings(self.app), 'use_entity_index': use_entity_index}
+                init_args = (self.app.index_dir, list(self.app.sources.values()), settings)
+                with ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=init_args) as pool:
+                    runs = list(tqdm(pool.map(_worker_run_query, queries, [k] * len(queries)), total=len(queries)))
+            for i, run in zip(missing, runs):
+                cache[keys[i]] = run_to_json(run)
+            self._save_cache()
+
+        return [run_from_json(cache[key]) for key in keys]
+
+    def time_modes(self, suite: BenchmarkSuite, modes: Dict[str, Dict[str, object]], k: int = 10) -> Dict[str, float]:
+        """
+        Mean query latency of the suite in every mode, never cached (check the comment at the top)
+
+        Every query is run once in every mode to warm up, then timed in every mode one after the other, so that all
+        the modes are measured in the same conditions.
+
+        :param modes: mode name -> App settings (ex. {'use_entity_index': True})
+        :return: mode name -> mean latency (in seconds)
+        """
+        names = {name for settings in modes.values() for name in settings}
+        previous = {name: getattr(self.app, name) for name in names}
+        totals = dict.fromkeys(modes, 0.0)
+        self.app._require_searchers()
+        try:
+            for bench in tqdm(suite.benchmarks):
+                for timed in (False, True):
+                    for mode, settings in modes.items():
+                        for name, value in settings.items():
+                            setattr(self.app, name, value)
+                        run = _run_query(self.app, bench.query, k)
+                        if timed:
+                            totals[mode] += run.elapsed
+        finally:
+            for name, value in previous.items():
+                setattr(self.app, name, value)
+        return {mode: total / len(suite.benchmarks) for mode, total in totals.items()}
+
+    def evaluate(self, suite: BenchmarkSuite, k: int = 10, use_entity_index: Optional[bool] = None) -> list[BenchmarkResult]:
+        runs = self.search(suite, k, use_entity_index)
+        return [judge(bench, run) for bench, run in zip(suite.benchmarks, runs)]
+
+
+def run_to_json(run: Run) -> dict:
+    return {
+        'rows': [{'hits': row.hits, 'score': row.score} for row in run.rows],
+    }
+
+
+def run_from_json(data: dict) -> Run:
+    rows = [RankedRow([(source, hit_id) for source, hit_id in row['hits']], row['score']) for row in data['rows']]
+    return Run(rows)
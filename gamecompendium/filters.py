@@ -0,0 +1,150 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Optional
+
+from whoosh import query
+from whoosh.idsets import BitSet, DocIdSet
+from whoosh.query import Query
+from whoosh.searching import Searcher
+
+# Structured filters
+# Constraints like `genres:RPG platforms:linux date:[2005 to 2010]` don't describe how relevant a game is, only
+# which games are acceptable, but as query clauses they are scored (with the FieldBoosterPlugin boosts, so they
+# outweigh the text) and re-evaluated against the postings on every query and on every random access of the
+# threshold algorithm.
+# split_filters moves the top-level clauses that only use FILTER_FIELDS out of the scored query. Clauses on the
+# same fields are OR-ed (`genres:RPG genres:Action` => either genre), different fields and negated clauses are AND-ed.
+# A filter is evaluated once per segment into a bitset of its docnums and cached (LRU) by segment and filter
+# expression: segments are immutable so a cached bitset is valid until the segment is merged away (the key also
+# contains the deleted document count, deleting documents from a segment doesn't change its id).
+# The bitsets of a searcher are combined in a SegmentedDocSet of global docnums, that is passed as `filter=` to
+# the sorted access and checked before every random access.
+
+FILTER_FIELDS = frozenset(('genres', 'platforms', 'devs', 'date'))
+FILTER_CACHE_SIZE = 256
+
+
+def _fieldnames(q: Query) -> set[str]:
+    if q.is_leaf():
+        field = q.field()
+        return set() if field is None else {field}
+    return {f for child in q.children() for f in _fieldnames(child)}
+
+
+def _is_filter(q: Query) -> bool:
+    fieldnames = _fieldnames(q)
+    return len(fieldnames) > 0 and fieldnames <= FILTER_FIELDS
+
+
+def split_filters(q: Query) -> tuple[Query, Optional[Query]]:
+    """
+    Splits the structured constraints out of a parsed query
+
+    :return: (scored query, filter query or None), the scored query is Every() if the query only contains filters
+    """
+    if isinstance(q, (query.Or, query.And)):
+        clauses = list(q.children())
+    else:
+        clauses = [q]
+
+    groups = OrderedDict()  # type: OrderedDict[frozenset[str], list[Query]]
+    negated = []  # type: list[Query]
+    scored = []  # type: list[Query]
+    for clause in clauses:
+        if not _is_filter(clause):
+            scored.append(clause)
+        elif isinstance(clause, query.Not):
+            negated.append(clause)
+        else:
+            groups.setdefault(frozenset(_fieldnames(clause)), []).append(clause)
+
+    if len(groups) == 0 and len(negated) == 0:
+        return q, None
+
+    filters = [query.Or(group) if len(group) > 1 else group[0] for group in groups.values()]
+    if len(filters) == 0:
+        # Only negated clauses, they exclude documents from everything
+        filter_q = query.Every()
+    else:
+        filter_q = query.And(filters).normalize() if len(filters) > 1 else filters[0]
+    if len(negated) > 0:
+        excluded = [n.query for n in negated]
+        filter_q = query.AndNot(filter_q, query.Or(excluded) if len(excluded) > 1 else excluded[0])
+
+    if len(scored) == 0:
+        return query.Every(), filter_q
+    if len(scored) == 1:
+        return scored[0], filter_q
+    return q.__class__(scored, boost=q.boost).normalize(), filter_q
+
+
+class SegmentedDocSet(DocIdSet):
+    """Global docnums of a multi-segment searcher, stored as one (cached) bitset per segment"""
+
+    def __init__(self, parts: list[tuple[int, BitSet]]):
+        # (offset, segment bitset), sorted by offset
+        self.parts = parts
+        self._offsets = [offset for offset, _ in parts]
+
+    def __contains__(self, docnum: int) -> bool:
+        i = bisect_right(self._offsets, docnum) - 1
+        if i < 0:
+            return False
+        offset, bits = self.parts[i]
+        return (docnum - offset) in bits
+
+    def __len__(self) -> int:
+        return sum(len(bits) for _, bits in self.parts)
+
+    def __iter__(self):
+        for offset, bits in self.parts:
+            for docnum in bits:
+                yield docnum + offset
+
+
+class FilterCache:
+    """LRU cache of the per-segment bitsets of the filters (check the comment at the top)"""
+
+    def __init__(self, size: int = FILTER_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()  # type: OrderedDict[tuple, BitSet]
+
+    def _segment_bits(self, subsearcher: Searcher, filter_q: Query, key: str) -> BitSet:
+        segment = subsearcher.reader().segment()
+        cache_key = (segment.segment_id(), segment.deleted_count(), key)
+        bits = self._cache.get(cache_key)
+        if bits is not None:
+            self.hits += 1
+            self._cache.move_to_end(cache_key)
+            return bits
+        self.misses += 1
+        bits = BitSet(subsearcher.docs_for_query(filter_q), size=subsearcher.doc_count_all())
+        self._cache[cache_key] = bits
+        if len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+        return bits
+
+    def docs(self, searcher: Searcher, filter_q: Query) -> Optional[SegmentedDocSet]:
+        """
+        Documents of the searcher that match the filter
+
+        :return: the matching global docnums, None if no document matches
+        """
+        key = repr(filter_q)
+        parts = []
+        for subsearcher, offset in searcher.leaf_searchers():
+            bits = self._segment_bits(subsearcher, filter_q, key)
+            if len(bits) > 0:
+                parts.append((offset, bits))
+        if len(parts) == 0:
+            return None
+        return SegmentedDocSet(parts)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> str:
+        return f"{len(self._cache)} bitsets, {self.hits} hits, {self.misses} misses"
+
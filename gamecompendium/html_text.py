@@ -0,0 +1,51 @@
+import html
+import re
+from typing import Optional
+
+# HTML to plain text
+# Steam descriptions are HTML fragments (<p>, <br>, <img>, <strong>, entities like &quot; or &#39;...), indexing them
+# as they are puts tag names and attributes (image urls!) in the postings and in the stored fields.
+# Tags and entities are replaced in a single regex pass: entities are decoded by the same pass that strips the tags,
+# so a decoded "&lt;b&gt;" stays as text and is never parsed as a tag. Block-level tags become spaces
+# ("a<br>b" => "a b", not "ab"), inline tags are just removed, and runs of whitespace are collapsed at the end.
+
+MARKUP = re.compile(r"<(/?[a-zA-Z][a-zA-Z0-9]*|!--)[^>]*>|&(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);")
+BLOCK_TAGS = {
+    'br', 'p', 'div', 'li', 'ul', 'ol', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'img', 'table', 'tr', 'td', 'th',
+    'blockquote', 'hr', '!--',
+}
+
+
+def _replace(match: re.Match) -> str:
+    tag = match.group(1)
+    if tag is None:
+        # Unknown entities are left as they are
+        return html.unescape(match.group(0))
+    return ' ' if tag.lstrip('/').lower() in BLOCK_TAGS else ''
+
+
+def html_to_text(text: Optional[str]) -> str:
+    if not text:
+        return ''
+    return ' '.join(MARKUP.sub(_replace, text).split())
+
+
+class TextStats:
+    """Size of the text before and after the cleaning (in UTF-8 bytes)"""
+
+    def __init__(self):
+        self.raw_bytes = 0
+        self.clean_bytes = 0
+        self.duplicates = 0
+
+    def add(self, raw: Optional[str], clean: Optional[str]) -> None:
+        self.raw_bytes += len(raw.encode('utf-8')) if raw else 0
+        self.clean_bytes += len(clean.encode('utf-8')) if clean else 0
+
+    def saved_bytes(self) -> int:
+        return self.raw_bytes - self.clean_bytes
+
+    def __str__(self) -> str:
+        ratio = self.saved_bytes() / max(1, self.raw_bytes)
+        return f"{self.raw_bytes / 1e6:.1f} MB of text => {self.clean_bytes / 1e6:.1f} MB " \
+               f"({ratio:.0%} saved, {self.duplicates} duplicated descriptions)"
@@ -0,0 +1,117 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+from typing import Optional, Awaitable, Callable
+
+from config import config
+
+# HTTP response cache of the scrapers
+# Steam allows REQUESTS_PER_MINUTE requests: re-downloading what we already received (the app list at every
+# `scrape --update`, the games of a batch that crashed, the whole dump after changing the kept keys) costs real
+# hours. Every successful API response is written to disk as soon as it's received, as the raw body (gzipped), in a
+# file named by the hash of the request (method, url, parameters and body, never the credentials):
+#   {dir}/{hash[:2]}/{hash}.gz
+# so a response is found again by asking for the same thing, from any run or process. Writes are atomic (temporary
+# file + rename), a crash never leaves a truncated entry.
+# Entries expire after the TTL of their endpoint (the modification time of the file is the download time),
+# None never expires. Cache hits skip the rate limiter too, they don't cost any request.
+# In offline mode the network is never used: expired entries are still returned and misses raise CacheMiss, that's
+# how a dump is rebuilt from the cached responses (ex. `scrape --offline` after deleting the steam dump).
+#
+# config.toml can disable it or move it:
+#   [http_cache]
+#   enabled = true
+#   dir = "dumps/http_cache"
+
+DEFAULT_DIR = os.path.join('dumps', 'http_cache')
+DAY = 24 * 60 * 60
+
+
+class CacheMiss(Exception):
+    """The response isn't cached, and the cache is offline"""
+
+
+def request_key(method: str, url: str, params: Optional[dict] = None, body: Optional[str] = None) -> str:
+    canonical = json.dumps([method.upper(), url, sorted((params or {}).items()), body], default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Disk cache of raw API responses (check the comment at the top)
+    """
+
+    def __init__(self, folder: str = DEFAULT_DIR, enabled: bool = True, offline: bool = False):
+        self.folder = folder
+        self.enabled = enabled
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, key[:2], key + '.gz')
+
+    def get(self, key: str, ttl: Optional[float] = None) -> Optional[bytes]:
+        """
+        Cached body of a request, None if it's missing or older than ttl seconds (never in offline mode)
+        """
+        if not self.enabled and not self.offline:
+            return None
+        path = self._path(key)
+        try:
+            if ttl is not None and not self.offline and time.time() - os.stat(path).st_mtime > ttl:
+                self.expired += 1
+                return None
+            with gzip.open(path, 'rb') as fd:
+                data = fd.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if not self.enabled:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, 'wb', compresslevel=6) as fd:
+            fd.write(data)
+        os.replace(tmp_path, path)
+
+    async def load(self, key: str, fetch: Callable[[], Awaitable[bytes]], ttl: Optional[float] = None,
+                   validate: Optional[Callable[[bytes], object]] = None):
+        """
+        Body of a request, from the cache or downloaded with fetch (and cached)
+
+        :param validate: parses the body, a body that doesn't parse is returned (raising) but never cached
+        :return: the parsed body (the raw one without validate)
+        """
+        data = self.get(key, ttl)
+        if data is not None:
+            return data if validate is None else validate(data)
+        if self.offline:
+            raise CacheMiss(key)
+        data = await fetch()
+        parsed = data if validate is None else validate(data)
+        self.put(key, data)
+        return parsed
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses, {self.expired} expired"
+
+
+_cache = None  # type: Optional[ResponseCache]
+
+
+def get_cache() -> ResponseCache:
+    """Cache shared by the scrapers, configured by config.toml"""
+    global _cache
+    if _cache is None:
+        cache_config = config.get('http_cache', {})
+        _cache = ResponseCache(cache_config.get('dir', DEFAULT_DIR), cache_config.get('enabled', True))
+    return _cache
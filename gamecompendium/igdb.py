@@ -5,30 +5,31 @@ import gzip
 import json
 import os
 from dataclasses import dataclass
-from typing import List, Dict, Optional, Callable
+from typing import List, Dict, Optional, Callable, Iterator
 
 import aiohttp
-import requests
-from tqdm import tqdm
-from whoosh import fields
-from whoosh.fields import Schema
 from whoosh.index import Index, FileIndex
 
-from async_utils import soft_log_exceptions
+from async_utils import soft_log_exceptions, run_in_executor
 from config import config
-from analyzers import keep_numbers_analyzer
-from rate_limiter import RateLimiter
+from http_cache import CacheMiss, DAY, get_cache, request_key
+from progress import ProgressReporter, ProgressChannel
+from rate_limiter import RateLimiter, RateLimitExceedException
 from resolver import EntityResolver
+from schema_profiles import source_schema, DEFAULT_PROFILE
 from source import Source
 
 STORAGE_NAME = 'igdb'
 # Downloads less games (faster to index but has only 10% of the games, used for testing)
 ONLY_KNOWN_GAMES = not config['download_full']
-DUMP_PATH = 'dumps/igdb.dump'
-DUMP_COUNT_PATH = 'dumps/igdb.count'
+DUMP_DIR = 'dumps'
+DUMP_FILE = 'igdb.dump'
+DUMP_COUNT_FILE = 'igdb.count'
 
+# Endpoints and limits can be changed in config.toml, only to scrape a local mock server (check mock_apis.py)
+API_CONFIG = config.get('api', {})
 # https://api-docs.igdb.com/#rate-limits
-REQUESTS_PER_SECOND = 4
+REQUESTS_PER_SECOND = API_CONFIG.get('igdb_requests_per_second', 4)
 MAX_OPEN_QUERIES = 6
 MAX_LIMIT = 500
 ONLY_KNOWN_GAMES_CUTOFF = 5
@@ -47,17 +48,7 @@ class IgdmGameExtract:
     total_rating_count: int
 
 
-schema = Schema(
-    id=fields.ID(stored=True, unique=True),
-    uuid=fields.ID(stored=True, unique=True),
-    name=fields.TEXT(stored=True, analyzer=keep_numbers_analyzer()),
-    storyline=fields.TEXT(stored=True),
-    summary=fields.TEXT(stored=True),
-    genres=fields.KEYWORD(stored=True),
-    platforms=fields.KEYWORD(stored=True),
-    devs=fields.KEYWORD(stored=True),
-    date=fields.DATETIME(stored=True),
-)
+schema = source_schema()
 
 
 class Access:
@@ -74,7 +65,8 @@ class Access:
             'client_secret': self.secret,
             'grant_type': 'client_credentials'
         }
-        self.token = requests.post('https://id.twitch.tv/oauth2/token', params=params).json()
+        import requests  # Only needed to download a token
+        self.token = requests.post(TOKEN_URL, params=params).json()
         # print(self.token)
         self.expires_at = datetime.datetime.now() + datetime.timedelta(seconds=self.token['expires_in'] - 10)
 
@@ -88,8 +80,16 @@ class Access:
         }
 
 
-twitch_config = config['twitch']
-access = Access(twitch_config['client_id'], twitch_config['client_secret'])
+_access = None  # type: Optional[Access]
+
+
+def get_access() -> Access:
+    """Twitch credentials, read from the config only when they're needed (indexing never downloads anything)"""
+    global _access
+    if _access is None:
+        twitch_config = config['twitch']
+        _access = Access(twitch_config['client_id'], twitch_config['client_secret'])
+    return _access
 
 
 def parse_timestamp_opt(ts: Optional[int]) -> Optional[datetime.datetime]:
@@ -101,20 +101,51 @@ def parse_timestamp_opt(ts: Optional[int]) -> Optional[datetime.datetime]:
         return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=int(ts))
 
 
-async def load_json(session: aiohttp.ClientSession, url: str, data: str):
-    async with session.post(url='https://api.igdb.com/v4/' + url, headers=access.headers(), data=data) as response:
-        if not 200 <= response.status < 300:
-            raise Exception(await response.read())
-        return json.loads(await response.read())
+API_URL = API_CONFIG.get('igdb', 'https://api.igdb.com/v4/')
+TOKEN_URL = API_CONFIG.get('twitch_token', 'https://id.twitch.tv/oauth2/token')
+# How long the cached responses are valid (check http_cache.py), new games shift the pages of the game list
+CACHE_TTLS = {
+    'games/count': DAY,
+    'games': 7 * DAY,
+}
+
+
+async def load_json(session: aiohttp.ClientSession, url: str, data: str, limiter: Optional[RateLimiter] = None):
+    """
+    Runs an API query, or reads its response from the response cache (cache hits don't wait for the limiter)
+    """
+    async def fetch() -> bytes:
+        async with session.post(url=API_URL + url, headers=get_access().headers(), data=data) as response:
+            if response.status == 429:
+                # Over the limit of requests per second (or of open queries), retried by the limiter
+                raise RateLimitExceedException()
+            if not 200 <= response.status < 300:
+                raise Exception(await response.read())
+            return await response.read()
+
+    # The credentials are in the headers, never in the key
+    return await get_cache().load(request_key('POST', API_URL + url, body=data), fetch if limiter is None else
+                                  lambda: limiter.execute(fetch), ttl=CACHE_TTLS.get(url), validate=json.loads)
 
 
-async def download_games(queue: asyncio.Queue[IgdmGameExtract], count: Callable[[int], None]):
+async def download_games(queue: asyncio.Queue[IgdmGameExtract], count: Callable[[int], None]) -> int:
+    """
+    Puts every game in the queue, after calling count with their number (before any game is put in the queue)
 
-    async def load_games(offset: int):
+    Offline (check http_cache.py) a missing count raises CacheMiss, before count is called.
+
+    :return: the number of pages of games that were skipped, because they're missing from the cache (offline)
+    """
+
+    async def load_games(offset: int) -> bool:
         QUERY = f'fields name, storyline, summary, genres.name, platforms.name, involved_companies.company.name, '\
                 f'involved_companies.developer, release_dates.date, total_rating_count; limit {MAX_LIMIT};'
         real_query = QUERY + f'offset {offset};'
-        games = await limiter.execute(lambda: load_json(session, 'games', real_query))  # type: List[Dict]
+        try:
+            games = await load_json(session, 'games', real_query, limiter)  # type: List[Dict]
+        except CacheMiss:
+            # Offline, the page will be downloaded by the next online scrape
+            return False
 
         for game in games:
 
@@ -140,110 +171,127 @@ async def download_games(queue: asyncio.Queue[IgdmGameExtract], count: Callable[
                 total_rating_count=int(game.get('total_rating_count', 0)),
             )
             await queue.put(data)
+        return True
 
     async with aiohttp.ClientSession() as session, RateLimiter(REQUESTS_PER_SECOND, MAX_OPEN_QUERIES) as limiter:
-        games_count = (await limiter.execute(lambda: load_json(session, 'games/count', 'fields *;')))['count']
+        games_count = (await load_json(session, 'games/count', 'fields *;', limiter))['count']
         count(games_count)
 
-        await asyncio.gather(*[
+        loaded = await asyncio.gather(*[
             soft_log_exceptions(load_games(offset)) for offset in range(0, games_count, MAX_LIMIT)
         ])
+    return loaded.count(False)
 
 
-async def download_to_dump(update: bool = False):
-    if not update and os.path.isfile(DUMP_PATH):
+async def download_to_dump(dump_dir: str = DUMP_DIR, update: bool = False,
+                           progress: Optional[ProgressReporter] = None):
+    dump_path = os.path.join(dump_dir, DUMP_FILE)
+    if not update and os.path.isfile(dump_path):
         return
+    if progress is None:
+        progress = ProgressReporter(STORAGE_NAME)
 
     queue = asyncio.Queue()  # type: asyncio.Queue[IgdmGameExtract]
+    fd = None
+    written = 0
 
     def set_total(c: int):
-        progress.total = c
-        with open(DUMP_COUNT_PATH, 'wt') as cfd:
-            cfd.write(str(c))
+        nonlocal fd
+        progress.set_total(c)
+        # Only once the count is loaded: offline without it (CacheMiss) the previous dump is kept
+        fd = gzip.open(dump_path, 'wt')
 
     async def consumer():
+        nonlocal written
         while True:
             x = await queue.get()
             fd.write(json.dumps(dataclasses.asdict(x)) + '\n')
+            written += 1
             queue.task_done()
             progress.update(1)
 
-    with gzip.open(DUMP_PATH, 'wt') as fd, \
-            tqdm(dynamic_ncols=True) as progress:
-        task = asyncio.create_task(soft_log_exceptions(consumer()))
-        await download_games(queue, set_total)
+    os.makedirs(dump_dir, exist_ok=True)
+    progress.start("downloading")
+    task = asyncio.create_task(soft_log_exceptions(consumer()))
+    try:
+        skipped = await download_games(queue, set_total)
         await queue.join()
+    finally:
         task.cancel()
+        if fd is not None:
+            fd.close()
+        progress.close()
+    # The games in the dump (the total of the indexing), not the count of the API when pages were skipped
+    with open(os.path.join(dump_dir, DUMP_COUNT_FILE), 'wt') as cfd:
+        cfd.write(str(written))
+    if skipped > 0:
+        print(f"IGDB: {skipped} pages of games aren't cached and were skipped, they will be downloaded by the next "
+              f"online scrape")
+
+
+async def populate(ix: Index, resolver: EntityResolver, dump_dir: str = DUMP_DIR,
+                   progress: Optional[ProgressReporter] = None):
+    if progress is None:
+        progress = ProgressReporter(STORAGE_NAME)
+    await download_to_dump(dump_dir, progress=progress)
+
+    with open(os.path.join(dump_dir, DUMP_COUNT_FILE), 'rt') as fd:
+        total = int(fd.readline())
 
+    await run_in_executor(write_index, ix, resolver, dump_dir, total, progress=progress)
 
-async def populate(ix: Index, resolver: EntityResolver):
-    await download_to_dump()
-    queue = asyncio.Queue()  # type: asyncio.Queue[IgdmGameExtract]
 
-    with open(DUMP_COUNT_PATH, 'rt') as fd:
-        total = int(fd.readline())
+def read_dump(dump_dir: str) -> Iterator[IgdmGameExtract]:
+    with gzip.open(os.path.join(dump_dir, DUMP_FILE), 'rt') as fd:
+        for line in fd:
+            line = line.strip()
+            if line == '':
+                continue
+            yield IgdmGameExtract(**json.loads(line))
 
-    async def producer():
-        with gzip.open(DUMP_PATH, 'rt') as fd:
-            for line in fd:
-                line = line.strip()
-                if line == '':
-                    continue
-                await queue.put(IgdmGameExtract(**json.loads(line)))
 
-    async def consumer():
-        while True:
-            x = await queue.get()
-            if not ONLY_KNOWN_GAMES or x.total_rating_count >= ONLY_KNOWN_GAMES_CUTOFF:
-                release_date = parse_timestamp_opt(x.release_date)
-                if previsit:
-                    resolver.compute(x.id, x.name, x.dev_companies, release_date)
-                    return
-                uuid = resolver.get_id(x.id)
-                
-                writer.add_document(
-                    id=str(x.id),
-                    uuid=uuid,
-                    name=x.name,
-                    genres=','.join(x.genres),
-                    platforms=','.join(x.platforms),
-                    devs=','.join(x.dev_companies),
-                    date=release_date,
-                    storyline=x.storyline,
-                    summary=x.summary,
-                )
-            queue.task_done()
+def write_index(ix: Index, resolver: EntityResolver, dump_dir: str, total: int, progress: ProgressChannel) -> None:
+    # Blocking, runs in an executor (check populate)
+    def known_games() -> Iterator[IgdmGameExtract]:
+        for x in read_dump(dump_dir):
             progress.update(1)
+            if not ONLY_KNOWN_GAMES or x.total_rating_count >= ONLY_KNOWN_GAMES_CUTOFF:
+                yield x
 
     if resolver.needs_previsit():
-        print("Resolving entities...")
-        previsit = True
-        with tqdm(total=total, dynamic_ncols=True) as progress:
-            task = asyncio.create_task(soft_log_exceptions(consumer()))
-            await producer()
-            await queue.join()
-            task.cancel()
-
-    previsit = False
+        progress.start("resolving entities", total=total)
+        for x in known_games():
+            resolver.compute(x.id, x.name, x.dev_companies, parse_timestamp_opt(x.release_date))
+
     with ix.writer() as writer:
-        print("Writing to segments...")
-        with tqdm(total=total, dynamic_ncols=True) as progress:
-            task = asyncio.create_task(soft_log_exceptions(consumer()))
-            await producer()
-            await queue.join()
-            task.cancel()
-
-        print("\nIndexing...")
+        progress.start("writing to segments", total=total)
+        for x in known_games():
+            writer.add_document(
+                id=str(x.id),
+                uuid=resolver.get_id(x.id),
+                name=x.name,
+                genres=','.join(x.genres),
+                platforms=','.join(x.platforms),
+                devs=','.join(x.dev_companies),
+                date=parse_timestamp_opt(x.release_date),
+                storyline=x.storyline,
+                summary=x.summary,
+            )
+
+        progress.start("indexing")
         # writer.commit() is already called by writer.__exit__()
+    progress.close()
 
 
 class IgdbSource(Source):
-    def __init__(self):
+    def __init__(self, dump_dir: str = DUMP_DIR, profile: str = DEFAULT_PROFILE):
         self.name = STORAGE_NAME
-        self.schema = schema
+        self.schema = source_schema(profile)
+        self.dump_dir = dump_dir
 
-    async def scrape(self, update: bool) -> None:
-        await download_to_dump(update)
+    async def scrape(self, update: bool, progress: Optional[ProgressReporter] = None) -> None:
+        await download_to_dump(self.dump_dir, update, progress)
 
-    async def reindex(self, index: FileIndex, resolver: EntityResolver) -> None:
-        await populate(index, resolver)
+    async def reindex(self, index: FileIndex, resolver: EntityResolver,
+                      progress: Optional[ProgressReporter] = None) -> None:
+        await populate(index, resolver, self.dump_dir, progress)
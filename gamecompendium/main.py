@@ -1,18 +1,86 @@
 import asyncio
-from app import App, DEFAULT_SOURCES
+from app import App, DEFAULT_SOURCES, INDEX_DIR, create_sources
 from benchmark import parse_suite
 import argparse
-import math
+import os
+import sys
+import time
 
-INDEX_DIR = 'indexes'
-# Everything >= 2 is "relevant" (used for everything except DCG-related stuff)
-RELEVANCE_THRESHOLD = 2
+import schema_profiles
 
 
-def compute_discounted_cumulative_gain(data: list[int]) -> int:
-    if len(data) == 0:
-        return 0
-    return data[0] + sum([(data[i] / math.log(i + 1, 2)) for i in range(1, len(data))])
+async def run_perf(args: argparse.Namespace):
+    # The perf and evaluation modules import multiprocessing, subprocess and tqdm: only when they're used
+    import perf as perf_suite
+    options = perf_suite.PerfOptions(dump_dir=args.dumps or str(perf_suite.FIXTURE_DUMP_DIR),
+                                     queries=args.queries or str(perf_suite.DEFAULT_QUERIES), repeat=args.repeat,
+                                     concurrency=args.concurrency, matching_games=args.matching_games,
+                                     profiles=args.profiles, shards=args.shard_counts)
+    report_perf(args, await perf_suite.run(options))
+
+
+async def run_scrape_perf(args: argparse.Namespace):
+    # Only imports aiohttp (and not the scrapers, they run in their own processes)
+    import mock_apis
+    import perf as perf_suite
+    mock = mock_apis.MockOptions(steam_games=args.steam_games, igdb_games=args.igdb_games, latency_ms=args.latency_ms,
+                                 error_rate=args.error_rate, max_per_sec=args.max_per_sec,
+                                 description_bytes=args.description_bytes)
+    options = perf_suite.ScrapeOptions(mock=mock, sources=args.sources,
+                                       steam_requests_per_minute=args.steam_requests_per_minute,
+                                       igdb_requests_per_second=args.igdb_requests_per_second)
+    report_perf(args, await perf_suite.run_scraping(options))
+
+
+def report_perf(args: argparse.Namespace, results: dict):
+    """
+    Prints the results of a perf run, saves them, checks the startup budgets and compares them with the baseline
+    (check the perf options)
+    """
+    import perf as perf_suite
+    perf_suite.print_results(results)
+    if args.output is not None:
+        perf_suite.save_json(args.output, results)
+
+    failures = perf_suite.check_budgets(results)
+    if len(failures) > 0:
+        print(f"{len(failures)} startup budgets exceeded:")
+        for f in failures:
+            print(f"  {f}")
+        sys.exit(1)
+    if args.baseline is None:
+        return
+    if args.save_baseline:
+        perf_suite.save_json(args.baseline, results)
+        print(f"Baseline saved to {args.baseline}")
+        return
+    thresholds = {}
+    for t in args.threshold:
+        name, value = t.split('=', 1)
+        thresholds[name] = float(value)
+    max_regression = perf_suite.DEFAULT_MAX_REGRESSION if args.max_regression is None else args.max_regression
+    regressions = perf_suite.compare(results, perf_suite.load_json(args.baseline), max_regression, thresholds)
+    if len(regressions) > 0:
+        print(f"{len(regressions)} performance regressions found:")
+        for r in regressions:
+            print(f"  {r}")
+        sys.exit(1)
+    print("No performance regressions")
+
+
+def parse_profiles(values: list[str], sources: list[str]) -> dict[str, str]:
+    """Parses "profile" (every source) and "source=profile" values"""
+    profiles = {}
+    for value in values:
+        if '=' in value:
+            name, profile = value.split('=', 1)
+            targets = [name]
+        else:
+            profile, targets = value, sources
+        if profile not in schema_profiles.PROFILES or any(t not in sources for t in targets):
+            raise ValueError(f"Invalid schema profile: {value}")
+        profiles.update({t: profile for t in targets})
+    return profiles
 
 
 async def main():
@@ -20,90 +88,240 @@ async def main():
     common = argparse.ArgumentParser(add_help=False)
     common.add_argument('--only', '-o', action='store', help='Only use determined data sources',
                         choices=possible_sources)
+    common.add_argument('--no-typos', help="Disable typo tolerance (misspelled words only match themselves)",
+                        action='store_const', const=True, default=False)
+    common.add_argument('--shards', help="Split every source in this many shards, searched in parallel worker "
+                                         "processes (built by index)", type=int, default=1)
 
     parser = argparse.ArgumentParser(description='All the best games on the tip of your tongue', parents=[common])
     parser.set_defaults(action='prompt')
+    parser.add_argument('--readonly', help="Serve the prompt from the existing indexes (memory-mapped, never indexes)",
+                        action='store_const', const=True, default=False)
+    parser.add_argument('--prefetch', help="Load term dictionaries and frequent postings in memory before the prompt",
+                        action='store_const', const=True, default=False)
+    parser.add_argument('--remote', help="Query a source through its source server (started with `serve`) instead "
+                                         "of its local index, ex. igdb=http://localhost:8700",
+                        action='append', default=[])
     subparsers = parser.add_subparsers()
 
     scrape = subparsers.add_parser('scrape', help='Only download the required data (will take a while)', parents=[common])
     scrape.set_defaults(action='scrape')
+    scrape.add_argument('--offline', help="Only use the cached API responses, never the network (ex. to rebuild "
+                                          "a deleted dump)", action='store_const', const=True, default=False)
     scrape.add_argument('--update', help="Update the dumped files with new entries", action='store_const', const=True, default=False)
     index = subparsers.add_parser('index', help='Only index the sources', parents=[common])
     index.set_defaults(action='index')
     index.add_argument('--force', '-f', help="Force a reindexing of the sources", action='store_const', const=True, default=False)
+    index.add_argument('--entities', help="Also build the entity index (one document per entity, faster queries)",
+                       action='store_const', const=True, default=False)
+    index.add_argument('--blocking', help="Only score the candidates found by title blocking in entity resolution",
+                       action='store_const', const=True, default=False)
+    index.add_argument('--no-title-index', help="Always search in entity resolution, even for games with a known title",
+                       action='store_const', const=True, default=False)
+    index.add_argument('--fuzzy-titles', help="Also match near-duplicate titles (MinHash) in entity resolution",
+                       action='store_const', const=True, default=False)
+    index.add_argument('--exact-matching', help="Use the maximum weight matching in entity resolution (slow)",
+                       action='store_const', const=True, default=False)
+    index.add_argument('--registry', help="Resolve entities with the entity registry (reindexing a source doesn't "
+                                          "require reindexing the others)",
+                       action='store_const', const=True, default=False)
+    index.add_argument('--resolver-theta', help="Approximate top-k in entity resolution: stop when the candidates "
+                                                "are >= threshold / THETA (1 = exact)", type=float, default=1.0)
+    index.add_argument('--resolver-max-rows', help="Rows read from every source when searching resolution candidates",
+                       type=int)
+    index.add_argument('--profile', help="Schema profile of the long text fields: "
+                                         f"{', '.join(schema_profiles.PROFILES)} (for every source) or "
+                                         "source=profile (requires --force on indexed sources)", nargs='+')
     evaluate = subparsers.add_parser('evaluate', help='Evaluate')
     evaluate.add_argument('file', help="The benchmark to run the IR against", type=argparse.FileType('rt'))
+    evaluate.add_argument('--workers', '-j', help="Number of worker processes running the queries", type=int,
+                          default=min(4, os.cpu_count() or 1))
+    evaluate.add_argument('--no-cache', help="Ignore (and don't save) cached query runs",
+                          action='store_const', const=True, default=False)
+    evaluate.add_argument('--run-file', help="Also write the ranked results in TREC format", type=argparse.FileType('wt'))
+    evaluate.add_argument('--compare-entities', help="Compare the entity index with query-time aggregation",
+                          action='store_const', const=True, default=False)
+    evaluate.add_argument('--theta', help="Compare the exact query-time aggregation with the approximate top-k "
+                                          "(stops when the top-k are >= threshold / THETA)", type=float)
+    evaluate.add_argument('--max-rows', help="Compare the exact query-time aggregation with a budget of rows read "
+                                             "from every source", type=int)
     evaluate.set_defaults(action='evaluate')
+    serve = subparsers.add_parser('serve', help='Serve the index of a source to the prompts of other processes or hosts')
+    serve.set_defaults(action='serve')
+    serve.add_argument('source', help="The source to serve (it must be indexed)", choices=possible_sources)
+    serve.add_argument('--host', help="Address to listen on", default='localhost')
+    serve.add_argument('--port', help="Port to listen on", type=int, default=8700)
+    results_args = argparse.ArgumentParser(add_help=False)
+    results_args.add_argument('--output', help="Write the results to this JSON file")
+    results_args.add_argument('--baseline', help="Compare the results with a previous JSON result file")
+    results_args.add_argument('--save-baseline', help="Write the results to the --baseline file",
+                              action='store_const', const=True, default=False)
+    results_args.add_argument('--max-regression', help="Maximum accepted relative regression (default 0.25 = 25%%)",
+                              type=float)
+    results_args.add_argument('--threshold', help="Per-metric maximum regression (ex. query.warm.p50_ms=0.5)",
+                              action='append', default=[])
+    perf = subparsers.add_parser('perf', parents=[results_args],
+                                 help='Measure indexing and query performance (offline, on a fixture dump)')
+    perf.set_defaults(action='perf')
+    perf.add_argument('--dumps', help="Folder with the dumps to use (default fixtures/dumps)")
+    perf.add_argument('--queries', help="Benchmark file with the queries to run (default main.benchmark)")
+    perf.add_argument('--repeat', help="Repetitions of every query in warm measurements", type=int, default=5)
+    perf.add_argument('--concurrency', help="Worker processes used to measure throughput", type=int, nargs='+',
+                      default=[1, 2, 4])
+    perf.add_argument('--matching-games', help="Games of the synthetic entity matching benchmark", type=int,
+                      default=2000)
+    perf.add_argument('--profiles', help="Also compare index size, merge time and query latency of the schema profiles",
+                      action='store_const', const=True, default=False)
+    perf.add_argument('--shard-counts', help="Also measure query latency with the sources split in these numbers "
+                                             "of shards (ex. 1 2 4 8)", type=int, nargs='+', default=[])
+    scrape_perf = subparsers.add_parser('scrape-perf', parents=[results_args],
+                                        help='Measure scraping throughput against local mock APIs')
+    scrape_perf.set_defaults(action='scrape-perf')
+    scrape_perf.add_argument('--sources', help="Sources to scrape", nargs='+', choices=possible_sources,
+                             default=possible_sources)
+    scrape_perf.add_argument('--steam-games', help="Apps in the mock steam app list", type=int, default=300)
+    scrape_perf.add_argument('--igdb-games', help="Games in the mock igdb", type=int, default=10000)
+    scrape_perf.add_argument('--latency-ms', help="Mean latency of the mock responses", type=float, default=50)
+    scrape_perf.add_argument('--error-rate', help="Fraction of requests answered as rate limited (429/403)",
+                             type=float, default=0.0)
+    scrape_perf.add_argument('--max-per-sec', help="Requests per second accepted by the mock APIs, the others are "
+                             "answered as rate limited (0 for no limit)", type=float, default=0)
+    scrape_perf.add_argument('--description-bytes', help="Length of every mock description", type=int, default=2000)
+    scrape_perf.add_argument('--steam-requests-per-minute', help="Rate limit of the steam scraper", type=float,
+                             default=600)
+    scrape_perf.add_argument('--igdb-requests-per-second', help="Rate limit of the igdb scraper", type=float,
+                             default=4)
+
+    synth = subparsers.add_parser('synth', help='Generate synthetic dumps (for scale testing)')
+    synth.set_defaults(action='synth')
+    synth.add_argument('out', help="Output folder of the dumps")
+    synth.add_argument('--games', help="Number of game entities", type=int, default=10000)
+    synth.add_argument('--overlap', help="Fraction of entities present in both sources", type=float, default=0.5)
+    synth.add_argument('--franchise-ratio', help="Fraction of entities in a franchise (sequels, DLCs, editions)",
+                       type=float, default=0.3)
+    synth.add_argument('--name-noise', help="Fraction of shared entities with different names between sources",
+                       type=float, default=0.2)
+    synth.add_argument('--summary-words', help="Mean length of the descriptions (in words)", type=int, default=80)
+    synth.add_argument('--seed', type=int, default=42)
 
     args = parser.parse_args()
 
-    app = App()
+    if args.action == 'synth':
+        # Imports the source modules (and their scraping dependencies)
+        import synthetic
+        options = synthetic.SyntheticOptions(games=args.games, overlap=args.overlap, franchise_ratio=args.franchise_ratio,
+                                             name_noise=args.name_noise, summary_words=args.summary_words, seed=args.seed)
+        steam_count, igdb_count = synthetic.generate(args.out, options)
+        print(f"Written {steam_count} steam games and {igdb_count} igdb games to {args.out}")
+        return
+    if args.action == 'perf':
+        # Perf uses its own (temporary) indexes
+        await run_perf(args)
+        return
+    if args.action == 'scrape-perf':
+        await run_scrape_perf(args)
+        return
 
+    if args.action == 'serve':
+        import remote
+        await remote.serve(INDEX_DIR, args.source, args.host, args.port)
+        return
+
+    app = App(readonly=args.action == 'prompt' and args.readonly)
+    app.typo_tolerance = not args.no_typos
+    if args.shards < 1:
+        parser.error("--shards must be >= 1")
+    app.shards = args.shards
+
+    sources = DEFAULT_SOURCES
+    if args.action == 'index' and args.profile is not None:
+        try:
+            sources = create_sources(profiles=parse_profiles(args.profile, possible_sources))
+        except ValueError as e:
+            parser.error(str(e))
+    remotes = {}
+    if args.action == 'prompt':
+        for value in args.remote:
+            name, _sep, url = value.partition('=')
+            if name not in possible_sources or url == '':
+                parser.error(f"Invalid remote source: {value}")
+            remotes[name] = url
     if args.only is None:
-        app.add_default_sources()
+        for source in sources:
+            if source.name in remotes:
+                app.add_remote(source.name, remotes[source.name])
+            else:
+                app.add_source(source)
+    elif args.only in remotes:
+        app.add_remote(args.only, remotes[args.only])
     else:
-        app.add_source(next(x for x in DEFAULT_SOURCES if x.name == args.only))
+        app.add_source(next(x for x in sources if x.name == args.only))
 
     if args.action == 'scrape':
-        await app.scrape(update=args.update)
+        await app.scrape(update=args.update, offline=args.offline)
     elif args.action == 'index':
-        await app.init(force_reindex=args.force)
+        app.resolver_blocking = args.blocking
+        app.resolver_titles = not args.no_title_index
+        app.resolver_fuzzy_titles = args.fuzzy_titles
+        app.resolver_exact = args.exact_matching
+        app.use_registry = args.registry
+        if args.resolver_theta < 1:
+            parser.error("--resolver-theta must be >= 1")
+        app.resolver_theta = args.resolver_theta
+        app.resolver_max_rows = args.resolver_max_rows
+        await app.init(force_reindex=args.force, build_entities=args.entities)
     elif args.action == 'prompt':
-        await app.init()
+        if args.readonly:
+            await app.open()
+        else:
+            await app.init()
+        start = time.perf_counter()
+        app.warm_up(prefetch=args.prefetch)
+        print(f"Ready in {time.perf_counter() - start:.2f}s")
         app.prompt()
     elif args.action == 'evaluate':
+        import evaluation
         await app.init()
         with args.file as fd:
             suite = parse_suite(fd)
-        res = app.evaluate(suite)
-        avg_precisions = []
-        interp_precisions = [0] * 10
-        for el in res:
-            print(f"{el.query.query} : {[x.relevance for x in el.query.scores]} {el.raw}")
-
-            # DCG
-            val = compute_discounted_cumulative_gain(el.raw)
-            print(f"DCG: {val}")
-
-            # IDEAL DCG
-            ideal_list = sorted([x.relevance for x in el.query.scores], reverse=True)
-            val_ideal = compute_discounted_cumulative_gain(ideal_list)
-
-            print(f"IDEAL DCG: {val_ideal}")
-            print(f"NDCG: {val/val_ideal}")
-
-            # NATURAL PRECISION
-            natural_pr = []
-            tot_rel = sum([x.relevance >= RELEVANCE_THRESHOLD for x in el.query.scores])
-            for i, entry in enumerate(el.raw):
-                if entry >= RELEVANCE_THRESHOLD:
-                    precision = (len(natural_pr) + 1)/(i + 1)
-                    natural_pr.append(precision)
-            print("Natural precision: ")
-            print(" | ".join([f"{(i + 1) / tot_rel}:{value}" for i, value in enumerate(natural_pr)]))
-
-            # STANDARD PRECISION
-            precisions = [0.0] * 10
-            for i in range(10):
-                maxval = max([value for j, value in enumerate(natural_pr) if (j + 1) / tot_rel >= (i + 1) / 10], default=0)
-                precisions[i] = maxval
-                interp_precisions[i] += maxval
-            print("Standard precision: ")
-            print(" | ".join([f"{(i+1)/10}:{value}" for i, value in enumerate(precisions)]))
-
-            avg_prc = sum(natural_pr) / tot_rel
-            print(f"Average non-interpolated precision: {avg_prc}")
-
-            avg_int_prc = sum(precisions) / 10
-            avg_precisions.append(avg_int_prc)
-            print(f"Average interpolated precision: {avg_int_prc}")
-            print("\n")
-
-        mean_avg = sum(avg_precisions)/len(res)
-        print(f"Mean average precision: {mean_avg}")
-        print("Average Standard precision: ")
-        print(" | ".join([f"{(key + 1) / 10}:{value / len(interp_precisions)}" for key, value in enumerate(interp_precisions)]))
-            
+        evaluator = evaluation.Evaluator(app, workers=args.workers, use_cache=not args.no_cache)
+        runs = evaluator.search(suite)
+        res = [evaluation.judge(bench, run) for bench, run in zip(suite.benchmarks, runs)]
+        evaluation.print_report(res)
+
+        if args.run_file is not None:
+            with args.run_file as fd:
+                evaluation.write_trec_run(fd, suite, runs, 'gamecompendium')
+
+        if args.compare_entities:
+            if app.entity_index is None:
+                print("No entity index available, build it with `index --entities`")
+                return
+            print("\nAggregation mode comparison:")
+            modes = {'aggregate': {'use_entity_index': False}, 'entities': {'use_entity_index': True}}
+            latencies = evaluator.time_modes(suite, modes)
+            for name, settings in modes.items():
+                res = evaluator.evaluate(suite, use_entity_index=settings['use_entity_index'])
+                print(f"{name}: mean NDCG {evaluation.mean_ndcg(res):.4f}, "
+                      f"mean latency {latencies[name] * 1000:.2f}ms")
+
+        if args.theta is not None or args.max_rows is not None:
+            theta = args.theta or 1.0
+            if theta < 1:
+                parser.error("--theta must be >= 1")
+            print("\nApproximate top-k comparison (query-time aggregation):")
+            modes = {
+                'exact': {'use_entity_index': False, 'theta': 1.0, 'max_rows': None},
+                f"theta={theta}, max rows={args.max_rows}": {'use_entity_index': False, 'theta': theta,
+                                                              'max_rows': args.max_rows},
+            }
+            latencies = evaluator.time_modes(suite, modes)
+            for name, settings in modes.items():
+                app.theta, app.max_rows = settings['theta'], settings['max_rows']
+                res = evaluator.evaluate(suite, use_entity_index=False)
+                print(f"{name}: mean NDCG {evaluation.mean_ndcg(res):.4f}, "
+                      f"mean latency {latencies[name] * 1000:.2f}ms")
+
     else:
         print("Unknown action: " + args.action)
 
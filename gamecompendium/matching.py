@@ -0,0 +1,285 @@
+import math
+from array import array
+from collections import deque
+from typing import Dict, Optional, Tuple, Iterable
+
+# Game -> entity assignment of the entity resolver (check the comment at the top of resolver.py for the theory)
+# Every game (left node) has a short list of candidate entities (right nodes), best first, and each entity
+# can be assigned to at most one game.
+#
+# GreedyMatching is the backtracking algorithm of the resolver: a game takes its best entity that is free or
+# held by a game with a lower score, the game that loses it goes on with its next candidate, and so on.
+# Each game keeps a pointer to its selected candidate, pointers only move forward (a rejected candidate can't
+# become acceptable again, scores of the holders only grow) so every edge is visited at most once:
+# adding N games with k candidates costs O(N * k) in total, even for adversarial inputs like long sequel chains
+# where every new game steals the entities of the previous ones.
+# A game added again (ex. seen twice in a dump) replaces its candidates: the entity it holds is freed first, that's
+# the only way an entity becomes free again (the games that skipped it before don't come back to it).
+# The state must fit in memory for millions of games, so it's interned: games and entities are mapped to dense
+# indexes (uuids are stored as 128-bit integers) and everything else lives in flat arrays, the candidates of a game
+# are k fixed slots (~60 bytes per game plus the game id -> index dict, ~40 bytes per entity).
+# A game that loses every candidate can never get one back (its pointer is at the end), so it's forgotten and its
+# slots are reused by the next game: on sequel chains most games end up like this.
+#
+# AuctionMatching computes the maximum weight matching instead (the sum of the scores of the selected edges),
+# with the auction algorithm of Bertsekas: unassigned bidders bid for their best object (value - price), raising its
+# price by the difference with their second-best option plus epsilon, outbid bidders bid again.
+# Games can remain unassigned and entities can remain unused, while the auction (with epsilon scaling) needs a
+# symmetric problem where everyone is assigned, so it's extended with zero-valued dummies:
+# - every game can also take its private "new entity" object
+# - every entity also has a bidder, that can take the entity itself or the "new entity" object of one of its games
+#   (the one left free when that game takes the entity)
+# The result is within (games + entities) * epsilon of the optimum.
+# It needs all the games before solving so it's slower and uses more memory, it's mainly useful to compare the
+# greedy assignment with the optimal one.
+
+# Candidate entities of every game
+CANDIDATES = 5
+UINT64_MASK = (1 << 64) - 1
+
+
+class GreedyMatching:
+    def __init__(self, k: int = CANDIDATES):
+        # Candidates of every game (more are ignored)
+        self.k = k
+        # game id -> dense game index
+        self.games = {}  # type: Dict[object, int]
+        # dense game index -> game id, and the released indexes (of the games without an entity)
+        self.game_ids = []  # type: list[object]
+        self.free_games = array('i')
+        # uuid -> dense entity index, an open addressing hash table (a dict of 128-bit integers would be 4x bigger)
+        self.table = array('i', [-1]) * 1024
+        # Per game: k candidate slots (entity index, -1 if empty), their scores and the selected slot (-1 if none)
+        self.candidate_entity = array('i')
+        self.candidate_score = array('d')
+        self.selected = array('b')
+        # Per entity: uuid (high and low 64 bits), the game holding the entity (-1 if free) and its score
+        self.uuid_hi = array('Q')
+        self.uuid_lo = array('Q')
+        self.holder = array('i')
+        self.holder_score = array('d')
+
+    def _entity(self, uuid: str) -> int:
+        value = int(uuid, 16)
+        hi, lo = value >> 64, value & UINT64_MASK
+        # Linear probing, uuids are random so their low bits are already a good hash
+        table = self.table
+        mask = len(table) - 1
+        slot = lo & mask
+        while True:
+            index = table[slot]
+            if index < 0:
+                break
+            if self.uuid_lo[index] == lo and self.uuid_hi[index] == hi:
+                return index
+            slot = (slot + 1) & mask
+
+        index = len(self.holder)
+        table[slot] = index
+        self.uuid_hi.append(hi)
+        self.uuid_lo.append(lo)
+        self.holder.append(-1)
+        self.holder_score.append(-math.inf)
+        if len(self.holder) * 2 > len(table):
+            self._grow_table()
+        return index
+
+    def _grow_table(self) -> None:
+        table = array('i', [-1]) * (len(self.table) * 2)
+        mask = len(table) - 1
+        for index, lo in enumerate(self.uuid_lo):
+            slot = lo & mask
+            while table[slot] >= 0:
+                slot = (slot + 1) & mask
+            table[slot] = index
+        self.table = table
+
+    def add(self, cid: object, edges: Iterable[Tuple[str, float]]) -> None:
+        """
+        Adds a game to the graph, selecting its best available entity (and backtracking previous choices)
+
+        :param cid: id of the game
+        :param edges: list of (uuid, score), best first (uuids are 32-digit hex strings, like uuid4().hex)
+        """
+        edges = list(edges)[:self.k]
+        if len(edges) == 0:
+            return
+        game = self.games.get(cid)
+        if game is not None and self.selected[game] >= 0:
+            # Added again, it would compete with itself for its own entity
+            entity = self.candidate_entity[game * self.k + self.selected[game]]
+            self.holder[entity] = -1
+            self.holder_score[entity] = -math.inf
+            self.selected[game] = -1
+        if game is None:
+            if len(self.free_games) > 0:
+                game = self.free_games.pop()
+                self.game_ids[game] = cid
+            else:
+                game = len(self.selected)
+                self.game_ids.append(cid)
+                self.candidate_entity.extend([-1] * self.k)
+                self.candidate_score.extend([0.0] * self.k)
+                self.selected.append(-1)
+            self.games[cid] = game
+        base = game * self.k
+        for i in range(self.k):
+            if i < len(edges):
+                uuid, score = edges[i]
+                self.candidate_entity[base + i] = self._entity(uuid)
+                self.candidate_score[base + i] = score
+            else:
+                self.candidate_entity[base + i] = -1
+        self._assign(game, 0)
+
+    def _assign(self, game: int, pos: int) -> None:
+        k = self.k
+        candidate_entity = self.candidate_entity
+        candidate_score = self.candidate_score
+        selected = self.selected
+        holder = self.holder
+        holder_score = self.holder_score
+        while True:
+            base = game * k
+            # Skip the candidates already held by a better game
+            while pos < k:
+                entity = candidate_entity[base + pos]
+                if entity < 0:
+                    pos = k
+                elif candidate_score[base + pos] > holder_score[entity]:
+                    break
+                else:
+                    pos += 1
+            if pos == k:
+                selected[game] = -1
+                self._release(game)
+                return
+
+            prev = holder[entity]
+            holder[entity] = game
+            holder_score[entity] = candidate_score[base + pos]
+            selected[game] = pos
+            if prev < 0:
+                return
+            # Backtrack: the previous holder continues from its next candidate
+            game = prev
+            pos = selected[game] + 1
+
+    def _release(self, game: int) -> None:
+        """Forgets a game without any entity (check the comment at the top)"""
+        del self.games[self.game_ids[game]]
+        self.game_ids[game] = None
+        self.free_games.append(game)
+
+    def get(self, cid: object) -> Optional[str]:
+        game = self.games.get(cid)
+        if game is None or self.selected[game] < 0:
+            return None
+        entity = self.candidate_entity[game * self.k + self.selected[game]]
+        return f"{self.uuid_hi[entity]:016x}{self.uuid_lo[entity]:016x}"
+
+    def __len__(self) -> int:
+        return sum(1 for pos in self.selected if pos >= 0)
+
+
+class AuctionMatching:
+    def __init__(self, epsilon: float = 1e-6):
+        # Final epsilon, relative to the maximum score
+        self.epsilon = epsilon
+        self.candidates = {}  # type: Dict[object, Tuple[Tuple[str, ...], array]]
+        # id -> selected uuid (computed lazily, on the first get)
+        self.assignment = None  # type: Optional[Dict[object, str]]
+
+    def add(self, cid: object, edges: Iterable[Tuple[str, float]]) -> None:
+        uuids = tuple(uuid for uuid, _score in edges)
+        if len(uuids) == 0:
+            return
+        self.candidates[cid] = (uuids, array('d', (score for _uuid, score in edges)))
+        self.assignment = None
+
+    @staticmethod
+    def _auction(options: list[Tuple[list[int], list[float]]], prices: list[float], epsilon: float) -> list[int]:
+        """
+        One forward auction phase
+
+        :param options: for every bidder the objects it can take and their values
+        :param prices: prices of the objects (updated in place)
+        :return: the object assigned to every bidder
+        """
+        owner = [-1] * len(prices)
+        assigned = [-1] * len(options)
+        unassigned = deque(range(len(options)))
+        while len(unassigned) > 0:
+            bidder = unassigned.popleft()
+            objects, values = options[bidder]
+            best, best_value, second_value = -1, -math.inf, -math.inf
+            for obj, value in zip(objects, values):
+                value -= prices[obj]
+                if value > best_value:
+                    best, best_value, second_value = obj, value, best_value
+                elif value > second_value:
+                    second_value = value
+            prices[best] += best_value - second_value + epsilon
+            prev = owner[best]
+            owner[best] = bidder
+            assigned[bidder] = best
+            if prev >= 0:
+                assigned[prev] = -1
+                unassigned.append(prev)
+        return assigned
+
+    def solve(self) -> Dict[object, str]:
+        games = list(self.candidates.keys())
+        entities = {}  # type: Dict[str, int]
+        for cid in games:
+            for uuid in self.candidates[cid][0]:
+                entities.setdefault(uuid, len(entities))
+        n, m = len(games), len(entities)
+
+        # Objects: entities [0, m), "new entity" of every game [m, m + n)
+        # Bidders: games [0, n), entities [n, n + m)
+        options = []  # type: list[Tuple[list[int], list[float]]]
+        entity_options = [([j], [0.0]) for j in range(m)]
+        for i, cid in enumerate(games):
+            uuids, scores = self.candidates[cid]
+            options.append(([entities[u] for u in uuids] + [m + i], list(scores) + [0.0]))
+            for uuid in uuids:
+                objects, values = entity_options[entities[uuid]]
+                objects.append(m + i)
+                values.append(0.0)
+        options += entity_options
+
+        max_score = max((max(scores) for _uuids, scores in self.candidates.values()), default=0.0)
+        min_epsilon = max(max_score, 1.0) * self.epsilon
+        epsilon = max(max_score / 4, min_epsilon)
+        prices = [0.0] * (n + m)
+        # Epsilon scaling: prices of the previous (coarser) phase are a good start for the next one
+        while True:
+            assigned = self._auction(options, prices, epsilon)
+            if epsilon <= min_epsilon:
+                break
+            epsilon = max(epsilon / 8, min_epsilon)
+
+        uuids = list(entities.keys())
+        self.assignment = {cid: uuids[assigned[i]] for i, cid in enumerate(games) if assigned[i] < m}
+        return self.assignment
+
+    def get(self, cid: object) -> Optional[str]:
+        if self.assignment is None:
+            self.solve()
+        return self.assignment.get(cid)
+
+    def __len__(self) -> int:
+        if self.assignment is None:
+            self.solve()
+        return len(self.assignment)
+
+
+def total_weight(matching, games: Iterable[Tuple[object, list[Tuple[str, float]]]]) -> float:
+    """Sum of the scores of the selected edges"""
+    res = 0.0
+    for cid, edges in games:
+        uuid = matching.get(cid)
+        if uuid is not None:
+            res += next(score for u, score in edges if u == uuid)
+    return res
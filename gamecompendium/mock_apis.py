@@ -0,0 +1,267 @@
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Optional, Callable, Dict
+
+from aiohttp import web
+
+# Mock scraping APIs
+# The scrapers (steam.dump_steam, igdb.download_games and their RateLimiter) only ever talk to the real APIs: their
+# throughput, backoff and memory can't be measured, and a benchmark would burn our (tiny) Steam quota.
+# This is a local stand-in of every endpoint they use, on a single server:
+#   GET  /ISteamApps/GetAppList/v0002       steam app list
+#   GET  /api/appdetails?appids=ID          steam game details
+#   POST /v4/games/count                    igdb game count
+#   POST /v4/games  "... limit N; offset M;" igdb page of games
+#   POST /oauth2/token                      twitch token (igdb credentials)
+# Responses have the shape of the real ones (only the fields the scrapers read, plus the descriptions) and are
+# generated from the id, so every run sees the same games. What can be configured (MockOptions):
+# - the latency of every response (uniform in 0.5x..1.5x)
+# - rate limiting: a fraction of the requests answered with 429 (steam also with its random 403), and a server-side
+#   limit of requests per second, like the real ones
+# - the size of the descriptions (the bulk of the payloads)
+# Point the scrapers at it in config.toml (check the [api] section of config.example.toml):
+#   python gamecompendium/mock_apis.py --port 8800
+# the scraping benchmark (perf.measure_scraping, `scrape-perf`) runs it and counts what the scrapers ask.
+
+DEFAULT_PORT = 8800
+TOKEN = 'mock-token'
+WORDS = ['the', 'of', 'and', 'a', 'to', 'in', 'game', 'world', 'play', 'battle', 'dark', 'quest', 'city', 'hero',
+         'space', 'story', 'time', 'war', 'island', 'legend', 'magic', 'dragon', 'racing', 'puzzle', 'survive',
+         'build', 'explore', 'fight', 'friends', 'online', 'levels', 'secret', 'ancient', 'kingdom', 'empire']
+GENRES = ['Action', 'Adventure', 'RPG', 'Strategy', 'Simulation', 'Puzzle', 'Racing', 'Sports', 'Indie', 'Casual']
+PLATFORMS = ['windows', 'mac', 'linux']
+
+
+@dataclass
+class MockOptions:
+    steam_games: int = 300
+    igdb_games: int = 10000
+    # Mean latency of every response
+    latency_ms: float = 50
+    # Fraction of the requests answered as rate limited
+    error_rate: float = 0.0
+    # Requests per second accepted by every API, the others are answered as rate limited (0 for no limit)
+    max_per_sec: float = 0
+    # Length of every description
+    description_bytes: int = 2000
+    seed: int = 42
+
+
+@dataclass
+class ApiStats:
+    requests: int = 0
+    statuses: Counter = field(default_factory=Counter)
+    # Requests of every distinct (method, path, parameters, body), the retries ask the same thing again
+    keys: Counter = field(default_factory=Counter)
+    succeeded: set = field(default_factory=set)
+    bytes_sent: int = 0
+    first: Optional[float] = None
+    last: Optional[float] = None
+
+    def add(self, key: str, status: int, size: int) -> None:
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.requests += 1
+        self.statuses[status] += 1
+        self.keys[key] += 1
+        self.bytes_sent += size
+        if status == 200:
+            self.succeeded.add(key)
+
+    def rate_limited(self) -> int:
+        return self.statuses[429] + self.statuses[403]
+
+    def requests_per_sec(self) -> float:
+        if self.requests < 2 or self.last == self.first:
+            return 0.0
+        # n requests arrive in n - 1 intervals
+        return (self.requests - 1) / (self.last - self.first)
+
+
+class MockApis:
+    """
+    The mock server (check the comment at the top), with the request stats of every API (steam, igdb and twitch)
+    """
+
+    def __init__(self, options: MockOptions):
+        self.options = options
+        self.stats = {}  # type: Dict[str, ApiStats]
+        self._rng = random.Random(options.seed)
+        self._recent = {}  # type: Dict[str, deque[float]]
+
+    def reset(self) -> None:
+        self.stats.clear()
+        self._recent.clear()
+
+    def _text(self, rng: random.Random) -> str:
+        words = []
+        size = 0
+        while size < self.options.description_bytes:
+            word = rng.choice(WORDS)
+            words.append(word)
+            size += len(word) + 1
+        return ' '.join(words)
+
+    def _is_limited(self, api: str) -> bool:
+        if self._rng.random() < self.options.error_rate:
+            return True
+        if self.options.max_per_sec <= 0:
+            return False
+        now = time.perf_counter()
+        recent = self._recent.setdefault(api, deque())
+        while len(recent) > 0 and recent[0] < now - 1:
+            recent.popleft()
+        if len(recent) >= self.options.max_per_sec:
+            return True
+        recent.append(now)
+        return False
+
+    async def _respond(self, api: str, key: str, make_body: Callable[[], object],
+                       limited_status: Optional[int] = 429) -> web.Response:
+        """:param limited_status: status of the rate-limited responses, None to never limit them"""
+        await asyncio.sleep(self.options.latency_ms / 1000 * self._rng.uniform(0.5, 1.5))
+        if limited_status is not None and self._is_limited(api):
+            response = web.Response(status=limited_status, text='Too Many Requests')
+        else:
+            response = web.json_response(make_body())
+        self.stats.setdefault(api, ApiStats()).add(key, response.status, len(response.body))
+        return response
+
+    def steam_details(self, appid: int) -> dict:
+        rng = random.Random(self.options.seed * 1_000_003 + appid)
+        if appid % 10 == 0:
+            # Apps that can't be read (unreleased, region locked...)
+            return {'success': False}
+        text = self._text(rng)
+        return {'success': True, 'data': {
+            'type': 'dlc' if rng.random() < 0.2 else 'game',
+            'name': f"{rng.choice(WORDS).capitalize()} {rng.choice(WORDS).capitalize()} {appid}",
+            'steam_appid': appid,
+            'required_age': 0,
+            'is_free': rng.random() < 0.1,
+            'detailed_description': f"<h2 class=\"bb_tag\">About the game</h2><p>{text}</p>",
+            'about_the_game': f"<p>{text}</p>",
+            'short_description': text[:200],
+            'developers': [f"{rng.choice(WORDS).capitalize()} Studios"],
+            'platforms': {p: p == 'windows' or rng.random() < 0.3 for p in PLATFORMS},
+            'genres': [{'id': str(GENRES.index(g)), 'description': g} for g in rng.sample(GENRES, 2)],
+            'recommendations': {'total': int(rng.paretovariate(1.2) * 100)},
+            'release_date': {'coming_soon': False, 'date': f"{rng.randint(1, 28)} Mar, {rng.randint(1995, 2023)}"},
+        }}
+
+    def igdb_game(self, gid: int) -> dict:
+        rng = random.Random(self.options.seed * 1_000_003 + gid)
+        return {
+            'id': gid,
+            'name': f"{rng.choice(WORDS).capitalize()} {rng.choice(WORDS).capitalize()} {gid}",
+            'summary': self._text(rng),
+            'genres': [{'id': GENRES.index(g), 'name': g} for g in rng.sample(GENRES, 2)],
+            'platforms': [{'id': 6, 'name': 'PC (Microsoft Windows)'}],
+            'involved_companies': [{'id': gid, 'developer': True,
+                                    'company': {'id': gid % 97, 'name': f"{rng.choice(WORDS).capitalize()} Games"}}],
+            'release_dates': [{'id': gid, 'date': rng.randint(788918400, 1672531200)}],
+            'total_rating_count': rng.randint(0, 50),
+        }
+
+    def create_app(self) -> web.Application:
+        async def app_list(request: web.Request) -> web.Response:
+            return await self._respond('steam', request.path_qs, lambda: {'applist': {'apps': [
+                {'appid': appid, 'name': ''} for appid in range(1, self.options.steam_games + 1)]}},
+                self._rng.choice([429, 403]))
+
+        async def app_details(request: web.Request) -> web.Response:
+            appid = int(request.query['appids'])
+            return await self._respond('steam', request.path_qs, lambda: {str(appid): self.steam_details(appid)},
+                                       self._rng.choice([429, 403]))
+
+        async def read_igdb(request: web.Request) -> str:
+            if request.headers.get('Authorization') != 'Bearer ' + TOKEN:
+                raise web.HTTPUnauthorized()
+            return await request.text()
+
+        async def games_count(request: web.Request) -> web.Response:
+            body = await read_igdb(request)
+            return await self._respond('igdb', request.path + body, lambda: {'count': self.options.igdb_games})
+
+        async def games(request: web.Request) -> web.Response:
+            body = await read_igdb(request)
+            limit = re.search(r'limit (\d+);', body)
+            offset = re.search(r'offset (\d+);', body)
+            start = 0 if offset is None else int(offset.group(1))
+            end = min(self.options.igdb_games, start + (10 if limit is None else int(limit.group(1))))
+            return await self._respond('igdb', request.path + body,
+                                       lambda: [self.igdb_game(gid) for gid in range(start + 1, end + 1)])
+
+        async def token(request: web.Request) -> web.Response:
+            # Only the APIs are rate limited, the token is asked once
+            return await self._respond('twitch', request.path, lambda: {
+                'access_token': TOKEN, 'expires_in': 3600, 'token_type': 'bearer'}, None)
+
+        app = web.Application()
+        app.router.add_get('/ISteamApps/GetAppList/v0002', app_list)
+        app.router.add_get('/api/appdetails', app_details)
+        app.router.add_post('/v4/games/count', games_count)
+        app.router.add_post('/v4/games', games)
+        app.router.add_post('/oauth2/token', token)
+        return app
+
+
+def api_config(url: str) -> dict:
+    """[api] section of config.toml that points the scrapers at a mock server"""
+    return {
+        'steam_api': url,
+        'steam_store': url,
+        'igdb': url + '/v4/',
+        'twitch_token': url + '/oauth2/token',
+    }
+
+
+async def start(mock: MockApis, host: str = 'localhost', port: int = DEFAULT_PORT) -> tuple[web.AppRunner, int]:
+    """
+    Starts the mock server (port 0 picks a free one)
+
+    :return: the runner (to clean up), the port
+    """
+    runner = web.AppRunner(mock.create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+async def _serve(options: MockOptions, host: str, port: int) -> None:
+    mock = MockApis(options)
+    runner, port = await start(mock, host, port)
+    print(f"Mock APIs on http://{host}:{port}, add to config.toml:")
+    print("[api]")
+    for key, value in api_config(f"http://{host}:{port}").items():
+        print(f"{key} = {json.dumps(value)}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local mock of the Steam, IGDB and Twitch APIs used by the scrapers")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--steam-games', type=int, default=MockOptions.steam_games)
+    parser.add_argument('--igdb-games', type=int, default=MockOptions.igdb_games)
+    parser.add_argument('--latency-ms', type=float, default=MockOptions.latency_ms)
+    parser.add_argument('--error-rate', type=float, default=MockOptions.error_rate)
+    parser.add_argument('--max-per-sec', type=float, default=MockOptions.max_per_sec)
+    parser.add_argument('--description-bytes', type=int, default=MockOptions.description_bytes)
+    args = parser.parse_args()
+    asyncio.run(_serve(MockOptions(steam_games=args.steam_games, igdb_games=args.igdb_games,
+                                   latency_ms=args.latency_ms, error_rate=args.error_rate,
+                                   max_per_sec=args.max_per_sec, description_bytes=args.description_bytes),
+                       args.host, args.port))
@@ -0,0 +1,834 @@
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Optional
+
+from benchmark import parse_suite
+from blocking import TitleBlocking
+from matching import GreedyMatching, AuctionMatching, total_weight
+from resolver import EntityResolver
+from schema_profiles import PROFILES
+from title_index import TitleIndex, FUZZY_SCORE
+
+import serving
+
+if TYPE_CHECKING:
+    # Imports aiohttp, only the scraping benchmark needs it (imported there)
+    import mock_apis
+
+# Performance regression harness
+# evaluate measures the quality of the results, this measures how fast we get them.
+# Everything runs offline on a small dump checked in the repository (fixtures/dumps), indexes are built in a
+# temporary directory so the real ones are never touched.
+# Metrics are a flat dict "name -> value", the suffix of the name tells how to compare them:
+#   *_ms        latencies, lower is better
+#   *_per_sec   throughputs, higher is better
+# anything else is informational and never compared.
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+FIXTURE_DUMP_DIR = ROOT_DIR / 'fixtures' / 'dumps'
+DEFAULT_QUERIES = ROOT_DIR / 'main.benchmark'
+DEFAULT_MAX_REGRESSION = 0.25
+# Import time budget of main.py (python -X importtime), query-only modes must not import the scraping dependencies
+# nor tqdm (only indexing, scraping, evaluation and perf show progress bars)
+IMPORT_BUDGET_MS = 400
+# Time to prompt budget of the read-only CLI (fresh interpreter, index opened and warmed up), checked on every run
+TIME_TO_PROMPT_BUDGET_MS = 1000
+SCRAPING_MODULES = ('aiohttp', 'dateparser', 'requests', 'config', 'igdb', 'steam', 'tqdm')
+
+
+@dataclass
+class PerfOptions:
+    dump_dir: str = str(FIXTURE_DUMP_DIR)
+    queries: str = str(DEFAULT_QUERIES)
+    k: int = 10
+    # How many times each query is repeated in warm measurements
+    repeat: int = 5
+    # Number of worker processes used in the throughput measurements
+    concurrency: list[int] = field(default_factory=lambda: [1, 2, 4])
+    # Number of games of the (synthetic) matching benchmark
+    matching_games: int = 2000
+    # Compare the schema profiles (indexes everything again for every profile)
+    profiles: bool = False
+    # Shard counts of the sharding scaling measurements (empty to skip them)
+    shards: list[int] = field(default_factory=list)
+
+
+def expand_queries(queries: list[str]) -> list[str]:
+    """
+    Synthetic expansions of the benchmark queries, so that the suite also covers query shapes that
+    are not in the benchmark (name-only, phrase, prefix and shorter queries)
+    """
+    res = list(queries)
+    for q in queries:
+        if ':' in q or '"' in q:
+            continue  # Already structured
+        words = q.split()
+        res.append(f"name:({q})")
+        res.append(f'"{q}"')
+        res.append(' '.join(words[:-1] + [words[-1][:3] + '*']))
+        if len(words) > 1:
+            res.append(' '.join(words[:-1]))
+    return list(dict.fromkeys(res))
+
+
+def latency_stats(prefix: str, samples: list[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+
+    def percentile(p: float) -> float:
+        return samples[min(len(samples) - 1, math.ceil(p * len(samples)) - 1)] * 1000
+
+    return {
+        f"{prefix}.mean_ms": statistics.fmean(samples) * 1000,
+        f"{prefix}.p50_ms": percentile(0.5),
+        f"{prefix}.p90_ms": percentile(0.9),
+        f"{prefix}.p99_ms": percentile(0.99),
+        f"{prefix}.max_ms": samples[-1] * 1000,
+    }
+
+
+async def measure_indexing(app) -> Dict[str, float]:
+    """
+    Indexing speed of every source, and the peak RSS of indexing (it runs first: the peak of the process after it is
+    the peak of indexing, the growth excludes the interpreter and the imports)
+    """
+    res = {}
+    # In KB on linux
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for source in app.sources.values():
+        start = time.perf_counter()
+        await app._init_index(source, force_reindex=True)
+        elapsed = time.perf_counter() - start
+        count = app.indexes[source.name].doc_count()
+        res[f"index.{source.name}.docs"] = count
+        res[f"index.{source.name}.docs_per_sec"] = count / elapsed
+    start = time.perf_counter()
+    await app._init_title_sidecars()
+    res["index.title_sidecars_ms"] = (time.perf_counter() - start) * 1000
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    res["index.peak_rss_mb"] = rss / 1024
+    res["index.peak_rss_growth_mb"] = (rss - rss_before) / 1024
+    return res
+
+
+def _last_source_games(app) -> list[tuple]:
+    with list(app.indexes.values())[-1].reader() as reader:
+        return [(f['id'], f['name'], f['devs'].split(',') if f.get('devs') else [], f.get('date'))
+                for f in reader.all_stored_fields()]
+
+
+def measure_resolver(app) -> Dict[str, float]:
+    """
+    Resolves the games of the last source against all the previous ones
+    """
+    indexes = list(app.indexes.values())
+    if len(indexes) < 2:
+        return {}
+    resolver = EntityResolver(*indexes[:-1], uuid_maps=app.uuid_maps)
+    games = _last_source_games(app)
+    start = time.perf_counter()
+    for game in games:
+        resolver.compute(*game)
+    elapsed = time.perf_counter() - start
+    return {
+        'resolver.games': len(games),
+        'resolver.games_per_sec': len(games) / elapsed,
+    }
+
+
+def _find_all(resolver: EntityResolver, games: list[tuple]) -> tuple[list, float]:
+    start = time.perf_counter()
+    found = [resolver.find_candidates(*g) for g in games]
+    return found, time.perf_counter() - start
+
+
+def _agreement(expected: list, found: list) -> Dict[str, float]:
+    top1 = [e[0][0] == f[0][0] for e, f in zip(expected, found) if len(e) > 0 and len(f) > 0]
+    recall = [len({u for u, _ in e} & {u for u, _ in f}) / len(e) for e, f in zip(expected, found) if len(e) > 0]
+    return {
+        'top1_agreement': sum(top1) / max(1, len(top1)),
+        'top5_recall': sum(recall) / max(1, len(recall)),
+    }
+
+
+def measure_blocking(app) -> Dict[str, float]:
+    """
+    Recall and speed of the title blocking stage, compared with the full search of the resolver
+    """
+    indexes = list(app.indexes.values())
+    if len(indexes) < 2:
+        return {}
+    games = [g[1:] for g in _last_source_games(app)]
+    full = EntityResolver(*indexes[:-1], uuid_maps=app.uuid_maps)
+    expected, full_time = _find_all(full, games)
+
+    start = time.perf_counter()
+    blocking = TitleBlocking.build(indexes[:-1])
+    build_time = time.perf_counter() - start
+    blocked = EntityResolver(*indexes[:-1], uuid_maps=app.uuid_maps, candidates=blocking)
+    found, blocked_time = _find_all(blocked, games)
+
+    agreement = _agreement(expected, found)
+    return {
+        'resolver.blocking.build_ms': build_time * 1000,
+        'resolver.blocking.games_per_sec': len(games) / blocked_time,
+        'resolver.blocking.speedup': full_time / blocked_time,
+        'resolver.blocking.fallback_ratio': blocked.searched / len(games),
+        'resolver.blocking.top1_agreement': agreement['top1_agreement'],
+        'resolver.blocking.top5_recall': agreement['top5_recall'],
+    }
+
+
+def measure_title_index(app, fuzzy: bool = False) -> Dict[str, float]:
+    """
+    Fast path ratio and speed of the title index, compared with the full search of the resolver
+    (agreement is only measured on the games resolved by the fast path)
+    """
+    indexes = list(app.indexes.values())
+    if len(indexes) < 2:
+        return {}
+    games = [g[1:] for g in _last_source_games(app)]
+    full = EntityResolver(*indexes[:-1], uuid_maps=app.uuid_maps)
+    expected, full_time = _find_all(full, games)
+
+    start = time.perf_counter()
+    titles = TitleIndex.build(indexes[:-1], fuzzy=fuzzy)
+    build_time = time.perf_counter() - start
+    fast = EntityResolver(*indexes[:-1], uuid_maps=app.uuid_maps, titles=titles)
+    found, fast_time = _find_all(fast, games)
+
+    pairs = [(e, f) for e, f in zip(expected, found) if len(f) == 1 and f[0][1] >= FUZZY_SCORE]
+    agreement = _agreement([e for e, _ in pairs], [f for _, f in pairs])
+    prefix = 'resolver.titles_fuzzy' if fuzzy else 'resolver.titles'
+    return {
+        f"{prefix}.build_ms": build_time * 1000,
+        f"{prefix}.games_per_sec": len(games) / fast_time,
+        f"{prefix}.speedup": full_time / fast_time,
+        f"{prefix}.fast_path_ratio": fast.fast_path / len(games),
+        f"{prefix}.top1_agreement": agreement['top1_agreement'],
+    }
+
+
+def sequel_chains(games: int, chain: int = 50, k: int = 5):
+    """
+    Adversarial input for the resolver matching: games come in long sequel chains, every game of a chain matches the
+    same k entities (the franchise) and every new game has higher scores than the previous ones,
+    so each insertion steals the entities of the previous games
+    """
+    for c in range(0, games, chain):
+        franchise = [uuid.uuid4().hex for _ in range(k)]
+        for i in range(min(chain, games - c)):
+            yield c + i, [(franchise[j], float(i * k - j + k)) for j in range(k)]
+
+
+def random_graph(games: int, k: int = 5, seed: int = 42):
+    """Games with k random candidates (out of as many entities as games) and random scores"""
+    rng = random.Random(seed)
+    entities = [uuid.uuid4().hex for _ in range(games)]
+    for i in range(games):
+        scores = sorted((rng.uniform(1, 20) for _ in range(k)), reverse=True)
+        yield i, list(zip(rng.sample(entities, k), scores))
+
+
+def _run_matching(matching_class, graph: list):
+    matching = matching_class()
+    for cid, edges in graph:
+        matching.add(cid, edges)
+    len(matching)  # The auction is solved lazily
+    return matching
+
+
+def measure_matching(games: int) -> Dict[str, float]:
+    """
+    Speed, memory and total weight of the matching algorithms on adversarial (sequel chains) and random graphs.
+    Memory doesn't include the uuid strings, they're shared with the input.
+    """
+    res = {}
+    for graph_name, graph in [('chains', list(sequel_chains(games))), ('random', list(random_graph(games)))]:
+        for name, matching_class in [('greedy', GreedyMatching), ('auction', AuctionMatching)]:
+            prefix = f"matching.{graph_name}.{name}"
+            start = time.perf_counter()
+            matching = _run_matching(matching_class, graph)
+            res[f"{prefix}.games_per_sec"] = games / (time.perf_counter() - start)
+            res[f"{prefix}.total_weight"] = total_weight(matching, graph)
+            del matching
+            # Memory is measured in another run, tracemalloc slows everything down
+            tracemalloc.start()
+            matching = _run_matching(matching_class, graph)
+            size, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del matching
+            res[f"{prefix}.mb_per_1m_games"] = size / games * 1e6 / 2 ** 20
+            res[f"{prefix}.peak_mb_per_1m_games"] = peak / games * 1e6 / 2 ** 20
+        greedy, auction = res[f"matching.{graph_name}.greedy.total_weight"], res[f"matching.{graph_name}.auction.total_weight"]
+        res[f"matching.{graph_name}.greedy_optimality"] = greedy / auction if auction > 0 else 1.0
+        _check_added_again(graph)
+    return res
+
+
+def _check_added_again(graph: list) -> None:
+    """
+    Games added again with the same candidates (ex. a game seen twice in a dump) must end up with the same entities
+    """
+    once = _run_matching(GreedyMatching, graph)
+    again = _run_matching(GreedyMatching, graph + graph[::10])
+    changed = sum(1 for cid, _edges in graph if once.get(cid) != again.get(cid))
+    if changed > 0:
+        raise Exception(f"Greedy matching: {changed} games change entity when games are added again")
+
+
+def measure_latency(app, queries: list[str], k: int, repeat: int) -> Dict[str, float]:
+    # Cold: every query runs on freshly opened searchers
+    cold = []
+    for q in queries:
+        app.close_searchers()
+        start = time.perf_counter()
+        app.run_query(q, k)
+        cold.append(time.perf_counter() - start)
+
+    warm = []
+    for _ in range(repeat):
+        for q in queries:
+            start = time.perf_counter()
+            app.run_query(q, k)
+            warm.append(time.perf_counter() - start)
+
+    return {**latency_stats('query.cold', cold), **latency_stats('query.warm', warm)}
+
+
+# Every filter selects some (but not all) of the fixture games, empty filters would only measure the early return
+FILTER_SUFFIXES = (' platforms:linux', ' genres:shooter', ' date:[2000 to 2015]',
+                   " genres:'role-playing (rpg)' NOT platforms:mac")
+
+
+def measure_filters(app, queries: list[str], k: int, repeat: int) -> Dict[str, float]:
+    # Same queries with structured filters, the first run evaluates the bitsets and the next ones use the cache
+    filtered = [q + FILTER_SUFFIXES[i % len(FILTER_SUFFIXES)] for i, q in enumerate(queries)]
+    app.filter_cache.clear()
+    first = []
+    for q in filtered:
+        start = time.perf_counter()
+        app.run_query(q, k)
+        first.append(time.perf_counter() - start)
+
+    cached = []
+    for _ in range(repeat):
+        for q in filtered:
+            start = time.perf_counter()
+            app.run_query(q, k)
+            cached.append(time.perf_counter() - start)
+    cache = app.filter_cache
+    return {
+        **latency_stats('filter.first', first),
+        **latency_stats('filter.cached', cached),
+        'filter.cache_hit_rate': cache.hits / max(1, cache.hits + cache.misses),
+    }
+
+
+PAGES = 8
+
+
+def measure_paging(app, queries: list[str], k: int) -> Dict[str, float]:
+    # Pages 2..PAGES of every query: resumed from the cursor, or computed again with a bigger k.
+    # The cost of a resumed page should stay flat with its number (paging.cursor.page*), the rerun grows with it
+    resumed = []
+    rerun = []
+    by_page = {page: [] for page in range(2, PAGES + 1)}
+    growth = []
+    for q in queries:
+        _page, cursor = app.run_query_page(q, k)
+        times = []
+        for page in range(2, PAGES + 1):
+            if cursor is None:
+                break
+            start = time.perf_counter()
+            _page, cursor = app.run_query_page(q, k, cursor)
+            times.append(time.perf_counter() - start)
+            by_page[page].append(times[-1])
+
+            start = time.perf_counter()
+            app.run_query(q, k * page, use_entity_index=False)
+            rerun.append(time.perf_counter() - start)
+        resumed += times
+        if len(times) == PAGES - 1:
+            growth.append(times[-1] / times[0])
+    if len(resumed) == 0:
+        return {}
+    res = {**latency_stats('paging.cursor', resumed), **latency_stats('paging.rerun', rerun)}
+    for page, samples in by_page.items():
+        if len(samples) > 0:
+            res[f"paging.cursor.page{page}.mean_ms"] = statistics.fmean(samples) * 1000
+    if len(growth) > 0:
+        # Last page / second page of the queries with every page, ~1 when resuming doesn't repeat the previous work
+        res['paging.cursor.last_page_ratio'] = statistics.median(growth)
+    return res
+
+
+def measure_completion(app, queries: list[str]) -> Dict[str, float]:
+    # Every prefix of the queries, like a user typing them
+    prefixes = [q[:i] for q in queries for i in range(1, len(q) + 1)]
+    samples = []
+    for prefix in prefixes:
+        start = time.perf_counter()
+        app.complete(prefix)
+        samples.append(time.perf_counter() - start)
+    return {**latency_stats('complete', samples), 'complete.titles': len(app.completion or [])}
+
+
+def measure_spelling(app, queries: list[str]) -> Dict[str, float]:
+    # Misspelled words of the queries (middle letter removed), corrected with the trigram index and with FuzzyTerm
+    from whoosh.query import FuzzyTerm
+    from spelling import CORRECTED_FIELDS, max_edits
+
+    words = sorted({w for q in queries for w in q.lower().split() if len(w) >= 6 and w.isalpha()})
+    typos = [(w, w[:len(w) // 2] + w[len(w) // 2 + 1:]) for w in words]
+    trigram = []
+    fuzzy = []
+    found = 0
+    searchers = app._require_searchers()
+    for word, typo in typos:
+        start = time.perf_counter()
+        corrections = app.spelling._find_corrections(typo)
+        trigram.append(time.perf_counter() - start)
+        found += any(term == word for term, _distance in corrections)
+
+        start = time.perf_counter()
+        for searcher, _name in searchers:
+            for fieldname in CORRECTED_FIELDS:
+                list(FuzzyTerm(fieldname, typo, maxdist=max_edits(typo)).expanded_terms(searcher.reader()))
+        fuzzy.append(time.perf_counter() - start)
+    if len(typos) == 0:
+        return {}
+    return {
+        **latency_stats('spelling.trigrams', trigram),
+        **latency_stats('spelling.fuzzy_term', fuzzy),
+        'spelling.corrected': found / len(typos),
+    }
+
+
+async def measure_shards(app, queries: list[str], k: int, repeat: int, counts: list[int]) -> Dict[str, float]:
+    """
+    Query latency with the sources split in a growing number of shards (check shards.py), and how many results of
+    the top-k are the same of the unsharded indexes (every shard scores with its own statistics)
+    """
+    await app.reshard(1)
+    expected = {q: [hit.hits[0][0]['uuid'] for hit in app.run_query(q, k, use_entity_index=False)] for q in queries}
+    res = {}
+    for count in counts:
+        start = time.perf_counter()
+        await app.reshard(count)
+        build = time.perf_counter() - start
+        # Starts the workers
+        found = {q: [hit.hits[0][0]['uuid'] for hit in app.run_query(q, k, use_entity_index=False)] for q in queries}
+        warm = []
+        for _ in range(repeat):
+            for q in queries:
+                start = time.perf_counter()
+                app.run_query(q, k, use_entity_index=False)
+                warm.append(time.perf_counter() - start)
+        res.update(latency_stats(f"shards.s{count}.query.warm", warm))
+        res[f"shards.s{count}.build_ms"] = build * 1000
+        same = sum(len(set(found[q]) & set(expected[q])) for q in queries)
+        res[f"shards.s{count}.top_k_agreement"] = same / max(1, sum(len(expected[q]) for q in queries))
+    await app.reshard(1)
+    return res
+
+
+def measure_remote(app, queries: list[str], k: int, repeat: int) -> Dict[str, float]:
+    """
+    Query latency with every source served by a source server on localhost (check remote.py), against the
+    in-process aggregation, and the requests and bytes every query sends
+
+    The baseline of the servers is remote.inprocess_async: the same algorithm (aggregator.aggregate_search_async) on
+    in-process sources, without the network. remote.inprocess is the default (synchronous) aggregation.
+    """
+    import multiprocessing
+    import aggregator
+    import remote
+
+    ctx = multiprocessing.get_context('spawn')
+    ready = ctx.Queue()
+    servers = [ctx.Process(target=remote.serve_forever, args=(app.index_dir, name, 'localhost', 0, ready), daemon=True)
+               for name in app.indexes]
+    for server in servers:
+        server.start()
+    try:
+        ports = [ready.get(timeout=60) for _ in servers]
+        # The ports come in start order, not in source order: ask every server its name
+        urls = {}
+        for port in ports:
+            with urllib.request.urlopen(f"http://localhost:{port}/info") as resp:
+                urls[json.load(resp)['name']] = f"http://localhost:{port}"
+
+        local = []
+        for _ in range(repeat):
+            for q in queries:
+                start = time.perf_counter()
+                app.run_query(q, k, use_entity_index=False)
+                local.append(time.perf_counter() - start)
+
+        # Kept across the queries, with their sorted access cache, like the servers
+        sources = [remote.SearcherSource(searcher, name, app._search_uuid_maps.get(name), app.filter_cache)
+                   for searcher, name in app._require_searchers()]
+        local_client = remote.RemoteClient()
+
+        def run_async(q: str) -> None:
+            query, filter_q = app._parse_query(q)
+            local_client.run(aggregator.aggregate_search_async(query, filter_q, sources, k, theta=app.theta,
+                                                               max_rows=app.max_rows))
+
+        try:
+            for q in queries:
+                run_async(q)
+            local_async = []
+            for _ in range(repeat):
+                for q in queries:
+                    start = time.perf_counter()
+                    run_async(q)
+                    local_async.append(time.perf_counter() - start)
+        finally:
+            local_client.close()
+
+        for name, url in urls.items():
+            app.add_remote(name, url)
+        # Connections and server caches
+        for q in queries:
+            app.run_query(q, k)
+        client = app._remote_client
+        client.requests = client.bytes = 0
+        remote_samples = []
+        for _ in range(repeat):
+            for q in queries:
+                start = time.perf_counter()
+                app.run_query(q, k)
+                remote_samples.append(time.perf_counter() - start)
+        requests, sent = client.requests, client.bytes
+    finally:
+        app.remotes.clear()
+        app.close_searchers()
+        for server in servers:
+            server.terminate()
+            server.join()
+
+    res = {**latency_stats('remote.inprocess', local), **latency_stats('remote.inprocess_async', local_async),
+           **latency_stats('remote.localhost', remote_samples)}
+    res['remote.requests_per_query'] = requests / len(remote_samples)
+    res['remote.kb_per_query'] = sent / len(remote_samples) / 1024
+    return res
+
+
+def measure_throughput(app, queries: list[str], k: int, repeat: int, levels: list[int]) -> Dict[str, float]:
+    # Same workers of the evaluation engine: one App (with warm searchers) per process
+    from evaluation import _init_worker, _worker_run_query, query_settings
+
+    res = {}
+    all_queries = queries * repeat
+    for workers in levels:
+        init_args = (app.index_dir, list(app.sources.values()), query_settings(app))
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=init_args) as pool:
+            # Warm up every worker
+            list(pool.map(_worker_run_query, queries, [k] * len(queries)))
+            start = time.perf_counter()
+            list(pool.map(_worker_run_query, all_queries, [k] * len(all_queries)))
+            elapsed = time.perf_counter() - start
+        res[f"throughput.c{workers}.queries_per_sec"] = len(all_queries) / elapsed
+    return res
+
+
+async def measure_startup(app, queries: list[str], k: int) -> Dict[str, float]:
+    """
+    Time to the first query (open, warm up and run it) with cold page cache, in the default, read-only and
+    read-only with prefetch modes (check serving.py)
+    """
+    from app import App
+
+    res = {}
+    for mode, readonly, prefetch in [('default', False, False), ('readonly', True, False), ('prefetch', True, True)]:
+        serving.evict(app.index_dir)
+        start = time.perf_counter()
+        served = App(app.index_dir, readonly=readonly)
+        for source in app.sources.values():
+            served.add_source(source)
+        await served.open()
+        served.warm_up(prefetch=prefetch)
+        ready = time.perf_counter()
+        served.run_query(queries[0], k)
+        done = time.perf_counter()
+        served.close_searchers()
+        res[f"startup.{mode}.open_ms"] = (ready - start) * 1000
+        res[f"startup.{mode}.first_query_ms"] = (done - ready) * 1000
+        res[f"startup.{mode}.time_to_first_query_ms"] = (done - start) * 1000
+    return res
+
+
+@dataclass
+class ScrapeOptions:
+    # Behavior of the mock APIs (None for the defaults)
+    mock: Optional['mock_apis.MockOptions'] = None
+    sources: list[str] = field(default_factory=lambda: ['steam', 'igdb'])
+    # Rate limits of the scrapers, the real steam one (40/min) would make a run last minutes
+    steam_requests_per_minute: float = 600
+    igdb_requests_per_second: float = 4
+
+
+async def measure_scraping(options: ScrapeOptions) -> Dict[str, float]:
+    """
+    Scrapes every source from the mock APIs (check mock_apis.py), each one with `main.py scrape` in a fresh
+    process and folder (without the response cache): achieved requests per second against the configured limit,
+    retries (requests / distinct requests), rate-limited and lost requests, peak RSS of the scraper
+    """
+    import toml
+    import mock_apis
+
+    mock = mock_apis.MockApis(options.mock or mock_apis.MockOptions())
+    runner, port = await mock_apis.start(mock, 'localhost', 0)
+    limits = {'steam': options.steam_requests_per_minute / 60, 'igdb': options.igdb_requests_per_second}
+    res = {}
+    try:
+        for source in options.sources:
+            mock.reset()
+            with tempfile.TemporaryDirectory(prefix='gamecompendium-scrape-') as work_dir:
+                with open(os.path.join(work_dir, 'config.toml'), 'wt') as fd:
+                    toml.dump({
+                        'download_full': True,
+                        'twitch': {'client_id': 'mock', 'client_secret': 'mock'},
+                        'http_cache': {'enabled': False},
+                        'api': {**mock_apis.api_config(f"http://localhost:{port}"),
+                                'steam_requests_per_minute': options.steam_requests_per_minute,
+                                'igdb_requests_per_second': options.igdb_requests_per_second},
+                    }, fd)
+                log_path = os.path.join(work_dir, 'scrape.log')
+                with open(log_path, 'wb') as log:
+                    start = time.perf_counter()
+                    proc = subprocess.Popen([sys.executable, str(ROOT_DIR / 'gamecompendium' / 'main.py'), 'scrape',
+                                             '--only', source], cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)
+                    # wait4 (instead of wait) gives the resources of this child only, the event loop keeps
+                    # serving the mock APIs meanwhile
+                    _pid, status, usage = await asyncio.get_running_loop().run_in_executor(None, os.wait4, proc.pid, 0)
+                    elapsed = time.perf_counter() - start
+                    proc.returncode = os.waitstatus_to_exitcode(status)
+                if proc.returncode != 0:
+                    with open(log_path, 'rt', errors='replace') as fd:
+                        print(fd.read()[-4000:])
+                    raise Exception(f"Scraping {source} failed ({proc.returncode})")
+
+            stats = mock.stats.get(source, mock_apis.ApiStats())
+            prefix = f"scrape.{source}"
+            res[f"{prefix}.total_ms"] = elapsed * 1000
+            res[f"{prefix}.requests"] = stats.requests
+            res[f"{prefix}.requests_per_sec"] = stats.requests_per_sec()
+            res[f"{prefix}.limit_per_sec"] = limits[source]
+            res[f"{prefix}.limit_usage"] = stats.requests_per_sec() / limits[source]
+            res[f"{prefix}.retry_amplification"] = stats.requests / max(1, len(stats.keys))
+            res[f"{prefix}.rate_limited"] = stats.rate_limited()
+            res[f"{prefix}.lost_requests"] = len(stats.keys) - len(stats.succeeded)
+            res[f"{prefix}.mb_received"] = stats.bytes_sent / 2 ** 20
+            # ru_maxrss is in KB on linux
+            res[f"{prefix}.peak_rss_mb"] = usage.ru_maxrss / 1024
+    finally:
+        await runner.cleanup()
+    return res
+
+
+def measure_cli_startup(index_dir: str) -> tuple[Dict[str, float], list[str]]:
+    """
+    Import time of main.py (with -X importtime) and time to prompt of the read-only query path,
+    in a fresh interpreter started outside the project folder (without config.toml)
+
+    :return: metrics, scraping modules imported by the query path (should be none)
+    """
+    code = (
+        "import asyncio, json, sys, time\n"
+        "import main\n"
+        "app = main.App(sys.argv[1], readonly=True)\n"
+        "for source in main.DEFAULT_SOURCES:\n"
+        "    app.add_source(source)\n"
+        "asyncio.run(app.open())\n"
+        "app.warm_up()\n"
+        f"print(json.dumps([m for m in {SCRAPING_MODULES!r} if m in sys.modules]))\n"
+    )
+    env = dict(os.environ, PYTHONPATH=str(Path(__file__).resolve().parent))
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code, index_dir], cwd=index_dir, env=env,
+                          capture_output=True, text=True, check=True)
+    elapsed = time.perf_counter() - start
+    # "import time: self [us] | cumulative | imported package"
+    import_us = next(int(line.split('|')[1]) for line in proc.stderr.splitlines()
+                     if line.startswith('import time:') and line.split('|')[2].strip() == 'main')
+    metrics = {
+        'startup.cli.import_ms': import_us / 1000,
+        'startup.cli.time_to_prompt_ms': elapsed * 1000,
+    }
+    return metrics, json.loads(proc.stdout.splitlines()[-1])
+
+
+def _index_bytes(index_dir: str, name: str) -> int:
+    return sum(p.stat().st_size for p in Path(index_dir).iterdir()
+               if p.name.startswith(f"{name}_") or p.name.startswith(f"_{name}_"))
+
+
+async def measure_profiles(options: PerfOptions, queries: list[str]) -> Dict[str, float]:
+    """
+    Index size, segment merge time and query latency of every schema profile (check schema_profiles.py)
+    """
+    from app import App, create_sources, DEFAULT_SOURCES
+
+    res = {}
+    for profile in PROFILES:
+        with tempfile.TemporaryDirectory(prefix='gamecompendium-perf-') as index_dir:
+            app = App(index_dir)
+            profiles = dict.fromkeys((s.name for s in DEFAULT_SOURCES), profile)
+            for source in create_sources(options.dump_dir, profiles=profiles):
+                app.add_source(source)
+            await app.init()
+
+            prefix = f"profile.{profile}"
+            res[f"{prefix}.index_mb"] = sum(_index_bytes(index_dir, name) for name in app.indexes) / 2 ** 20
+            latency = measure_latency(app, queries, options.k, options.repeat)
+            res[f"{prefix}.query.warm.p50_ms"] = latency['query.warm.p50_ms']
+            res[f"{prefix}.query.warm.p90_ms"] = latency['query.warm.p90_ms']
+            app.close_searchers()
+
+            # Merge: copy every index into a new segment (the same path as segment merges) and optimize
+            start = time.perf_counter()
+            for index in app.indexes.values():
+                with index.reader() as reader, index.writer() as writer:
+                    writer.add_reader(reader)
+                index.optimize()
+            res[f"{prefix}.merge_ms"] = (time.perf_counter() - start) * 1000
+    return res
+
+
+async def run(options: PerfOptions) -> dict:
+    from app import App, create_sources
+
+    with open(options.queries, 'rt') as fd:
+        queries = expand_queries([b.query for b in parse_suite(fd).benchmarks])
+
+    metrics = {}
+    with tempfile.TemporaryDirectory(prefix='gamecompendium-perf-') as index_dir:
+        app = App(index_dir)
+        for source in create_sources(options.dump_dir):
+            app.add_source(source)
+
+        metrics.update(await measure_indexing(app))
+        metrics.update(measure_resolver(app))
+        metrics.update(measure_blocking(app))
+        metrics.update(measure_title_index(app))
+        metrics.update(measure_title_index(app, fuzzy=True))
+        metrics.update(measure_matching(options.matching_games))
+        metrics.update(measure_latency(app, queries, options.k, options.repeat))
+        metrics.update(measure_filters(app, queries, options.k, options.repeat))
+        metrics.update(measure_paging(app, queries, options.k))
+        metrics.update(measure_completion(app, queries))
+        metrics.update(measure_spelling(app, queries))
+        metrics.update(await measure_startup(app, queries, options.k))
+        cli_metrics, query_path_imports = measure_cli_startup(index_dir)
+        metrics.update(cli_metrics)
+        metrics.update(measure_throughput(app, queries, options.k, options.repeat, options.concurrency))
+        metrics.update(measure_remote(app, queries, options.k, options.repeat))
+        if len(options.shards) > 0:
+            metrics.update(await measure_shards(app, queries, options.k, options.repeat, options.shards))
+        app.close_searchers()
+
+    if options.profiles:
+        metrics.update(await measure_profiles(options, queries))
+
+    return {
+        'info': {
+            'dump_dir': options.dump_dir,
+            'queries': len(queries),
+            'query_path_imports': query_path_imports,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'metrics': metrics,
+    }
+
+
+async def run_scraping(options: ScrapeOptions) -> dict:
+    """Scraping benchmark (check measure_scraping), in the same format as run"""
+    metrics = await measure_scraping(options)
+    return {
+        'info': {'sources': options.sources, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'metrics': metrics,
+    }
+
+
+def check_budgets(results: dict) -> list[str]:
+    """
+    Checks the startup budgets, they don't need a baseline
+
+    :param results: the current results (as returned by run)
+    :return: a description of every budget exceeded (empty if everything is fine)
+    """
+    failures = []
+    imports = results['info'].get('query_path_imports', [])
+    if len(imports) > 0:
+        failures.append(f"query-only startup imports scraping modules: {', '.join(imports)}")
+    budgets = {
+        'startup.cli.import_ms': IMPORT_BUDGET_MS,
+        'startup.cli.time_to_prompt_ms': TIME_TO_PROMPT_BUDGET_MS,
+    }
+    for name, budget in budgets.items():
+        value = results['metrics'].get(name, 0)
+        if value > budget:
+            failures.append(f"{name}: {value:.1f} over the budget of {budget}ms")
+    return failures
+
+
+def compare(results: dict, baseline: dict, max_regression: float = DEFAULT_MAX_REGRESSION,
+            thresholds: Optional[Dict[str, float]] = None) -> list[str]:
+    """
+    Compares the metrics with a baseline
+
+    :param results: the current results (as returned by run)
+    :param baseline: previous results
+    :param max_regression: maximum accepted relative regression (0.25 = 25% worse)
+    :param thresholds: metric name -> maximum accepted regression, overrides max_regression
+    :return: a description of every regression found (empty if everything is fine)
+    """
+    thresholds = thresholds or {}
+    regressions = []
+    for name, value in results['metrics'].items():
+        old = baseline['metrics'].get(name)
+        if old is None or old == 0:
+            continue
+        if name.endswith('_ms'):
+            change = (value - old) / old
+        elif name.endswith('_per_sec'):
+            change = (old - value) / old
+        else:
+            continue
+        limit = thresholds.get(name, max_regression)
+        if change > limit:
+            regressions.append(f"{name}: {old:.3f} -> {value:.3f} ({change * 100:+.1f}% worse, limit {limit * 100:.0f}%)")
+    return regressions
+
+
+def print_results(results: dict) -> None:
+    for name, value in results['metrics'].items():
+        print(f"{name:45} {value:12.3f}")
+
+
+def load_json(path: str) -> dict:
+    with open(path, 'rt') as fd:
+        return json.load(fd)
+
+
+def save_json(path: str, data: dict) -> None:
+    with open(path, 'wt') as fd:
+        json.dump(data, fd, indent=2)
@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import time
+from typing import TYPE_CHECKING, Optional, Dict
+
+if TYPE_CHECKING:
+    from tqdm import tqdm
+
+# Progress reporting
+# Sources are scraped and indexed concurrently, if each one printed its own progress bars they would overwrite
+# each other. A ProgressBoard gives every source its own line (a tqdm bar at a fixed position) and sources report
+# through a ProgressReporter: the bar is reused for every stage of the source (download, resolve, write...).
+# A reporter without a board is a plain tqdm bar, like the ones sources used before.
+# Reporters must only be used from the event loop thread, code running in an executor uses a ProgressChannel that
+# sends the updates back to the loop (and carries the cancellation requests the other way).
+# tqdm is only imported when a bar is shown (indexing and scraping), never by the query path.
+
+
+class ProgressReporter:
+    def __init__(self, name: str, position: Optional[int] = None):
+        self.name = name
+        self.position = position
+        self._bar = None  # type: Optional[tqdm]
+
+    def start(self, stage: str, total: Optional[int] = None, initial: int = 0) -> None:
+        """Starts a new stage, resetting the bar"""
+        from tqdm import tqdm
+
+        desc = f"{self.name}: {stage}"
+        if self._bar is None or self.position is None:
+            self.close()
+            self._bar = tqdm(total=total, initial=initial, desc=desc, position=self.position, dynamic_ncols=True)
+            return
+        self._bar.reset()
+        self._bar.total = total
+        self._bar.update(initial)
+        self._bar.set_description(desc)
+
+    def set_total(self, total: int) -> None:
+        if self._bar is not None:
+            self._bar.total = total
+            self._bar.refresh()
+
+    def update(self, n: int = 1) -> None:
+        if self._bar is not None:
+            self._bar.update(n)
+
+    def close(self) -> None:
+        if self._bar is not None:
+            self._bar.close()
+            self._bar = None
+
+
+class ProgressBoard:
+    def __init__(self):
+        self.reporters = {}  # type: Dict[str, ProgressReporter]
+
+    def reporter(self, name: str) -> ProgressReporter:
+        if name not in self.reporters:
+            self.reporters[name] = ProgressReporter(name, len(self.reporters))
+        return self.reporters[name]
+
+    def close(self) -> None:
+        for reporter in self.reporters.values():
+            reporter.close()
+
+
+class ProgressChannel:
+    """
+    Progress reporter for blocking code running in another thread (check async_utils.run_in_executor)
+
+    Updates are forwarded to the reporter on the event loop (batched, the loop is woken up at most every
+    FLUSH_INTERVAL seconds), the loop can ask the worker to stop with cancel().
+    """
+    FLUSH_INTERVAL = 0.1
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, reporter: ProgressReporter):
+        self.loop = loop
+        self.reporter = reporter
+        self.cancelled = threading.Event()
+        self._pending = 0
+        self._last_flush = 0.0
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def check_cancelled(self) -> None:
+        """Raises CancelledError if the loop cancelled the work"""
+        if self.cancelled.is_set():
+            raise asyncio.CancelledError()
+
+    def _send(self, fn, *args) -> None:
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def flush(self) -> None:
+        if self._pending > 0:
+            self._send(self.reporter.update, self._pending)
+            self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def start(self, stage: str, total: Optional[int] = None, initial: int = 0) -> None:
+        self.flush()
+        self._send(self.reporter.start, stage, total, initial)
+
+    def set_total(self, total: int) -> None:
+        self._send(self.reporter.set_total, total)
+
+    def update(self, n: int = 1) -> None:
+        self._pending += n
+        if time.monotonic() - self._last_flush >= self.FLUSH_INTERVAL:
+            self.check_cancelled()
+            self.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._send(self.reporter.close)
@@ -0,0 +1,177 @@
+import json
+import os
+from typing import Dict, Optional
+
+from whoosh import fields
+from whoosh.filedb.filestore import Storage
+from whoosh.index import Index
+
+from analyzers import keep_numbers_analyzer
+from schema_profiles import keyword_field
+from uuid_map import index_version
+
+# Entity registry
+# Without the registry every source is resolved against all the sources indexed before it: the third source
+# searches the first two, and reindexing the first source changes its uuids, so every later source should be
+# resolved again (a cascade that grows quadratically with the number of sources).
+# The registry is the persistent list of the entities: for every uuid the instances (source, id) and the
+# features used by the resolver (all the names, the developers and the earliest release date).
+# A source is resolved only against the registry, then the registry is updated:
+# - before resolving a source its old instances are removed (entities left without instances are deleted)
+# - the source is resolved against what's left, a game matching no entity gets its previous uuid back (when its
+#   entity has been deleted) so uuids are stable across reindexes
+# - the new instances are added
+# Adding or reindexing a source costs the resolution of that source only, the other indexes are never touched.
+# Like the entity index, the registry records the version of every source index it contains, when an index
+# changes without it (ex. reindexed without the registry) its instances are replaced with the ones in the index.
+
+INDEX_NAME = 'registry'
+
+schema = fields.Schema(
+    uuid=fields.ID(stored=True, unique=True),
+    # Sources with an instance of the entity
+    sources=fields.KEYWORD(),
+    # Instances: list of (source, id, name, devs, date)
+    members=fields.STORED(),
+    # Representative features (same fields and analyzers of the source indexes, check resolver.general_schema)
+    name=fields.TEXT(stored=True, analyzer=keep_numbers_analyzer()),
+    devs=keyword_field(),
+    date=fields.DATETIME(stored=True),
+)
+
+
+def _versions_path(folder: str) -> str:
+    return os.path.join(folder, f"{INDEX_NAME}.sources")
+
+
+def _member(source: str, stored: dict) -> tuple:
+    devs = stored['devs'].split(',') if stored.get('devs') else []
+    return source, stored['id'], stored.get('name') or '', devs, stored.get('date')
+
+
+def _document(uuid: str, members: list[tuple]) -> dict:
+    names = dict.fromkeys(name for _source, _id, name, _devs, _date in members if name)
+    devs = dict.fromkeys(dev for _source, _id, _name, member_devs, _date in members for dev in member_devs)
+    dates = [date for _source, _id, _name, _devs, date in members if date is not None]
+    doc = {
+        'uuid': uuid,
+        'sources': ' '.join(sorted({source for source, *_rest in members})),
+        'members': members,
+        # Multiple names are separated by newlines (check TitleIndex.build)
+        'name': '\n'.join(names),
+        'devs': ','.join(devs),
+    }
+    if len(dates) > 0:
+        doc['date'] = min(dates)
+    return doc
+
+
+class EntityRegistry:
+    def __init__(self, index: Index, folder: str):
+        self.index = index
+        self.folder = folder
+
+    def versions(self) -> Dict[str, int]:
+        """Version of every source index when it was added to the registry"""
+        try:
+            with open(_versions_path(self.folder), 'rt') as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return {}
+
+    def _save_versions(self, versions: Dict[str, int]) -> None:
+        with open(_versions_path(self.folder), 'wt') as fd:
+            json.dump(versions, fd)
+
+    def is_empty(self) -> bool:
+        return self.index.doc_count() == 0
+
+    def refresh(self, indexes: Dict[str, Index]) -> None:
+        """
+        Updates the instances of the source indexes changed without the registry (ex. reindexed without it),
+        sources that are not given are left as they are
+        """
+        versions = self.versions()
+        for name, index in indexes.items():
+            if versions.get(name) != index_version(index):
+                print(f"Updating the entity registry with {name}")
+                self.remove_source(name)
+                self.add_source(name, index)
+
+    @staticmethod
+    def open(storage: Storage, folder: str) -> Optional['EntityRegistry']:
+        if not storage.index_exists(INDEX_NAME):
+            return None
+        index = storage.open_index(indexname=INDEX_NAME)
+        if index.schema != schema:
+            # Built with older analyzers, the resolver queries wouldn't match it
+            return None
+        return EntityRegistry(index, folder)
+
+    @staticmethod
+    def build(storage: Storage, folder: str, indexes: Dict[str, Index]) -> 'EntityRegistry':
+        """
+        Builds the registry from the stored fields of already indexed sources
+        """
+        entities = {}  # type: Dict[str, list[tuple]]
+        for name, index in indexes.items():
+            with index.reader() as reader:
+                for stored in reader.all_stored_fields():
+                    entities.setdefault(stored['uuid'], []).append(_member(name, stored))
+
+        from tqdm import tqdm  # Only to build it, the query path never does
+
+        index = storage.create_index(schema, indexname=INDEX_NAME)
+        with index.writer() as writer:
+            for uuid, members in tqdm(entities.items(), dynamic_ncols=True):
+                writer.add_document(**_document(uuid, members))
+        res = EntityRegistry(index, folder)
+        res._save_versions({name: index_version(ix) for name, ix in indexes.items()})
+        return res
+
+    def remove_source(self, source: str) -> Dict[str, str]:
+        """
+        Removes every instance of a source from the registry
+
+        :return: id -> uuid of the instances whose entity has been deleted (no other instance was left)
+        """
+        previous = {}
+        with self.index.searcher() as searcher:
+            docs = [searcher.stored_fields(docnum) for docnum in searcher.document_numbers(sources=source)]
+        with self.index.writer() as writer:
+            for doc in docs:
+                members = [m for m in doc['members'] if m[0] != source]
+                if len(members) > 0:
+                    writer.update_document(**_document(doc['uuid'], members))
+                    continue
+                writer.delete_by_term('uuid', doc['uuid'])
+                for _source, member_id, *_rest in doc['members']:
+                    previous[member_id] = doc['uuid']
+
+        versions = self.versions()
+        versions.pop(source, None)
+        self._save_versions(versions)
+        return previous
+
+    def add_source(self, source: str, index: Index) -> None:
+        """
+        Adds the instances of a (just resolved) source index to the registry
+        """
+        from tqdm import tqdm
+
+        added = {}  # type: Dict[str, list[tuple]]
+        with index.reader() as reader:
+            for stored in reader.all_stored_fields():
+                added.setdefault(stored['uuid'], []).append(_member(source, stored))
+
+        with self.index.searcher() as searcher, self.index.writer() as writer:
+            for uuid, members in tqdm(added.items(), dynamic_ncols=True):
+                docnum = searcher.document_number(uuid=uuid)
+                if docnum is not None:
+                    old = [m for m in searcher.stored_fields(docnum)['members'] if m[0] != source]
+                    members = old + members
+                writer.update_document(**_document(uuid, members))
+
+        versions = self.versions()
+        versions[source] = index_version(index)
+        self._save_versions(versions)
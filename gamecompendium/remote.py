@@ -0,0 +1,331 @@
+import asyncio
+import base64
+import datetime
+import json
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Callable
+
+import aiohttp
+from aiohttp import web
+from whoosh import query as whoosh_query
+from whoosh.query import Query
+from whoosh.searching import Searcher
+
+from aggregator import _SortedAccess, random_access_scores
+from filters import FilterCache
+from schema_profiles import unpositioned_fields, without_phrases
+from uuid_map import UuidMap, index_version
+
+import serving
+
+# Source servers
+# A source index can be served by its own process (on this host or another one) instead of being opened by the
+# process that runs the queries, so every source gets its own cores (and memory, and page cache).
+# The protocol is JSON over HTTP, one endpoint per call of aggregator.aggregate_search_async:
+#   GET  /info                                          name, index version and document count
+#   POST /sorted  {query, filter, start, count}         rows start..start+count of the sorted access
+#   POST /random  {query, filter, uuids}                docnum and score of the uuids (batched random access)
+#   POST /stored  {docnums}                             stored fields
+# Queries travel as their whoosh object tree (only the query classes the parser emits are decoded, check QUERY_TYPES),
+# they're parsed (with the spelling rewrite and the filter split) by the querying process. The server removes the
+# phrases its own schema can't run, and evaluates the filters with its own bitset cache.
+# The sorted access of the last queries is cached (SORTED_CACHE_SIZE) so the next batch of rows doesn't search
+# from scratch (check aggregator._SortedAccess).
+# SearcherSource has the same interface on an in-process searcher: it's what the server runs, and it lets local and
+# remote sources be mixed in the same query.
+
+DEFAULT_PORT = 8700
+SORTED_CACHE_SIZE = 64
+
+
+def encode_value(value):
+    """JSON-compatible encoding of queries and stored fields"""
+    if isinstance(value, Query):
+        return {'$query': type(value).__name__, 'attrs': {k: encode_value(v) for k, v in value.__dict__.items()}}
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, bytes):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: encode_value(v) for k, v in value.items()}
+    return value
+
+
+_OPT_INT = (int, type(None))
+_NUMBER = (int, float)
+_RANGE = {'fieldname': str, 'startexcl': bool, 'endexcl': bool, 'boost': _NUMBER, 'constantscore': bool,
+          'startchar': _OPT_INT, 'endchar': _OPT_INT}
+_TERM = {'fieldname': str, 'text': (str, bytes), 'boost': _NUMBER, 'startchar': _OPT_INT, 'endchar': _OPT_INT}
+_BINARY = {'a': Query, 'b': Query, 'subqueries': [Query], 'boost': _NUMBER}
+# Query classes the parser emits (with the spelling rewrite, the phrase removal and the filter split), with the types
+# of their attributes ([t] is a list of t). Nothing else is decoded: any whoosh query (a Regex, a FuzzyTerm with a huge
+# maxdist...) or attribute would be run by the server as it's sent.
+QUERY_TYPES = {
+    'Term': (whoosh_query.Term, dict(_TERM, minquality=(int, float, type(None)))),
+    'Prefix': (whoosh_query.Prefix, dict(_TERM, constantscore=bool)),
+    'Wildcard': (whoosh_query.Wildcard, dict(_TERM, constantscore=bool)),
+    'Phrase': (whoosh_query.Phrase, {'fieldname': str, 'words': [str], 'slop': int, 'boost': _NUMBER,
+                                     'char_ranges': (list, type(None))}),
+    'And': (whoosh_query.And, {'subqueries': [Query], 'boost': _NUMBER}),
+    'Or': (whoosh_query.Or, {'subqueries': [Query], 'boost': _NUMBER, 'minmatch': int,
+                             'scale': (int, float, type(None))}),
+    'Not': (whoosh_query.Not, {'query': Query, 'boost': _NUMBER}),
+    'AndNot': (whoosh_query.AndNot, _BINARY),
+    'AndMaybe': (whoosh_query.AndMaybe, _BINARY),
+    'Require': (whoosh_query.Require, _BINARY),
+    'Every': (whoosh_query.Every, {'fieldname': (str, type(None)), 'boost': _NUMBER}),
+    'TermRange': (whoosh_query.TermRange, dict(_RANGE, start=(str, type(None)), end=(str, type(None)))),
+    'NumericRange': (whoosh_query.NumericRange, dict(_RANGE, start=(int, float, type(None)),
+                                                     end=(int, float, type(None)))),
+    '_NullQuery': (type(whoosh_query.NullQuery), {'error': type(None), 'startchar': _OPT_INT, 'endchar': _OPT_INT}),
+}
+
+
+def _decode_query(value: dict) -> Query:
+    if value['$query'] not in QUERY_TYPES:
+        raise ValueError(f"Unsupported query type: {value['$query']}")
+    cls, types = QUERY_TYPES[value['$query']]
+    if not isinstance(value.get('attrs'), dict):
+        raise ValueError(f"Invalid attributes of {value['$query']}")
+    if cls is type(whoosh_query.NullQuery):
+        # A singleton (NullQuery is compared by identity)
+        return whoosh_query.NullQuery
+    attrs = {}
+    for name, encoded in value['attrs'].items():
+        if name not in types:
+            raise ValueError(f"Unsupported attribute of {value['$query']}: {name}")
+        attr = decode_value(encoded)
+        expected = types[name]
+        if isinstance(expected, list):
+            valid = isinstance(attr, list) and all(isinstance(v, expected[0]) for v in attr)
+        else:
+            valid = isinstance(attr, expected)
+        if not valid:
+            raise ValueError(f"Invalid {value['$query']}.{name}: {encoded!r}")
+        attrs[name] = attr
+    q = cls.__new__(cls)
+    q.__dict__.update(attrs)
+    return q
+
+
+def decode_value(value):
+    """Inverse of encode_value, raises ValueError for the queries the parser can't emit (check QUERY_TYPES)"""
+    if isinstance(value, list):
+        return [decode_value(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if '$query' in value:
+        return _decode_query(value)
+    if '$datetime' in value:
+        return datetime.datetime.fromisoformat(value['$datetime'])
+    if '$bytes' in value:
+        return base64.b64decode(value['$bytes'])
+    return {k: decode_value(v) for k, v in value.items()}
+
+
+class SearcherSource:
+    """
+    In-process source of aggregator.aggregate_search_async
+    """
+
+    def __init__(self, searcher: Searcher, name: str, uuid_map: Optional[UuidMap] = None,
+                 filter_cache: Optional[FilterCache] = None):
+        self.searcher = searcher
+        self.name = name
+        self.uuid_map = uuid_map
+        self.filter_cache = filter_cache or FilterCache()
+        self._sorted = OrderedDict()  # type: OrderedDict[str, _SortedAccess]
+
+    def _allow(self, filter_q: Optional[Query]):
+        """:return: (allowed docnums or None for all of them, whether any document is allowed)"""
+        if filter_q is None:
+            return None, True
+        allow = self.filter_cache.docs(self.searcher, filter_q)
+        return allow, allow is not None
+
+    def sorted_page(self, q: Query, filter_q: Optional[Query], start: int, count: int) -> list[tuple[str, int, float]]:
+        allow, any_allowed = self._allow(filter_q)
+        if not any_allowed:
+            return []
+        key = repr((q, filter_q))
+        access = self._sorted.get(key)
+        if access is None:
+            access = self._sorted[key] = _SortedAccess(q, self.searcher, allow)
+            if len(self._sorted) > SORTED_CACHE_SIZE:
+                self._sorted.popitem(last=False)
+        else:
+            self._sorted.move_to_end(key)
+        page = []
+        for i in range(start, start + count):
+            hit = access.hit(i)
+            if hit is None:
+                break
+            page.append((hit['uuid'], hit.docnum, hit.score))
+        return page
+
+    def scores(self, q: Query, filter_q: Optional[Query], uuids: list[str]) -> Dict[str, tuple[int, float]]:
+        allow, any_allowed = self._allow(filter_q)
+        if not any_allowed:
+            return {}
+        found = random_access_scores(q, self.searcher, uuids, self.uuid_map)
+        if allow is not None:
+            found = {uuid: (docnum, score) for uuid, (docnum, score) in found.items() if docnum in allow}
+        return found
+
+    def stored(self, docnums: list[int]) -> list[dict]:
+        return [self.searcher.stored_fields(docnum) for docnum in docnums]
+
+    async def sorted_access(self, q: Query, filter_q: Optional[Query], start: int,
+                            count: int) -> list[tuple[str, int, float]]:
+        return self.sorted_page(q, filter_q, start, count)
+
+    async def random_access(self, q: Query, filter_q: Optional[Query], uuids: list[str]) -> Dict[str, tuple[int, float]]:
+        return self.scores(q, filter_q, uuids)
+
+    async def stored_fields(self, docnums: list[int]) -> list[dict]:
+        return self.stored(docnums)
+
+
+def create_server(index_dir: str, name: str) -> web.Application:
+    """
+    Server of a source index (check the comment at the top), read-only
+    """
+    index = serving.readonly_storage(index_dir).open_index(indexname=name)
+    source = SearcherSource(index.searcher(), name, UuidMap.open(index, index_dir))
+    unpositioned = unpositioned_fields([index.schema])
+
+    async def read_request(request: web.Request) -> tuple[dict, Optional[Query], Optional[Query]]:
+        try:
+            body = await request.json()
+            q = decode_value(body['query']) if 'query' in body else None
+            filter_q = decode_value(body['filter']) if body.get('filter') is not None else None
+        except (ValueError, KeyError, TypeError) as e:
+            raise web.HTTPBadRequest(text=str(e))
+        if q is not None:
+            q = without_phrases(q, unpositioned)
+        return body, q, filter_q
+
+    async def info(_request: web.Request) -> web.Response:
+        return web.json_response({'name': name, 'version': index_version(index),
+                                  'docs': source.searcher.doc_count()})
+
+    async def sorted_access(request: web.Request) -> web.Response:
+        body, q, filter_q = await read_request(request)
+        return web.json_response({'hits': source.sorted_page(q, filter_q, body['start'], body['count'])})
+
+    async def random_access(request: web.Request) -> web.Response:
+        body, q, filter_q = await read_request(request)
+        return web.json_response({'scores': source.scores(q, filter_q, body['uuids'])})
+
+    async def stored_fields(request: web.Request) -> web.Response:
+        body, _q, _filter_q = await read_request(request)
+        return web.json_response({'fields': encode_value(source.stored(body['docnums']))})
+
+    async def close(_app: web.Application):
+        source.searcher.close()
+
+    app = web.Application()
+    app.router.add_get('/info', info)
+    app.router.add_post('/sorted', sorted_access)
+    app.router.add_post('/random', random_access)
+    app.router.add_post('/stored', stored_fields)
+    app.on_cleanup.append(close)
+    return app
+
+
+async def serve(index_dir: str, name: str, host: str = 'localhost', port: int = DEFAULT_PORT,
+                ready: Optional[Callable[[int], None]] = None) -> None:
+    """
+    Serves a source index until cancelled
+
+    :param ready: called with the port once the server accepts connections (port 0 picks a free one)
+    """
+    runner = web.AppRunner(create_server(index_dir, name))
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = runner.addresses[0][1]
+        print(f"Serving {name} on http://{host}:{port}")
+        if ready is not None:
+            ready(port)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def serve_forever(index_dir: str, name: str, host: str, port: int, ready_queue=None) -> None:
+    """Process entry point of serve, the port is put in ready_queue"""
+    asyncio.run(serve(index_dir, name, host, port, None if ready_queue is None else ready_queue.put))
+
+
+class RemoteSearcher:
+    """
+    Client of a source server, a source of aggregator.aggregate_search_async
+    """
+
+    def __init__(self, client: 'RemoteClient', name: str, url: str):
+        self.client = client
+        self.name = name
+        self.url = url.rstrip('/')
+
+    async def _post(self, path: str, body: dict) -> dict:
+        data = json.dumps(body).encode('utf-8')
+        async with self.client.session.post(self.url + path, data=data,
+                                            headers={'Content-Type': 'application/json'}) as resp:
+            resp.raise_for_status()
+            raw = await resp.read()
+        self.client.requests += 1
+        self.client.bytes += len(data) + len(raw)
+        return json.loads(raw)
+
+    def _query_body(self, q: Query, filter_q: Optional[Query]) -> dict:
+        return {'query': encode_value(q), 'filter': None if filter_q is None else encode_value(filter_q)}
+
+    async def sorted_access(self, q: Query, filter_q: Optional[Query], start: int,
+                            count: int) -> list[tuple[str, int, float]]:
+        res = await self._post('/sorted', {**self._query_body(q, filter_q), 'start': start, 'count': count})
+        return [tuple(hit) for hit in res['hits']]
+
+    async def random_access(self, q: Query, filter_q: Optional[Query], uuids: list[str]) -> Dict[str, tuple[int, float]]:
+        res = await self._post('/random', {**self._query_body(q, filter_q), 'uuids': uuids})
+        return {uuid: tuple(found) for uuid, found in res['scores'].items()}
+
+    async def stored_fields(self, docnums: list[int]) -> list[dict]:
+        res = await self._post('/stored', {'docnums': docnums})
+        return decode_value(res['fields'])
+
+
+class RemoteClient:
+    """
+    HTTP client of the source servers, with its own event loop thread: queries are run by synchronous code
+    (the prompt, the evaluation), that might already be inside another event loop
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='remote-client', daemon=True)
+        self._thread.start()
+        self.session = self.run(self._create_session())
+
+    @staticmethod
+    async def _create_session() -> aiohttp.ClientSession:
+        return aiohttp.ClientSession()
+
+    def run(self, coro):
+        """Runs a coroutine in the client loop and waits for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def searcher(self, name: str, url: str) -> RemoteSearcher:
+        return RemoteSearcher(self, name, url)
+
+    def close(self) -> None:
+        self.run(self.session.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -1,5 +1,6 @@
 import datetime
 import sys
+import time
 import traceback
 from typing import List, Dict, Optional, Tuple
 
@@ -13,10 +14,17 @@ from uuid import uuid4
 
 import aggregator
 from analyzers import keep_numbers_analyzer
+from blocking import CandidateGenerator
+from matching import GreedyMatching, AuctionMatching, CANDIDATES
+from schema_profiles import keyword_field
+from title_index import TitleIndex
+from uuid_map import UuidMap
 
 general_schema = Schema(
     name=fields.TEXT(stored=True, analyzer=keep_numbers_analyzer()),
-    devs=fields.KEYWORD(stored=True),
+    devs=keyword_field(),
+    genres=keyword_field(),
+    platforms=keyword_field(),
     date=fields.DATETIME(stored=True),
     summary=fields.TEXT(stored=True),
     storyline=fields.TEXT(stored=True),
@@ -55,26 +63,47 @@ general_schema = Schema(
 # to that game. If there was another game with that same entity but a lower similarity value we select another candidate
 # and to the same, backtracking down until a game is left with no candidates, or until we assign it to an entity without
 # previous contenders.
-# This algorithm is O(N^2) in it's worst case, since each new game could backtrack all of previous selections, but since
-# the graph is really sparse the runtime behaviour approximates O(N).
+# Since a game never goes back to a candidate it has rejected, every edge is visited at most once and the whole
+# pass is O(N * k) (check matching.py, that also has an exact maximum weight matching for comparison).
 
 
 class EntityResolver:
-    def __init__(self, *indexes: Index):
+    def __init__(self, *indexes: Index, uuid_maps: Optional[Dict[str, UuidMap]] = None,
+                 candidates: Optional[CandidateGenerator] = None, titles: Optional[TitleIndex] = None,
+                 exact: bool = False, theta: float = 1.0, max_rows: Optional[int] = None):
         self.indexes = indexes
         self.searchers = [x.searcher() for x in indexes]
-        # UUID -> id, score  (selected edge)
-        self.uuid_to_id = dict()  # type: Dict[str, tuple[object, float]]
-        # id => list[uuid, score]  (candidates, first one must always be the selected edge)
-        self.id_to_uuids = dict()  # type: Dict[object, list[tuple[str, float]]]
+        # Index name -> uuid map of the index (optional, speeds up random access)
+        self.uuid_maps = uuid_maps or {}
+        # Candidate generation stage (optional, check blocking.py)
+        self.candidates = candidates
+        # Title hash index, unambiguous title matches skip the search (optional, check title_index.py)
+        self.titles = titles
+        # Greedy backtracking or maximum weight matching (slower, only for comparisons)
+        self.exact = exact
+        self.matching = AuctionMatching() if exact else GreedyMatching()
+        # Approximate top-k of the candidate search (check aggregator.py), only CANDIDATES entities are needed
+        self.theta = theta
+        self.max_rows = max_rows
+        # id -> uuid given to games that don't match any entity, instead of a new one (used to keep uuids stable)
+        self.previous_ids = {}  # type: Dict[str, str]
         self.generated = 0
         self.reused = 0
+        # Games resolved by scoring only the blocking candidates / by the full search
+        self.blocked = 0
+        self.searched = 0
+        # Games resolved by the title index, total time spent in compute (in seconds)
+        self.fast_path = 0
+        self.elapsed = 0.0
 
     def reset(self):
-        self.uuid_to_id.clear()
-        self.id_to_uuids.clear()
+        self.matching = AuctionMatching() if self.exact else GreedyMatching()
         self.generated = 0
         self.reused = 0
+        self.blocked = 0
+        self.searched = 0
+        self.fast_path = 0
+        self.elapsed = 0.0
 
     def _query_best(self, query: Query) -> list[Tuple[str, float]]:
         """
@@ -83,36 +112,31 @@ class EntityResolver:
         :param query: The query
         :return: a list of tuples (entity UUID, collective score)
         """
-        # We don't care about searcher names
-        searchers = [(s, '') for s in self.searchers]
-        res = aggregator.aggregate_search(query, searchers, k=5)
+        # Names are only used to pick the right uuid map
+        searchers = [(s, ix.indexname) for s, ix in zip(self.searchers, self.indexes)]
+        res = aggregator.aggregate_search(query, searchers, k=CANDIDATES, uuid_maps=self.uuid_maps,
+                                          theta=self.theta, max_rows=self.max_rows)
         return [(r.hits[0][0]['uuid'], r.total_score) for r in res]
 
-    def _backtrack_add_edges(self, cid: object, edges: list[Tuple[str, float]]) -> None:
+    def _score_candidates(self, query: Query, uuids: set[str]) -> list[Tuple[str, float]]:
         """
-        Adds a node cid to the graph, trying all the edges
+        Scores only the given entities with the same aggregation function of aggregator.aggregate_search
 
-        if an edge can override the previous uuid -> id binding it's replaced and the algorithm is
-        executed again to "backtrack" the adds.
-
-        :param cid: id of the node to add (left node)
-        :param edges: list of (uuid, score) (edges to the right nodes)
+        :param query: The query
+        :param uuids: The candidate entities
+        :return: a list of tuples (entity UUID, collective score), at most CANDIDATES
         """
-        while True:
-            while len(edges) > 0 and edges[0][1] <= self.uuid_to_id.get(edges[0][0], (None, -1))[1]:
-                edges = edges[1:]
-
-            if len(edges) <= 0:
-                self.id_to_uuids.pop(cid, None)
-                return
-
-            prev_id = self.uuid_to_id.get(edges[0][0], (None,))[0]
-            self.uuid_to_id[edges[0][0]] = (cid, edges[0][1])
-            self.id_to_uuids[cid] = edges
-            cid = prev_id
-            if cid is None:
-                break
-            edges = self.id_to_uuids[cid]
+        totals = {}  # type: Dict[str, list[float]]
+        for searcher, index in zip(self.searchers, self.indexes):
+            scores = aggregator.random_access_scores(query, searcher, uuids, self.uuid_maps.get(index.indexname))
+            for uuid, (_docnum, score) in scores.items():
+                total = totals.setdefault(uuid, [0.0, 0])
+                total[0] += score
+                total[1] += 1
+        # Like aggregate_search, entities are only found if they match in at least one source
+        res = [(uuid, score / count) for uuid, (score, count) in totals.items() if score > 0]
+        res.sort(key=lambda x: x[1], reverse=True)
+        return res[:CANDIDATES]
 
     def needs_previsit(self) -> bool:
         """
@@ -122,17 +146,17 @@ class EntityResolver:
         """
         return len(self.indexes) > 0
 
-    def compute(self, index_id: object, name: str, dev_companies: List[str], release_date: Optional[datetime.datetime]) -> None:
+    def find_candidates(self, name: str, dev_companies: List[str], release_date: Optional[datetime.datetime]) -> list[Tuple[str, float]]:
         """
-        Adds a game and its info to the system, to calculate the entity, should only be called in the first pass
+        Finds the best entities for a game (without adding it to the graph)
 
-        :param index_id: private id of the index
-        :param name: name of the game
-        :param dev_companies: dev companies (if known, else empty array)
-        :param release_date: release date if known
+        :return: a list of tuples (entity UUID, score), best first
         """
-        if len(self.indexes) == 0:
-            return
+        if self.titles is not None:
+            match = self.titles.match(name, dev_companies, release_date)
+            if match is not None:
+                self.fast_path += 1
+                return [match]
 
         name_parser = QueryParser('name', general_schema, [])
         query = name_parser.parse(name)
@@ -146,23 +170,49 @@ class EntityResolver:
             )
 
         if len(dev_companies) > 0:
-            dev_query = And([Term('devs', x) for x in dev_companies], boost=2)
+            dev_query = And([Term('devs', x.lower()) for x in dev_companies], boost=2)
             query = AndMaybe(
                 query,
                 dev_query,
             )
         query = query.normalize()
 
+        if self.candidates is not None:
+            uuids = self.candidates.candidates(name, dev_companies, release_date)
+            if uuids is not None:
+                res = self._score_candidates(query, uuids)
+                if len(res) > 0:
+                    self.blocked += 1
+                    return res
+
+        # No candidates, run the full search
+        self.searched += 1
+        return self._query_best(query)
+
+    def compute(self, index_id: object, name: str, dev_companies: List[str], release_date: Optional[datetime.datetime]) -> None:
+        """
+        Adds a game and its info to the system, to calculate the entity, should only be called in the first pass
+
+        :param index_id: private id of the index
+        :param name: name of the game
+        :param dev_companies: dev companies (if known, else empty array)
+        :param release_date: release date if known
+        """
+        if len(self.indexes) == 0:
+            return
+
+        start = time.perf_counter()
         try:
-            res = self._query_best(query)
+            res = self.find_candidates(name, dev_companies, release_date)
         except ValueError:
-            print(f"Whoosh exception on query: {repr(query)} on game {index_id}", file=sys.stderr)
+            print(f"Whoosh exception on game {index_id} ({name})", file=sys.stderr)
             traceback.print_exc()
             res = []
 
         # Add node and edges to the graph, select the active edge for the game (if any) and
         # backtrack choices if necessary
-        self._backtrack_add_edges(index_id, res)
+        self.matching.add(index_id, res)
+        self.elapsed += time.perf_counter() - start
 
     def get_id(self, index_id: object) -> str:
         """
@@ -173,10 +223,10 @@ class EntityResolver:
         :param index_id: internal index id of the game
         :return: UUID of the entity
         """
-        gid = self.id_to_uuids.get(index_id, ((None, 0),))[0][0]
+        gid = self.matching.get(index_id)
         if gid is None:
             self.generated += 1
-            gid = uuid4().hex
+            gid = self.previous_ids.pop(str(index_id), None) or uuid4().hex
         else:
             self.reused += 1
         return gid
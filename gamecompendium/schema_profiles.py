@@ -0,0 +1,83 @@
+from typing import Iterable
+
+from whoosh import fields, query
+from whoosh.fields import Schema
+from whoosh.query import Query
+
+from analyzers import keep_numbers_analyzer, capped_analyzer
+
+# Schema profiles of the source indexes
+# storyline and summary are by far the largest fields, but they only have a boost of 1 (check App.create_parser) and
+# they're almost never used in phrase queries, while their positions are most of the size of the postings.
+# A profile chooses how these long fields are indexed (name always keeps its positions):
+# - full: positions, the original schema
+# - frequency: only the term frequencies, no phrase queries on these fields
+# - capped: frequencies of the first LONG_FIELD_TOKENS tokens only (the text is still stored in full)
+# The profile is chosen per source when it's indexed, an existing index is always read with the schema it was
+# built with. Phrase queries on fields without positions are run as AND queries (check without_phrases).
+# genres, platforms and devs are lists joined with commas, keyword_field splits them on the commas (not on spaces,
+# "Free to Play" or "Valve Corporation" are a single keyword) and lowercases them, so `platforms:Linux` matches.
+
+PROFILES = ('full', 'frequency', 'capped')
+DEFAULT_PROFILE = 'full'
+LONG_FIELDS = ('storyline', 'summary')
+LONG_FIELD_TOKENS = 300
+
+
+def long_text_field(profile: str) -> fields.TEXT:
+    if profile == 'full':
+        return fields.TEXT(stored=True)
+    if profile == 'frequency':
+        return fields.TEXT(stored=True, phrase=False)
+    if profile == 'capped':
+        return fields.TEXT(stored=True, phrase=False, analyzer=capped_analyzer(LONG_FIELD_TOKENS))
+    raise ValueError(f"Unknown schema profile: {profile}")
+
+
+def keyword_field(stored: bool = True) -> fields.KEYWORD:
+    """Comma separated list of case-insensitive keywords"""
+    return fields.KEYWORD(stored=stored, commas=True, lowercase=True)
+
+
+def source_schema(profile: str = DEFAULT_PROFILE) -> Schema:
+    """Schema of the source indexes (the same for every source)"""
+    return Schema(
+        id=fields.ID(stored=True, unique=True),
+        uuid=fields.ID(stored=True, unique=True),
+        name=fields.TEXT(stored=True, analyzer=keep_numbers_analyzer()),
+        storyline=long_text_field(profile),
+        summary=long_text_field(profile),
+        genres=keyword_field(),
+        platforms=keyword_field(),
+        devs=keyword_field(),
+        date=fields.DATETIME(stored=True),
+    )
+
+
+def profile_of(schema: Schema) -> str:
+    """Profile of a source index schema, 'custom' if it doesn't match any of them"""
+    for profile in PROFILES:
+        if schema == source_schema(profile):
+            return profile
+    return 'custom'
+
+
+def unpositioned_fields(schemas: Iterable[Schema]) -> set[str]:
+    """Text fields without positions in any of the schemas"""
+    return {name for schema in schemas for name, field in schema.items()
+            if isinstance(field, fields.TEXT) and not field.format.supports('positions')}
+
+
+def without_phrases(q: Query, fieldnames: set[str]) -> Query:
+    """
+    Replaces the phrase queries on the given fields (without positions) with AND queries of their words
+    """
+    if len(fieldnames) == 0:
+        return q
+
+    def replace(node: Query) -> Query:
+        if isinstance(node, query.Phrase) and node.fieldname in fieldnames:
+            return query.And([query.Term(node.fieldname, word) for word in node.words], boost=node.boost)
+        return node
+
+    return q.accept(replace)
@@ -0,0 +1,87 @@
+import os
+from pathlib import Path
+from typing import Iterable
+
+from whoosh.filedb.filestore import FileStorage
+from whoosh.index import Index
+from whoosh.searching import Searcher
+
+# Read-only serving mode
+# When the indexes are only queried (prompt, evaluation workers) they're opened from a read-only storage: no lock
+# files, no sidecar rebuilds, and every segment is memory-mapped (whoosh maps compound segments when the storage
+# supports mmap), so processes serving the same indexes share the OS page cache instead of private buffers.
+# Memory-mapping alone doesn't make the first queries fast: they still fault in the pages of the term dictionaries
+# and of the postings they touch, from disk if the page cache is cold. prefetch loads the hot structures at startup:
+# - the segment files, with a readahead hint to the kernel (asynchronous, it doesn't slow down the startup)
+# - the term dictionaries of the fields every query uses (name, and uuid for random access)
+# - the postings of the most frequent terms of name (the field of almost every query)
+# - the uuid maps (check uuid_map.py)
+# Decoding the postings of the long fields too would take way longer (finding their most frequent terms means
+# scanning their whole lexicon) for nothing: the readahead already brings their pages in memory, and whoosh
+# doesn't cache decoded postings anyway.
+
+PREFETCH_DICTIONARIES = ('name', 'uuid')
+PREFETCH_POSTINGS = ('name',)
+PREFETCH_TOP_TERMS = 200
+
+
+def readonly_storage(index_dir: str) -> FileStorage:
+    if not os.path.isdir(index_dir):
+        raise FileNotFoundError(f"Index folder not found: {index_dir}")
+    return FileStorage(index_dir, supports_mmap=True, readonly=True)
+
+
+def segment_files(index_dir: str, indexname: str) -> list[Path]:
+    return [p for p in Path(index_dir).iterdir() if p.name.startswith(f"{indexname}_") and p.suffix == '.seg']
+
+
+def _advise(paths: Iterable[Path], advice: int) -> None:
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        finally:
+            os.close(fd)
+
+
+def readahead(index_dir: str, indexname: str) -> None:
+    """Asks the kernel to load the segments of an index in the page cache"""
+    if hasattr(os, 'POSIX_FADV_WILLNEED'):
+        _advise(segment_files(index_dir, indexname), os.POSIX_FADV_WILLNEED)
+
+
+def evict(index_dir: str) -> None:
+    """
+    Drops the (clean) pages of all the files in the index folder from the page cache, to measure cold starts
+    without root permissions
+    """
+    if hasattr(os, 'POSIX_FADV_DONTNEED'):
+        _advise((p for p in Path(index_dir).iterdir() if p.is_file()), os.POSIX_FADV_DONTNEED)
+
+
+def prefetch(searcher: Searcher, top_terms: int = PREFETCH_TOP_TERMS) -> int:
+    """
+    Reads the term dictionaries and the postings of the most frequent terms (check the comment at the top)
+
+    :return: number of postings read
+    """
+    reader = searcher.reader()
+    fieldnames = set(searcher.schema.names())
+    for fieldname in PREFETCH_DICTIONARIES:
+        if fieldname in fieldnames:
+            for _term in reader.lexicon(fieldname):
+                pass
+    read = 0
+    for fieldname in PREFETCH_POSTINGS:
+        if fieldname not in fieldnames:
+            continue
+        for _freq, term in reader.most_frequent_terms(fieldname, number=top_terms):
+            read += sum(1 for _ in reader.postings(fieldname, term).all_ids())
+    return read
+
+
+def prefetch_index(index: Index, searcher: Searcher, index_dir: str, top_terms: int = PREFETCH_TOP_TERMS) -> int:
+    readahead(index_dir, index.indexname)
+    return prefetch(searcher, top_terms)
@@ -0,0 +1,354 @@
+import heapq
+import json
+import math
+import os
+import time
+import zlib
+from bisect import bisect_right
+from concurrent.futures import Executor, Future
+from typing import Optional, Dict, Iterable
+
+from whoosh.filedb.filestore import Storage
+from whoosh.idsets import BitSet, DocIdSet
+from whoosh.index import Index
+from whoosh.query import Query
+from whoosh.searching import Searcher
+
+from filters import SegmentedDocSet
+from uuid_map import UuidMap, index_version
+
+import serving
+
+# Sharded sources
+# The sorted access of a source scores every document that matches the query, in a single thread: a big source
+# is as slow as its biggest posting lists.
+# A source can be split in N shard indexes, built from the source index (that stays the reference for entity
+# resolution and the entity index): every document goes to the shard of the hash of its id, so the shards have
+# about the same size and a document never moves between shards while its source is rebuilt.
+# The sorted access searches all the shards at the same time in worker processes (whoosh holds the GIL while
+# scoring), every worker returns its (score, docnum) list and the lists are merged by score in the parent, that's
+# the sorted stream aggregate_search and aggregate_page consume. The searches of all the sources of a query are
+# submitted before the first result is read, so they run in parallel too.
+# Random access stays in the parent (a single document, an IPC round trip would cost more than the scoring): the
+# uuid is looked up in the uuid map of every shard, and the document is scored by the shard that owns it.
+# Docnums of a sharded source are global: the docnums of shard i are offset by the size of the shards before it
+# (like the segments of a whoosh MultiReader), so filters (check filters.py) and cursors work unchanged.
+# Every shard scores with its own statistics (idf, average field length), like the query-then-fetch of the
+# distributed engines: with hash partitioning the shards have the same term distribution, so the scores only
+# differ slightly from the unsharded ones (perf measures the agreement of the top-k).
+#
+# The manifest ({source}.shards, next to the indexes) records the shard count and the version of the source
+# index the shards were built from, shards of an older version are rebuilt (or ignored in read-only mode).
+
+MANIFEST_SUFFIX = '.shards'
+
+
+def shard_names(name: str, count: int) -> list[str]:
+    # Not `{name}_...`, that's the prefix of the segments of the source index
+    return [f"{name}-shard{i}" for i in range(count)]
+
+
+def shard_of(doc_id, count: int) -> int:
+    # Stable across processes and runs, unlike hash()
+    return zlib.crc32(str(doc_id).encode('utf-8')) % count
+
+
+def manifest_path(folder: str, name: str) -> str:
+    return os.path.join(folder, name + MANIFEST_SUFFIX)
+
+
+def _read_manifest(folder: str, name: str) -> Optional[dict]:
+    try:
+        with open(manifest_path(folder, name), 'rt') as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def _remove_index(folder: str, indexname: str) -> None:
+    for entry in os.listdir(folder):
+        if entry.startswith(f"{indexname}_") or entry.startswith(f"_{indexname}_") \
+                or entry == f"{indexname}.uuidmap":
+            os.remove(os.path.join(folder, entry))
+
+
+class _ShardReader:
+    """
+    Segment reader that only shows the documents of a shard, the others look deleted
+    """
+
+    def __init__(self, reader, docnums: set[int]):
+        self._reader = reader
+        self._docnums = docnums
+
+    def __getattr__(self, name: str):
+        return getattr(self._reader, name)
+
+    def has_deletions(self) -> bool:
+        return True
+
+    def is_deleted(self, docnum: int) -> bool:
+        return docnum not in self._docnums
+
+    def all_doc_ids(self):
+        return (docnum for docnum in self._reader.all_doc_ids() if docnum in self._docnums)
+
+    def iter_docs(self):
+        return ((docnum, fields) for docnum, fields in self._reader.iter_docs() if docnum in self._docnums)
+
+
+def build_shards(storage: Storage, folder: str, index: Index, count: int) -> list[Index]:
+    """
+    Splits the documents of a source index in count shard indexes (check the comment at the top)
+    """
+    name = index.indexname
+    shards = [storage.create_index(index.schema, indexname=shard_name) for shard_name in shard_names(name, count)]
+    writers = [shard.writer() for shard in shards]
+    fieldnames = set(index.schema.names())
+    try:
+        with index.reader() as reader:
+            for segment_reader, _offset in reader.leaf_readers():
+                owners = {}  # type: Dict[int, int]
+                for docnum, fields in segment_reader.iter_docs():
+                    owners[docnum] = shard_of(fields['id'], count)
+                # Same as writer.add_reader (a segment merge: the text isn't analyzed again), but the postings of
+                # the segment are read once for all the shards
+                docmaps = []
+                for i, writer in enumerate(writers):
+                    docnums = {docnum for docnum, owner in owners.items() if owner == i}
+                    docmaps.append(writer.write_per_doc(fieldnames, _ShardReader(segment_reader, docnums)))
+                    writer._added = True
+                for fieldname, text, docnum, weight, value in segment_reader.iter_postings():
+                    i = owners[docnum]
+                    writers[i].pool.add((fieldname, text, docmaps[i][docnum], weight, value))
+    except BaseException:
+        for writer in writers:
+            writer.cancel()
+        raise
+    for writer in writers:
+        writer.commit()
+
+    # Shards of a previous (bigger) count
+    previous = _read_manifest(folder, name)
+    if previous is not None:
+        for shard_name in shard_names(name, previous['count'])[count:]:
+            _remove_index(folder, shard_name)
+    tmp_path = manifest_path(folder, name) + '.tmp'
+    with open(tmp_path, 'wt') as fd:
+        json.dump({'count': count, 'version': index_version(index)}, fd)
+    os.replace(tmp_path, manifest_path(folder, name))
+    return [storage.open_index(indexname=shard_name) for shard_name in shard_names(name, count)]
+
+
+def open_shards(storage: Storage, folder: str, index: Index, count: int) -> Optional[list[Index]]:
+    """
+    Opens the shards of a source index, None if they're missing, out of date or of another count
+    """
+    manifest = _read_manifest(folder, index.indexname)
+    if manifest is None or manifest['count'] != count or manifest['version'] != index_version(index):
+        return None
+    names = shard_names(index.indexname, count)
+    if not all(storage.index_exists(shard_name) for shard_name in names):
+        return None
+    return [storage.open_index(indexname=shard_name) for shard_name in names]
+
+
+def open_or_build_shards(storage: Storage, folder: str, index: Index, count: int) -> list[Index]:
+    shards = open_shards(storage, folder, index, count)
+    if shards is None:
+        shards = build_shards(storage, folder, index, count)
+    return shards
+
+
+# Worker processes, every worker opens (read-only) all the shards it might be asked to search
+_worker_searchers = {}  # type: Dict[str, Searcher]
+
+
+def _init_worker(index_dir: str, names: list[str]) -> None:
+    storage = serving.readonly_storage(index_dir)
+    for shard_name in names:
+        _worker_searchers[shard_name] = storage.open_index(indexname=shard_name).searcher()
+
+
+def _search_shard(shard_name: str, query: Query, limit, allow: Optional[DocIdSet]) -> list[tuple[float, int]]:
+    results = _worker_searchers[shard_name].search(query, limit=limit, filter=allow)
+    return results.top_n
+
+
+def create_pool(index_dir: str, names: list[str], workers: int) -> Executor:
+    """
+    Worker processes searching the shards with the given names
+    """
+    # Imports multiprocessing, only sharded searches need it
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(index_dir, names))
+
+
+class ShardHit:
+    """Hit of a sharded sorted access, with the global docnum"""
+
+    def __init__(self, searcher: 'ShardedSearcher', docnum: int, score: float):
+        self.searcher = searcher
+        self.docnum = docnum
+        self.score = score
+        self._fields = None
+
+    def fields(self) -> dict:
+        if self._fields is None:
+            self._fields = self.searcher.stored_fields(self.docnum)
+        return self._fields
+
+    def __getitem__(self, fieldname: str):
+        return self.fields()[fieldname]
+
+    def get(self, fieldname: str, default=None):
+        return self.fields().get(fieldname, default)
+
+
+class ShardedResults:
+    """
+    Sorted access of a sharded source, the shard results are merged on the first read (check the comment at the top)
+    """
+
+    def __init__(self, searcher: 'ShardedSearcher', futures: list[tuple[int, Future]]):
+        self.searcher = searcher
+        self._futures = futures
+        self._top = None  # type: Optional[list[tuple[float, int]]]
+
+    def _merged(self) -> list[tuple[float, int]]:
+        if self._top is None:
+            streams = [[(score, docnum + self.searcher.offsets[i]) for score, docnum in future.result()]
+                       for i, future in self._futures]
+            self._top = list(heapq.merge(*streams, key=lambda hit: -hit[0]))
+            self._futures = []
+        return self._top
+
+    def scored_length(self) -> int:
+        return len(self._merged())
+
+    def __len__(self) -> int:
+        return len(self._merged())
+
+    def __getitem__(self, i: int) -> ShardHit:
+        score, docnum = self._merged()[i]
+        return ShardHit(self.searcher, docnum, score)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class ShardedUuidMap:
+    """uuid -> global docnum of a sharded source, asks the uuid map of every shard"""
+
+    def __init__(self, searcher: 'ShardedSearcher'):
+        self.searcher = searcher
+
+    def document_number(self, uuid: str) -> Optional[int]:
+        return self.searcher.document_number(uuid=uuid)
+
+
+class ShardedSearcher:
+    """
+    Searcher of the shards of a source, it has the subset of the whoosh Searcher interface used by the aggregator,
+    the filters and the entity index
+    """
+
+    def __init__(self, name: str, indexes: list[Index], uuid_maps: list[Optional[UuidMap]], pool: Executor):
+        self.name = name
+        self.shard_names = [index.indexname for index in indexes]
+        self.searchers = [index.searcher() for index in indexes]
+        self.schema = self.searchers[0].schema
+        self.offsets = [0]
+        for searcher in self.searchers:
+            self.offsets.append(self.offsets[-1] + searcher.doc_count_all())
+        self.shard_maps = uuid_maps
+        self.uuid_map = ShardedUuidMap(self)
+        self._pool = pool
+
+    def doc_count_all(self) -> int:
+        return self.offsets[-1]
+
+    def leaf_searchers(self) -> Iterable[tuple[Searcher, int]]:
+        for i, searcher in enumerate(self.searchers):
+            for subsearcher, offset in searcher.leaf_searchers():
+                yield subsearcher, self.offsets[i] + offset
+
+    def context(self, **kwargs):
+        # Every shard has the same weighting
+        return self.searchers[0].context(**kwargs)
+
+    def _shard(self, docnum: int) -> int:
+        return bisect_right(self.offsets, docnum) - 1
+
+    def stored_fields(self, docnum: int) -> dict:
+        i = self._shard(docnum)
+        return self.searchers[i].stored_fields(docnum - self.offsets[i])
+
+    def document_number(self, uuid: str) -> Optional[int]:
+        for i, searcher in enumerate(self.searchers):
+            if self.shard_maps[i] is not None:
+                docnum = self.shard_maps[i].document_number(uuid)
+            else:
+                docnum = searcher.document_number(uuid=uuid)
+            if docnum is not None:
+                return docnum + self.offsets[i]
+        return None
+
+    def _shard_allow(self, allow: DocIdSet, i: int) -> Optional[DocIdSet]:
+        """Allowed docnums of a shard (local), None if the shard has none"""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        if isinstance(allow, SegmentedDocSet):
+            parts = [(offset - start, bits) for offset, bits in allow.parts if start <= offset < end]
+            return SegmentedDocSet(parts) if len(parts) > 0 else None
+        bits = BitSet((docnum - start for docnum in allow if start <= docnum < end), size=end - start)
+        return bits if len(bits) > 0 else None
+
+    def search(self, query: Query, limit=10, filter: Optional[DocIdSet] = None) -> ShardedResults:
+        if limit is None:
+            limit = math.inf
+        futures = []
+        for i, shard_name in enumerate(self.shard_names):
+            allow = None
+            if filter is not None:
+                allow = self._shard_allow(filter, i)
+                if allow is None:
+                    # An empty filter would disable the filtering in whoosh
+                    continue
+            futures.append((i, self._pool.submit(_search_shard, shard_name, query, limit, allow)))
+        return ShardedResults(self, futures)
+
+    def close(self) -> None:
+        for searcher in self.searchers:
+            searcher.close()
+
+
+def _benchmark(folder: str, name: str, queries: list[str], counts: list[int], repeat: int = 5):
+    """
+    Micro-benchmark: sorted access of a source index split in a growing number of shards
+    """
+    from whoosh.filedb.filestore import FileStorage
+    from whoosh.qparser import QueryParser
+
+    storage = FileStorage(folder)
+    index = storage.open_index(indexname=name)
+    parser = QueryParser('name', index.schema)
+    parsed = [parser.parse(q) for q in queries]
+    for count in counts:
+        shards = open_or_build_shards(storage, folder, index, count)
+        with create_pool(folder, [s.indexname for s in shards], count) as pool:
+            searcher = ShardedSearcher(name, shards, [UuidMap.open_or_build(s, folder) for s in shards], pool)
+            searcher.search(parsed[0], limit=None).scored_length()  # Starts the workers
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for q in parsed:
+                    searcher.search(q, limit=None).scored_length()
+            elapsed = (time.perf_counter() - start) / (repeat * len(parsed))
+            searcher.close()
+        print(f"{count} shards: {elapsed * 1e3:.2f}ms per sorted access")
+
+
+if __name__ == '__main__':
+    # python shards.py indexes steam 1,2,4,8 "dark souls" zelda
+    import sys
+    _benchmark(sys.argv[1], sys.argv[2], sys.argv[4:], [int(c) for c in sys.argv[3].split(',')])
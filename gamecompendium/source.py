@@ -1,9 +1,12 @@
-from typing import Protocol
+import importlib
+from typing import Protocol, Optional
 
 from whoosh.fields import Schema
 from whoosh.index import FileIndex
 
+from progress import ProgressReporter
 from resolver import EntityResolver
+from schema_profiles import source_schema, DEFAULT_PROFILE
 
 
 class Source(Protocol):
@@ -14,13 +17,52 @@ class Source(Protocol):
     schema: Schema
     """Schema of the IR system"""
 
-    async def scrape(self, update: bool) -> None:
-        """Download the data and store it for later"""
+    async def scrape(self, update: bool, progress: Optional[ProgressReporter] = None) -> None:
+        """
+        Download the data and store it for later
+
+        Sources are scraped concurrently, progress should only be reported through the given reporter."""
 
-    async def reindex(self, index: FileIndex, resolver: EntityResolver) -> None:
+    async def reindex(self, index: FileIndex, resolver: EntityResolver,
+                      progress: Optional[ProgressReporter] = None) -> None:
         """
         Use previously downloaded data to create an index
 
-        If there is no scraped data, it should be downloaded too."""
+        If there is no scraped data, it should be downloaded too.
+        The CPU-bound part (parsing, entity resolution and writing) should run in an executor with
+        async_utils.run_in_executor, so that other sources can be scraped and indexed in the meantime."""
+
+
+class LazySource(Source):
+    """
+    Source whose module is imported only when it has to scrape or index
+
+    Source modules pull in their scraping dependencies (aiohttp, dateparser, the API credentials...), that query-only
+    modes never need: the name and the schema are enough to open an existing index.
+    """
+
+    def __init__(self, name: str, module: str, class_name: str, profile: str = DEFAULT_PROFILE, **kwargs):
+        self.name = name
+        # All the sources share the same schema (check schema_profiles.py)
+        self.schema = source_schema(profile)
+        self.module = module
+        self.class_name = class_name
+        self.kwargs = dict(kwargs, profile=profile)
+        self._source = None  # type: Optional[Source]
+
+    def load(self) -> Source:
+        if self._source is None:
+            cls = getattr(importlib.import_module(self.module), self.class_name)
+            self._source = cls(**self.kwargs)
+        return self._source
+
+    async def scrape(self, update: bool, progress: Optional[ProgressReporter] = None) -> None:
+        await self.load().scrape(update, progress)
 
+    async def reindex(self, index: FileIndex, resolver: EntityResolver,
+                      progress: Optional[ProgressReporter] = None) -> None:
+        await self.load().reindex(index, resolver, progress)
 
+    def __getstate__(self) -> dict:
+        # Worker processes import the module again only if they need it
+        return dict(self.__dict__, _source=None)
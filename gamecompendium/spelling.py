@@ -0,0 +1,299 @@
+import bisect
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from collections import Counter
+from typing import Optional, Dict
+
+from whoosh import query
+from whoosh.index import Index
+from whoosh.query import Query
+
+from completion import StringTable, string_offsets, completion_version
+
+# Typo tolerance
+# "skyrm" or "witcher 3 wild hnt" find nothing (or the wrong games): the words aren't in the name vocabulary.
+# whoosh has FuzzyTerm, but it computes the edit distance of the word from every term of the field (it walks the
+# whole term dictionary), at every query.
+# The spelling index is a character trigram index over the vocabulary of the text fields (name, storyline, summary)
+# of all the sources, built with the indexes: a word can only be within N edits of a term if they share most of
+# their trigrams (an edit changes at most 3 of them, a transposition 4), so the trigram postings give a few candidates
+# and the exact (Damerau-Levenshtein) distance is only computed for them.
+# Query terms of the text fields that are in none of them are rewritten as an OR of the original term and of its
+# closest terms (at most MAX_CORRECTIONS, fewer edits first, then the most frequent), corrections have a lower boost
+# than the words typed correctly. A word that is only in the descriptions is spelled correctly too: it's never
+# rewritten. Short words and numbers are never corrected, there are too many terms one edit away from them.
+#
+# The sidecar is a flat file in the index folder, memory-mapped like the completion index (check completion.py):
+#   header: magic (with the format version), version of the source indexes, term count, trigram count, posting count
+#   terms: offsets[terms + 1], document frequency[terms]  (sorted)
+#   trigrams: offsets[trigrams + 1], posting offsets[trigrams + 1]  (sorted)
+#   postings: term ids
+#   blobs: terms, trigrams  (UTF-8)
+
+HEADER = struct.Struct('=4s4xqIII4x')
+# The first format only had the name vocabulary
+MAGIC = b'GCS2'
+SIDECAR_NAME = 'spelling.bin'
+CORRECTED_FIELDS = ('name', 'storyline', 'summary')
+MIN_LENGTH = 4
+MAX_CORRECTIONS = 3
+CORRECTION_BOOST = 0.5
+CACHE_SIZE = 4096
+
+
+def max_edits(word: str) -> int:
+    return 1 if len(word) <= 7 else 2
+
+
+def trigrams(word: str) -> set[str]:
+    word = f" {word} "
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Damerau-Levenshtein distance (optimal string alignment), limit + 1 if it's over the limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return min(prev[-1], limit + 1)
+
+
+def sidecar_path(folder: str) -> str:
+    return os.path.join(folder, SIDECAR_NAME)
+
+
+def _int_count(term_count: int, trigram_count: int, posting_count: int) -> int:
+    return term_count * 2 + 1 + (trigram_count + 1) * 2 + posting_count
+
+
+def _is_correctable(word: str) -> bool:
+    return len(word) >= MIN_LENGTH and not any(c.isdigit() for c in word)
+
+
+class SpellingIndex:
+    """
+    Read-only trigram index of the text vocabulary (check the comment at the top)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as fd:
+            self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version, term_count, trigram_count, posting_count = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"Invalid spelling index: {path}")
+        self._data = memoryview(self._mmap)
+        size = _int_count(term_count, trigram_count, posting_count) * 4
+        ints = self._data[HEADER.size:HEADER.size + size].cast('I')
+        self._views = [ints]
+        pos = 0
+
+        def take(n: int) -> memoryview:
+            nonlocal pos
+            pos += n
+            self._views.append(ints[pos - n:pos])
+            return self._views[-1]
+
+        self._terms = StringTable(self._data, take(term_count + 1))
+        self._frequencies = take(term_count)
+        self._trigrams = StringTable(self._data, take(trigram_count + 1))
+        self._posting_offsets = take(trigram_count + 1)
+        self._postings = take(posting_count)
+        self._cache = {}  # type: Dict[str, list[tuple[str, int]]]
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def _term_id(self, word: bytes) -> Optional[int]:
+        i = bisect.bisect_left(self._terms, word)
+        return i if i < len(self._terms) and self._terms[i] == word else None
+
+    def frequency(self, word: str) -> int:
+        """Number of (document, field) pairs with the word in the corrected fields (in all the sources)"""
+        i = self._term_id(word.encode('utf-8'))
+        return 0 if i is None else self._frequencies[i]
+
+    def _postings_of(self, trigram: str) -> memoryview:
+        key = trigram.encode('utf-8')
+        i = bisect.bisect_left(self._trigrams, key)
+        if i == len(self._trigrams) or self._trigrams[i] != key:
+            return self._postings[0:0]
+        return self._postings[self._posting_offsets[i]:self._posting_offsets[i + 1]]
+
+    def _find_corrections(self, word: str) -> list[tuple[str, int]]:
+        limit = max_edits(word)
+        grams = trigrams(word)
+        # Every edit changes at most 3 trigrams, a transposition ("protal") 4
+        min_shared = max(1, len(grams) - 4 * limit)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._postings_of(gram))
+        found = []
+        for term_id, count in shared.items():
+            if count < min_shared:
+                continue
+            term = self._terms[term_id].decode('utf-8')
+            distance = edit_distance(word, term, limit)
+            if distance <= limit:
+                found.append((distance, -self._frequencies[term_id], term))
+        found.sort()
+        return [(term, distance) for distance, _freq, term in found[:MAX_CORRECTIONS]]
+
+    def corrections(self, word: str) -> list[tuple[str, int]]:
+        """
+        Closest terms of a word that isn't in the vocabulary
+
+        :return: (term, edit distance), empty if the word is known or it isn't worth correcting
+        """
+        if not _is_correctable(word) or self.frequency(word) > 0:
+            return []
+        res = self._cache.get(word)
+        if res is None:
+            res = self._find_corrections(word)
+            if len(self._cache) >= CACHE_SIZE:
+                self._cache.clear()
+            self._cache[word] = res
+        return res
+
+    def rewrite(self, q: Query) -> Query:
+        """
+        Adds the corrections of the misspelled terms to the query (check the comment at the top)
+        """
+        def replace(node: Query) -> Query:
+            if not isinstance(node, query.Term) or node.fieldname not in CORRECTED_FIELDS \
+                    or not isinstance(node.text, str):
+                return node
+            corrections = self.corrections(node.text)
+            if len(corrections) == 0:
+                return node
+            alternatives = [query.Term(node.fieldname, term, boost=node.boost * CORRECTION_BOOST ** distance)
+                            for term, distance in corrections]
+            return query.Or([node] + alternatives)
+
+        return q.accept(replace)
+
+    @staticmethod
+    def build(indexes: Dict[str, Index], path: str) -> None:
+        """
+        Writes the spelling sidecar of the current version of the indexes
+        """
+        frequencies = Counter()
+        for index in indexes.values():
+            with index.reader() as reader:
+                for field in CORRECTED_FIELDS:
+                    if field not in reader.schema:
+                        continue
+                    for term, info in reader.iter_field(field):
+                        frequencies[term.decode('utf-8')] += info.doc_frequency()
+        terms = sorted(frequencies)
+        postings = {}  # type: Dict[str, list[int]]
+        for term_id, term in enumerate(terms):
+            if _is_correctable(term):
+                for gram in trigrams(term):
+                    postings.setdefault(gram, []).append(term_id)
+        grams = sorted(postings, key=lambda g: g.encode('utf-8'))
+
+        term_blobs = [t.encode('utf-8') for t in terms]
+        gram_blobs = [g.encode('utf-8') for g in grams]
+        posting_count = sum(len(p) for p in postings.values())
+        blob_start = HEADER.size + _int_count(len(terms), len(grams), posting_count) * 4
+        term_offsets = string_offsets(term_blobs, blob_start)
+        gram_offsets = string_offsets(gram_blobs, term_offsets[-1])
+        posting_offsets = array('I', [0])
+        for gram in grams:
+            posting_offsets.append(posting_offsets[-1] + len(postings[gram]))
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fd:
+            fd.write(HEADER.pack(MAGIC, completion_version(indexes), len(terms), len(grams), posting_count))
+            term_offsets.tofile(fd)
+            array('I', (frequencies[t] for t in terms)).tofile(fd)
+            gram_offsets.tofile(fd)
+            posting_offsets.tofile(fd)
+            for gram in grams:
+                array('I', postings[gram]).tofile(fd)
+            fd.write(b''.join(term_blobs))
+            fd.write(b''.join(gram_blobs))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def open(indexes: Dict[str, Index], folder: str) -> Optional['SpellingIndex']:
+        """
+        Opens the spelling sidecar, None if it's missing or out of date (or of an older format)
+        """
+        path = sidecar_path(folder)
+        if not os.path.exists(path):
+            return None
+        try:
+            spelling = SpellingIndex(path)
+        except ValueError:
+            return None
+        if spelling.version == completion_version(indexes):
+            return spelling
+        spelling.close()
+        return None
+
+    @staticmethod
+    def open_or_build(indexes: Dict[str, Index], folder: str) -> 'SpellingIndex':
+        spelling = SpellingIndex.open(indexes, folder)
+        if spelling is not None:
+            return spelling
+        path = sidecar_path(folder)
+        SpellingIndex.build(indexes, path)
+        return SpellingIndex(path)
+
+    def close(self) -> None:
+        self._terms = self._trigrams = None
+        self._frequencies = self._posting_offsets = self._postings = None
+        for view in reversed(self._views):
+            view.release()
+        self._data.release()
+        self._mmap.close()
+
+
+def _benchmark(folder: str, words: list[str], repeat: int = 100):
+    """
+    Micro-benchmark: corrections of the spelling index against whoosh FuzzyTerm on the text fields of every index
+    """
+    from whoosh.filedb.filestore import FileStorage
+    from app import SOURCE_CLASSES
+
+    storage = FileStorage(folder)
+    indexes = {name: storage.open_index(name) for name in SOURCE_CLASSES if storage.index_exists(name)}
+    spelling = SpellingIndex(sidecar_path(folder))
+    for word in words:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            spelling._find_corrections(word)
+        trigram_time = (time.perf_counter() - start) / repeat
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fuzzy = set()
+            for index in indexes.values():
+                with index.searcher() as searcher:
+                    for field in CORRECTED_FIELDS:
+                        fuzzy.update(query.FuzzyTerm(field, word, maxdist=max_edits(word))
+                                     .expanded_terms(searcher.reader()))
+        fuzzy_time = (time.perf_counter() - start) / repeat
+        print(f"{word!r}: trigrams {trigram_time * 1e3:.2f}ms {spelling._find_corrections(word)}, "
+              f"FuzzyTerm {fuzzy_time * 1e3:.2f}ms ({len(fuzzy)} terms)")
+
+
+if __name__ == '__main__':
+    # python spelling.py indexes skyrm wicher
+    _benchmark(sys.argv[1], sys.argv[2:])
@@ -1,37 +1,44 @@
 import asyncio
 import json
+import os
 import sys
 import traceback
 import warnings
 from pathlib import Path
-from typing import TextIO, Optional
+from typing import TextIO, Optional, Iterator
 
 import aiohttp
-import dateparser
 import gzip
-from tqdm import tqdm
 
-from whoosh import fields
-from whoosh.fields import Schema
 from whoosh.index import Index, FileIndex
 import datetime
-import re
 
 from whoosh.writing import IndexWriter
 
-from analyzers import keep_numbers_analyzer
-from async_utils import soft_log_exceptions
+from html_text import html_to_text, TextStats
+from async_utils import soft_log_exceptions, run_in_executor
 from config import config
+from http_cache import CacheMiss, DAY, get_cache, request_key
 from rate_limiter import RateLimiter, RateLimitExceedException
+from progress import ProgressReporter, ProgressChannel
 from resolver import EntityResolver
+from schema_profiles import source_schema, DEFAULT_PROFILE
 from source import Source
 
 STORAGE_NAME = 'steam'
 
+# Endpoints and limits can be changed in config.toml, only to scrape a local mock server (check mock_apis.py)
+API_CONFIG = config.get('api', {})
 # Steam says 100'000 a day, but it seems to use much lower limits
-REQUESTS_PER_MINUTE = 40
-DUMP_LIST_PATH = 'dumps/steam_list.json'
-DUMP_PATH = 'dumps/steam.dump'
+REQUESTS_PER_MINUTE = API_CONFIG.get('steam_requests_per_minute', 40)
+DUMP_DIR = 'dumps'
+DUMP_LIST_FILE = 'steam_list.json'
+DUMP_FILE = 'steam.dump'
+# Games to index, with the descriptions as plain text (check clean_games)
+CLEAN_DUMP_FILE = 'steam.clean.dump'
+CLEAN_HEADER_SIZE = 256
+# Format version of the cleaned dump, cleaned dumps of other versions are written again
+CLEAN_VERSION = 2
 DUMP_KEEP_KEYS = {'type', 'name', 'steam_appid', 'required_age', 'is_free', 'detailed_description', 'about_the_game',
                   'short_description', 'supported_languages', 'website', 'developers', 'price_overview',
                   'platforms', 'metacritic', 'categories', 'genres', 'recommendations', 'release_date',
@@ -41,46 +48,57 @@ ONLY_KNOWN_GAMES = not config['download_full']
 # Number of recommendations required to be a 'known game'
 ONLY_KNOWN_GAMES_CUTOFF = 1000
 
-schema = Schema(
-    id=fields.ID(stored=True, unique=True),
-    uuid=fields.ID(stored=True, unique=True),
-    name=fields.TEXT(stored=True, analyzer=keep_numbers_analyzer()),
-    storyline=fields.TEXT(stored=True),
-    summary=fields.TEXT(stored=True),
-    genres=fields.KEYWORD(stored=True),
-    platforms=fields.KEYWORD(stored=True),
-    devs=fields.KEYWORD(stored=True),
-    date=fields.DATETIME(stored=True),
-)
+schema = source_schema()
+
+
+APP_LIST_URL = API_CONFIG.get('steam_api', 'https://api.steampowered.com') + '/ISteamApps/GetAppList/v0002'
+APP_DETAILS_URL = API_CONFIG.get('steam_store', 'https://store.steampowered.com') + '/api/appdetails'
+# How long the cached responses are valid (check http_cache.py): new games are added every day, but the details
+# of a game rarely change
+CACHE_TTLS = {
+    APP_LIST_URL: DAY,
+    APP_DETAILS_URL: 30 * DAY,
+}
+
 
+async def load_json(session: aiohttp.ClientSession, url: str, params: dict = None,
+                    limiter: Optional[RateLimiter] = None) -> dict:
+    """
+    Downloads a JSON response, or reads it from the response cache (cache hits don't wait for the limiter)
+    """
+    async def fetch() -> bytes:
+        async with session.get(url=url, params=params) as response:
+            if not 200 <= response.status < 300:
+                # Steam has... weird things, seems like even if you respect their limits you'll still be
+                # temporarly banned
+                if response.status in [429, 403]:
+                    raise RateLimitExceedException()
+                raise Exception(f"Error {url} {params}, returned {response.status}: {await response.read()}")
+            return await response.read()
 
-async def load_json(session: aiohttp.ClientSession, url: str, params: dict = None) -> dict:
-    async with session.get(url=url, params=params) as response:
-        if not 200 <= response.status < 300:
-            # Steam has... weird things, seems like even if you respect their limits you'll still be temporarly banned
-            if response.status in [429, 403]:
-                raise RateLimitExceedException()
-            raise Exception(f"Error {url} {params}, returned {response.status}: {await response.read()}")
-        return json.loads(await response.read())
+    return await get_cache().load(request_key('GET', url, params), fetch if limiter is None else
+                                  lambda: limiter.execute(fetch), ttl=CACHE_TTLS.get(url), validate=json.loads)
 
 
-async def dump_steam(update: bool = False):
+async def dump_steam(dump_dir: str = DUMP_DIR, update: bool = False, progress: Optional[ProgressReporter] = None):
     """
     Dumps the steam API into a gzipped file, this is required since Steam has strict API limits and we don't
     want to hit them,
     """
+    if progress is None:
+        progress = ProgressReporter(STORAGE_NAME)
 
     async def load_list() -> list[int]:
-        path = Path(DUMP_LIST_PATH)
+        path = Path(dump_dir) / DUMP_LIST_FILE
         if not update and path.is_file():
             with path.open('rt') as fd:
                 return json.load(fd)
         else:
-            data = await limiter.execute(
-                lambda: load_json(session, 'https://api.steampowered.com/ISteamApps/GetAppList/v0002'))
+            data = await load_json(session, APP_LIST_URL, limiter=limiter)
             games = data['applist']['apps']
             # Format: list[{"appid": str, "name": str}]
             games = [g['appid'] for g in games]
+            path.parent.mkdir(parents=True, exist_ok=True)
             with path.open('wt') as fd:
                 json.dump(games, fd)
             return games
@@ -91,7 +109,10 @@ async def dump_steam(update: bool = False):
     async def load_game(appid: int):
         try:
             try:
-                details = await limiter.execute(lambda: load_json(session, 'https://store.steampowered.com/api/appdetails', {'appids': appid}))
+                details = await load_json(session, APP_DETAILS_URL, {'appids': appid}, limiter)
+            except CacheMiss:
+                # Offline, the game will be downloaded by the next online scrape
+                return
             except json.decoder.JSONDecodeError:
                 # Invalid json file returned
                 file_add({'steam_appid': appid, 'failed': True})
@@ -115,7 +136,7 @@ async def dump_steam(update: bool = False):
         finally:
             progress.update(1)
 
-    dump_path = Path(DUMP_PATH)
+    dump_path = Path(dump_dir) / DUMP_FILE
 
     async with aiohttp.ClientSession() as session, \
             RateLimiter(REQUESTS_PER_MINUTE / 60, 2) as limiter:
@@ -133,11 +154,9 @@ async def dump_steam(update: bool = False):
         games = list(all_games - completed_games)
         if len(games) == 0:
             return len(all_games)
-        print(f"Downloading: {len(games)} games")
-
         dump_path.parent.mkdir(parents=True, exist_ok=True)
-        with gzip.open(dump_path, 'at') as fd, \
-                tqdm(total=len(all_games), initial=len(completed_games), dynamic_ncols=True) as progress:
+        progress.start(f"downloading {len(games)} games", total=len(all_games), initial=len(completed_games))
+        with gzip.open(dump_path, 'at') as fd:
             BATCH_SIZE = 1000
             # Make requests in batches so that we don't fill RAM with futures
             for i in range(0, len(games), BATCH_SIZE):
@@ -145,20 +164,23 @@ async def dump_steam(update: bool = False):
                 await asyncio.gather(*[
                     soft_log_exceptions(load_game(g)) for g in batch
                 ])
+        progress.close()
     return len(all_games)
 
 
-async def require_dump(update: bool) -> tuple[int, TextIO]:
+async def require_dump(dump_dir: str, update: bool, progress: Optional[ProgressReporter] = None) -> tuple[int, TextIO]:
     # Replace the next line with some game count estimate
     # to skip the dump check/completion
-    count = await dump_steam(update)
+    count = await dump_steam(dump_dir, update, progress)
 
-    return count, gzip.open(DUMP_PATH, 'rt')
+    return count, gzip.open(Path(dump_dir) / DUMP_FILE, 'rt')
 
 
 def parse_date(date: dict) -> Optional[datetime.datetime]:
     if date['coming_soon'] or date['date'] == '':
         return None
+    # dateparser takes a while to import, only the cleaning stage needs it
+    import dateparser
     raw_date = date['date']
     try:
         date = dateparser.parse(raw_date)
@@ -169,76 +191,156 @@ def parse_date(date: dict) -> Optional[datetime.datetime]:
     return date
 
 
-def index_games(gamedb: TextIO, gamecount: int, writer: Optional[IndexWriter], resolver: EntityResolver):
-    with tqdm(total=gamecount) as progress:
-        games = set()
-        for line in gamedb:
-            line = line.strip()
-            if line == "":
-                continue
+def clean_games(gamedb: TextIO, gamecount: int, out: TextIO, progress: ProgressChannel) -> tuple[int, TextStats]:
+    """
+    Text normalization stage: filters the games to index and writes them with plain-text descriptions and parsed dates
 
-            progress.update(1)
+    :return: number of games written, text stats
+    """
+    progress.start("cleaning descriptions", total=gamecount)
+    stats = TextStats()
+    games = set()
+    for line in gamedb:
+        line = line.strip()
+        if line == "":
+            continue
+
+        progress.update(1)
+
+        game = json.loads(line)
+
+        if game.get('name', '') == '':
+            continue  # Yes, there are lots of games with no name
+        if game.get('failed', False) or game.get('type', 'unknown') not in ['game', 'dlc']:
+            continue
+        if game['steam_appid'] in games:
+            continue
+        if ONLY_KNOWN_GAMES and game.get('recommendations', {}).get('total', 0) < ONLY_KNOWN_GAMES_CUTOFF:
+            continue
+        games.add(game['steam_appid'])
+
+        game_date = parse_date(game['release_date'])
+        summary = html_to_text(game.get('about_the_game'))
+        storyline = html_to_text(game.get('detailed_description'))
+        stats.add(game.get('about_the_game'), summary)
+        stats.add(game.get('detailed_description'), storyline)
+        if storyline == summary and storyline != '':
+            # Steam often repeats "about the game" in the detailed description, store it once
+            stats.duplicates += 1
+            stats.clean_bytes -= len(storyline.encode('utf-8'))
+            storyline = ''
+
+        out.write(json.dumps({
+            'id': game['steam_appid'],
+            'name': game['name'],
+            'genres': [g['description'] for g in game.get('genres', [])],
+            # Steam has a boolean for every platform
+            'platforms': [p for p, supported in game['platforms'].items() if supported],
+            'devs': game.get('developers', []),
+            'date': None if game_date is None else game_date.isoformat(),
+            'storyline': storyline,
+            'summary': summary,
+        }) + '\n')
+    return len(games), stats
+
+
+def require_clean_dump(dump_dir: str, gamedb: TextIO, gamecount: int, progress: ProgressChannel) -> int:
+    """
+    Creates the cleaned dump (check clean_games) if it's missing or older than the dump
 
+    :return: number of games in the cleaned dump
+    """
+    dump_stat = os.stat(Path(dump_dir) / DUMP_FILE)
+    stamp = {'dump_size': dump_stat.st_size, 'dump_mtime': dump_stat.st_mtime_ns, 'only_known': ONLY_KNOWN_GAMES,
+             'version': CLEAN_VERSION}
+    clean_path = Path(dump_dir) / CLEAN_DUMP_FILE
+    try:
+        with clean_path.open('rt') as fd:
+            header = json.loads(fd.readline())
+        if header['stamp'] == stamp:
+            return header['count']
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    # Per process: other processes might be cleaning the same dump (ex. perf while indexing)
+    tmp_path = clean_path.with_name(f"{clean_path.name}.{os.getpid()}.tmp")
+    with tmp_path.open('wt') as out:
+        # Placeholder header, rewritten when the count is known
+        out.write(' ' * CLEAN_HEADER_SIZE + '\n')
+        count, stats = clean_games(gamedb, gamecount, out, progress)
+        out.seek(0)
+        out.write(json.dumps({'stamp': stamp, 'count': count}).ljust(CLEAN_HEADER_SIZE))
+    os.replace(tmp_path, clean_path)
+    print(f"Steam text cleaning: {stats}")
+    return count
+
+
+def read_clean_dump(dump_dir: str) -> Iterator[dict]:
+    with (Path(dump_dir) / CLEAN_DUMP_FILE).open('rt') as fd:
+        fd.readline()  # header
+        for line in fd:
             game = json.loads(line)
-
-            if game.get('name', '') == '':
-                continue  # Yes, there are lots of games with no name
-            if game.get('failed', False) or game.get('type', 'unknown') not in ['game', 'dlc']:
-                continue
-            if game['steam_appid'] in games:
-                continue
-            if ONLY_KNOWN_GAMES and game.get('recommendations', {}).get('total', 0) < ONLY_KNOWN_GAMES_CUTOFF:
-                continue
-            games.add(game['steam_appid'])
-
-            game_date = parse_date(game['release_date'])
-            genres_list = [g['description'] for g in game.get('genres', [])]
-
-            dev_list = game.get('developers', [])
-            if writer is None:
-                # Previsit! Just compute the ids, don't write anything (check EntityResolver for more info)
-                resolver.compute(game['steam_appid'], game['name'], dev_list, game_date)
-                continue
-            uuid = resolver.get_id(game['steam_appid'])
-
-            summary_text = game['about_the_game']
-            summary_text = re.sub(r"<(.*?)>", "", summary_text)  # Remove HTML tags
-            
-            writer.add_document(
-                id=str(game['steam_appid']),
-                uuid=uuid,
-                name=game['name'],
-                genres=','.join(genres_list),
-                platforms=','.join(game['platforms']),
-                devs=','.join(dev_list),
-                date=game_date,
-                storyline=game['detailed_description'],
-                summary=summary_text
-            )
-
-
-async def init_index(index: Index, resolver: EntityResolver) -> None:
-    count, fd = await require_dump(False)
-    with fd, index.writer() as writer:
+            game['date'] = None if game['date'] is None else datetime.datetime.fromisoformat(game['date'])
+            yield game
+
+
+def index_games(dump_dir: str, gamecount: int, writer: Optional[IndexWriter], resolver: EntityResolver,
+                progress: ProgressChannel):
+    progress.start("resolving entities" if writer is None else "writing to segments", total=gamecount)
+    for game in read_clean_dump(dump_dir):
+        progress.update(1)
+        if writer is None:
+            # Previsit! Just compute the ids, don't write anything (check EntityResolver for more info)
+            resolver.compute(game['id'], game['name'], game['devs'], game['date'])
+            continue
+
+        writer.add_document(
+            id=str(game['id']),
+            uuid=resolver.get_id(game['id']),
+            name=game['name'],
+            genres=','.join(game['genres']),
+            platforms=','.join(game['platforms']),
+            devs=','.join(game['devs']),
+            date=game['date'],
+            storyline=game['storyline'] or None,
+            summary=game['summary'],
+        )
+
+
+async def init_index(index: Index, resolver: EntityResolver, dump_dir: str = DUMP_DIR,
+                     progress: Optional[ProgressReporter] = None) -> None:
+    if progress is None:
+        progress = ProgressReporter(STORAGE_NAME)
+    count, fd = await require_dump(dump_dir, False, progress)
+    with fd:
+        await run_in_executor(write_index, index, resolver, dump_dir, fd, count, progress=progress)
+
+
+def write_index(index: Index, resolver: EntityResolver, dump_dir: str, fd: TextIO, count: int,
+                progress: ProgressChannel) -> None:
+    # Blocking, runs in an executor (check init_index)
+    # Both passes read the cleaned dump: HTML, filters and dates are handled only once (and only when the dump changes)
+    count = require_clean_dump(dump_dir, fd, count, progress)
+    with index.writer() as writer:
         if resolver.needs_previsit():
-            print("Resolving entities...")
-            index_games(fd, count, None, resolver)
-            fd.seek(0)
-        print("Writing to segments...")
-        index_games(fd, count, writer, resolver)
-        print("Indexing...")
+            index_games(dump_dir, count, None, resolver, progress)
+        index_games(dump_dir, count, writer, resolver, progress)
+        progress.start("indexing")
+    progress.close()
 
 
 class SteamSource(Source):
-    def __init__(self):
+    def __init__(self, dump_dir: str = DUMP_DIR, profile: str = DEFAULT_PROFILE):
         self.name = STORAGE_NAME
-        self.schema = schema
+        self.schema = source_schema(profile)
+        self.dump_dir = dump_dir
 
-    async def scrape(self, update: bool) -> None:
-        await require_dump(update)
+    async def scrape(self, update: bool, progress: Optional[ProgressReporter] = None) -> None:
+        await dump_steam(self.dump_dir, update, progress)
 
-    async def reindex(self, index: FileIndex, resolver: EntityResolver) -> None:
-        await init_index(index, resolver)
+    async def reindex(self, index: FileIndex, resolver: EntityResolver,
+                      progress: Optional[ProgressReporter] = None) -> None:
+        await init_index(index, resolver, self.dump_dir, progress)
 
 
 # Fix: disable dateparser warning (https://github.com/scrapinghub/dateparser/issues/1013)
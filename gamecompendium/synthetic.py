@@ -0,0 +1,214 @@
+import dataclasses
+import datetime
+import gzip
+import itertools
+import json
+import math
+import os
+import random
+from dataclasses import dataclass
+
+from tqdm import tqdm
+
+import igdb
+import steam
+
+# Synthetic dump generator
+# Real dumps take days to scrape, and they can't tell us how the system behaves with 10x the games.
+# This writes steam/igdb dumps with the same format of the scraped ones, so they can be indexed by the
+# real sources (ex. `perf --dumps synthetic_dumps`).
+# What we can control:
+# - the number of entities and how many of them are present in both sources (overlap)
+# - how many entities belong to a franchise, those are the hard cases of entity resolution: sequels
+#   ("Portal", "Portal 2", "Portal II"), subtitles, DLCs and editions share most of their name
+# - noise between the names of the same game in different sources (™/®, case, roman numerals)
+# - the length of the descriptions (log-normal, like the real ones)
+
+SYLLABLES = ['ka', 'ro', 'mi', 'ta', 'ne', 'shi', 'lo', 'van', 'dor', 'el', 'gar', 'po', 'tal', 'zen', 'qu', 'ar',
+             'bel', 'cor', 'da', 'fi', 'gon', 'hal', 'is', 'jun', 'kri', 'lum', 'mor', 'nox', 'or', 'pra', 'ryn',
+             'sol', 'tur', 'ul', 'vex', 'wyr', 'xan', 'yor', 'zul']
+DLC_SUFFIXES = ['Soundtrack', 'Season Pass', 'Expansion Pack', 'Artbook', 'Digital Deluxe Upgrade']
+EDITION_SUFFIXES = ['Deluxe Edition', 'Game of the Year Edition', 'Definitive Edition', 'Complete Edition', 'Remastered']
+ROMAN = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 'IX', 'X']
+GENRES = ['Action', 'Adventure', 'RPG', 'Strategy', 'Simulation', 'Puzzle', 'Racing', 'Sports', 'Indie', 'Casual']
+PLATFORMS = ['windows', 'mac', 'linux']
+IGDB_PLATFORMS = {'windows': 'PC (Microsoft Windows)', 'mac': 'Mac', 'linux': 'Linux'}
+
+
+@dataclass
+class SyntheticOptions:
+    games: int = 10000
+    # Fraction of the entities present in both sources (the others are split evenly between the sources)
+    overlap: float = 0.5
+    # Fraction of the entities that are part of a franchise (sequels, DLCs, editions)
+    franchise_ratio: float = 0.3
+    # Fraction of the shared entities whose name is slightly different between the sources
+    name_noise: float = 0.2
+    # Mean number of words of a description
+    summary_words: int = 80
+    vocabulary: int = 20000
+    seed: int = 42
+
+
+@dataclass
+class SyntheticGame:
+    name: str
+    devs: list[str]
+    date: datetime.datetime
+    genres: list[str]
+    platforms: list[str]
+    summary: str
+    popularity: int
+    dlc: bool
+
+
+class Generator:
+    def __init__(self, options: SyntheticOptions):
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self.words = self._make_words(options.vocabulary)
+        # Zipf-like word frequency
+        self.word_weights = list(itertools.accumulate(1 / (i + 1) for i in range(len(self.words))))
+        self.devs = [self._title_words(self.rng.randint(1, 2)) + self.rng.choice([' Studios', ' Games', ' Interactive', ''])
+                     for _ in range(max(10, options.games // 20))]
+
+    def _make_words(self, count: int) -> list[str]:
+        words = set()
+        while len(words) < count:
+            words.add(''.join(self.rng.choices(SYLLABLES, k=self.rng.randint(1, 4))))
+        words = sorted(words)
+        self.rng.shuffle(words)
+        return words
+
+    def _title_words(self, count: int) -> str:
+        # Titles prefer the most common words (so that different games share words too)
+        return ' '.join(w.capitalize() for w in self.rng.choices(self.words[:2000], k=count))
+
+    def _summary(self) -> str:
+        mean = self.options.summary_words
+        length = max(3, int(self.rng.lognormvariate(math.log(mean) - 0.5, 1.0)))
+        words = self.rng.choices(self.words, cum_weights=self.word_weights, k=length)
+        sentences = [' '.join(words[i:i + 12]).capitalize() for i in range(0, length, 12)]
+        return '. '.join(sentences) + '.'
+
+    def _game(self, name: str, devs: list[str], date: datetime.datetime, genres: list[str], dlc: bool = False) -> SyntheticGame:
+        platforms = ['windows'] + [p for p in PLATFORMS[1:] if self.rng.random() < 0.3]
+        return SyntheticGame(name, devs, date, genres, platforms, self._summary(),
+                             int(self.rng.paretovariate(1.2) * 10), dlc)
+
+    def entities(self):
+        """
+        Generates the entities, franchises are generated together (like they would be in a catalogue)
+        """
+        remaining = self.options.games
+        while remaining > 0:
+            base = self._title_words(self.rng.randint(1, 3))
+            devs = [self.rng.choice(self.devs)]
+            date = datetime.datetime(1990, 1, 1) + datetime.timedelta(days=self.rng.randint(0, 365 * 33))
+            genres = self.rng.sample(GENRES, self.rng.randint(1, 3))
+            if self.rng.random() >= self.options.franchise_ratio:
+                remaining -= 1
+                yield self._game(base, devs, date, genres)
+                continue
+
+            # Franchise: the original, some sequels (with subtitles), DLCs and editions
+            size = min(remaining, self.rng.randint(2, 8))
+            yield self._game(base, devs, date, genres)
+            for i in range(1, size):
+                kind = self.rng.random()
+                date = date + datetime.timedelta(days=self.rng.randint(30, 900))
+                if kind < 0.5:
+                    name = f"{base} {i + 1}"
+                    if self.rng.random() < 0.3:
+                        name += ': ' + self._title_words(self.rng.randint(1, 3))
+                    yield self._game(name, devs, date, genres)
+                elif kind < 0.75:
+                    yield self._game(f"{base} - {self.rng.choice(DLC_SUFFIXES)}", devs, date, genres, dlc=True)
+                else:
+                    yield self._game(f"{base} {self.rng.choice(EDITION_SUFFIXES)}", devs, date, genres)
+            remaining -= size
+
+    def noisy_name(self, name: str) -> str:
+        """The same name, as another source might write it"""
+        choice = self.rng.randint(0, 3)
+        words = name.split(' ')
+        if choice == 0 and words[-1].isdigit() and int(words[-1]) <= len(ROMAN):
+            words[-1] = ROMAN[int(words[-1]) - 1]
+            return ' '.join(words)
+        elif choice == 1:
+            return name + '™'
+        elif choice == 2:
+            return name.upper()
+        return name.replace(' ', ': ', 1) if ' ' in name else name + '®'
+
+
+def _steam_record(appid: int, game: SyntheticGame) -> dict:
+    # Steam repeats the same text in both descriptions, with some markup
+    paragraphs = game.summary.split('. ')
+    html = ''.join(f"<p>{p}</p>" for p in paragraphs)
+    return {
+        'type': 'dlc' if game.dlc else 'game',
+        'name': game.name,
+        'steam_appid': appid,
+        'required_age': 0,
+        'is_free': False,
+        'detailed_description': f"<h2 class=\"bb_tag\">About the game</h2>{html}<br>",
+        'about_the_game': html,
+        'short_description': paragraphs[0],
+        'developers': game.devs,
+        'platforms': {p: p in game.platforms for p in PLATFORMS},
+        'genres': [{'id': str(GENRES.index(g)), 'description': g} for g in game.genres],
+        'recommendations': {'total': game.popularity * 100},
+        'release_date': {'coming_soon': False, 'date': game.date.strftime('%d %b, %Y')},
+    }
+
+
+def _igdb_record(gid: int, game: SyntheticGame) -> dict:
+    return dataclasses.asdict(igdb.IgdmGameExtract(
+        id=gid,
+        name=game.name,
+        storyline=None,
+        summary=game.summary,
+        genres=game.genres,
+        platforms=[IGDB_PLATFORMS[p] for p in game.platforms],
+        dev_companies=game.devs,
+        release_date=int(game.date.timestamp()),
+        total_rating_count=game.popularity,
+    ))
+
+
+def generate(out_dir: str, options: SyntheticOptions) -> tuple[int, int]:
+    """
+    Writes synthetic steam and igdb dumps into out_dir
+
+    :return: the number of (steam, igdb) games written
+    """
+    gen = Generator(options)
+    os.makedirs(out_dir, exist_ok=True)
+    steam_ids = []
+    igdb_count = 0
+    only_ratio = (1 - options.overlap) / 2
+
+    with gzip.open(os.path.join(out_dir, steam.DUMP_FILE), 'wt', compresslevel=1) as steam_fd, \
+            gzip.open(os.path.join(out_dir, igdb.DUMP_FILE), 'wt', compresslevel=1) as igdb_fd, \
+            tqdm(total=options.games, dynamic_ncols=True) as progress:
+        for game in gen.entities():
+            progress.update(1)
+            r = gen.rng.random()
+            in_steam = r < options.overlap + only_ratio
+            in_igdb = r < options.overlap or r >= options.overlap + only_ratio
+            if in_steam:
+                appid = 10 + len(steam_ids) * 10
+                steam_ids.append(appid)
+                steam_fd.write(json.dumps(_steam_record(appid, game)) + '\n')
+            if in_igdb:
+                igdb_count += 1
+                if in_steam and gen.rng.random() < options.name_noise:
+                    game.name = gen.noisy_name(game.name)
+                igdb_fd.write(json.dumps(_igdb_record(igdb_count, game)) + '\n')
+
+    with open(os.path.join(out_dir, steam.DUMP_LIST_FILE), 'wt') as fd:
+        json.dump(steam_ids, fd)
+    with open(os.path.join(out_dir, igdb.DUMP_COUNT_FILE), 'wt') as fd:
+        fd.write(str(igdb_count))
+    return len(steam_ids), igdb_count
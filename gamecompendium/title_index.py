@@ -0,0 +1,178 @@
+import datetime
+import re
+import unicodedata
+import zlib
+from typing import Optional, Iterable, Dict, Tuple
+
+from whoosh.index import Index
+
+# Title hash index, the fast path of the entity resolver.
+# Most of the games present in more than one source have the same title in both ("Portal 2" and "Portal 2"), for
+# them the full scored search is a waste of time: if only one entity has that title (and it's not contradicted by
+# the developers or the release year) we can reuse it directly.
+# Titles are compared with two normalized keys:
+# - strict: lowercase, no accents, no ™/®/©, no punctuation and roman numerals converted to numbers
+#   ("PORTAL II™" => "portal 2")
+# - loose: the strict key without edition suffixes ("Portal 2: Game of the Year Edition" => "portal 2")
+# Optionally near-duplicates can be found with MinHash/LSH over the character trigrams of the strict key,
+# candidates are verified with the exact Jaccard similarity and must have the same numbers in their name
+# (or "Portal 2" would be a near-duplicate of "Portal 3").
+# Every match kind has a fixed score, way higher than any search score: the backtracking of the resolver then prefers
+# strict matches over loose ones, and any fast-path match over searched ones.
+# Ambiguous titles (more than one compatible entity) always go through the full search.
+
+STRICT_SCORE = 1e6
+LOOSE_SCORE = 1e5
+FUZZY_SCORE = 1e4
+
+ROMAN_NUMERALS = {
+    'ii': '2', 'iii': '3', 'iv': '4', 'v': '5', 'vi': '6', 'vii': '7', 'viii': '8', 'ix': '9', 'x': '10',
+    'xi': '11', 'xii': '12', 'xiii': '13', 'xiv': '14', 'xv': '15', 'xvi': '16', 'xvii': '17', 'xviii': '18',
+    'xix': '19', 'xx': '20',
+}
+EDITION_SUFFIX = re.compile(
+    r"(\s+(game of the year|goty|remastered|remaster|hd|directors cut|(\w+\s+)?edition))+$"
+)
+TRADEMARKS = re.compile(r"[™®©]")
+NOT_ALNUM = re.compile(r"[^a-z0-9]+")
+
+MINHASH_PERMUTATIONS = 16
+MINHASH_BANDS = 4
+MINHASH_PRIME = (1 << 61) - 1
+FUZZY_MIN_JACCARD = 0.8
+
+
+def plain_words(name: str) -> list[str]:
+    """Words of the name: lowercase, no accents, no ™/®/©, no punctuation"""
+    name = unicodedata.normalize('NFKD', TRADEMARKS.sub('', name))
+    name = ''.join(c for c in name if not unicodedata.combining(c)).lower()
+    name = name.replace('&', ' and ').replace("'", '')
+    return NOT_ALNUM.sub(' ', name).split()
+
+
+def strict_key(name: str) -> str:
+    return ' '.join(ROMAN_NUMERALS.get(w, w) for w in plain_words(name))
+
+
+def loose_key(name: str) -> str:
+    key = strict_key(name)
+    return EDITION_SUFFIX.sub('', key) or key
+
+
+def _trigrams(key: str) -> set[str]:
+    key = f" {key} "
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+
+def _numbers(key: str) -> set[str]:
+    return {w for w in key.split() if w.isdigit()}
+
+
+def _minhash(shingles: set[str]) -> list[int]:
+    hashes = [zlib.crc32(s.encode('utf-8')) for s in shingles]
+    # a*x + b permutations, with fixed (deterministic) coefficients
+    return [min(((2 * i + 1) * 0x9E3779B1 * h + i * 0x7F4A7C15) % MINHASH_PRIME for h in hashes)
+            for i in range(MINHASH_PERMUTATIONS)]
+
+
+def _bands(signature: list[int]) -> list[tuple]:
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    return [(b,) + tuple(signature[b * rows:(b + 1) * rows]) for b in range(MINHASH_BANDS)]
+
+
+class TitleIndex:
+    def __init__(self, fuzzy: bool = False):
+        self.fuzzy = fuzzy
+        # key -> uuids of the entities with that title
+        self.strict = {}  # type: Dict[str, set[str]]
+        self.loose = {}  # type: Dict[str, set[str]]
+        # uuid -> developers, release years (to reject matches between different games with the same name)
+        self.devs = {}  # type: Dict[str, set[str]]
+        self.years = {}  # type: Dict[str, set[int]]
+        # LSH band -> strict keys, strict key -> trigrams
+        self.lsh = {}  # type: Dict[tuple, set[str]]
+        self.shingles = {}  # type: Dict[str, set[str]]
+
+    def add(self, uuid: str, name: str, dev_companies: Iterable[str], release_date: Optional[datetime.datetime]) -> None:
+        key = strict_key(name)
+        if len(key) == 0:
+            return
+        self.strict.setdefault(key, set()).add(uuid)
+        self.loose.setdefault(loose_key(name), set()).add(uuid)
+        self.devs.setdefault(uuid, set()).update(d.lower() for d in dev_companies)
+        if release_date is not None:
+            self.years.setdefault(uuid, set()).add(release_date.year)
+        if self.fuzzy and key not in self.shingles:
+            shingles = _trigrams(key)
+            self.shingles[key] = shingles
+            for band in _bands(_minhash(shingles)):
+                self.lsh.setdefault(band, set()).add(key)
+
+    @staticmethod
+    def build(indexes: Iterable[Index], fuzzy: bool = False) -> 'TitleIndex':
+        """
+        Builds the title index from the stored fields of already indexed sources
+        """
+        res = TitleIndex(fuzzy)
+        for index in indexes:
+            with index.reader() as reader:
+                for fields in reader.all_stored_fields():
+                    devs = fields['devs'].split(',') if fields.get('devs') else []
+                    # Registry entities can have more than one name (check registry.py)
+                    for name in (fields.get('name') or '').split('\n'):
+                        res.add(fields['uuid'], name, devs, fields.get('date'))
+        return res
+
+    def _compatible(self, uuid: str, dev_companies: set[str], release_date: Optional[datetime.datetime]) -> bool:
+        devs = self.devs.get(uuid)
+        if devs and dev_companies and devs.isdisjoint(dev_companies):
+            return False
+        years = self.years.get(uuid)
+        if years and release_date is not None and all(abs(y - release_date.year) > 1 for y in years):
+            return False
+        return True
+
+    def _unique(self, uuids: Iterable[str], dev_companies: set[str], release_date: Optional[datetime.datetime]) -> Optional[str]:
+        found = [u for u in uuids if self._compatible(u, dev_companies, release_date)]
+        return found[0] if len(found) == 1 else None
+
+    def _fuzzy_keys(self, key: str) -> set[str]:
+        shingles = _trigrams(key)
+        numbers = _numbers(key)
+        candidates = set().union(*(self.lsh.get(band, ()) for band in _bands(_minhash(shingles))))
+        res = set()
+        for other in candidates:
+            other_shingles = self.shingles[other]
+            jaccard = len(shingles & other_shingles) / len(shingles | other_shingles)
+            if jaccard >= FUZZY_MIN_JACCARD and _numbers(other) == numbers:
+                res.add(other)
+        return res
+
+    def match(self, name: str, dev_companies: list[str], release_date: Optional[datetime.datetime]) -> Optional[Tuple[str, float]]:
+        """
+        Finds the only entity with the same (normalized) title
+
+        :return: (entity UUID, score) or None if there's no unambiguous match
+        """
+        key = strict_key(name)
+        if len(key) == 0:
+            return None
+        devs = {d.lower() for d in dev_companies}
+
+        uuids = self.strict.get(key)
+        if uuids is not None:
+            # An ambiguous exact title is not resolved with looser keys
+            uuid = self._unique(uuids, devs, release_date)
+            return None if uuid is None else (uuid, STRICT_SCORE)
+
+        uuids = self.loose.get(loose_key(name))
+        if uuids is not None:
+            uuid = self._unique(uuids, devs, release_date)
+            return None if uuid is None else (uuid, LOOSE_SCORE)
+
+        if self.fuzzy:
+            uuids = set().union(*(self.strict[k] for k in self._fuzzy_keys(key)))
+            uuid = self._unique(uuids, devs, release_date)
+            if uuid is not None:
+                return uuid, FUZZY_SCORE
+        return None
@@ -0,0 +1,188 @@
+import bisect
+import hashlib
+import mmap
+import os
+import random
+import struct
+import sys
+import time
+from array import array
+from typing import Optional
+
+from whoosh.index import FileIndex
+from whoosh.reading import TermNotFound
+
+# Random access is the hot path of the aggregator: every new candidate found in a source is looked up
+# (by uuid) in all the other sources. Whoosh resolves `document_number(uuid=...)` with a term dictionary lookup,
+# but the uuid -> docnum relation only changes when an index is rewritten, so we can precompute it once.
+#
+# The sidecar is a flat file next to the index:
+#   header: magic, index version, entry count
+#   hi[count], lo[count], docnum[count]   (unsigned 64 bit, native byte order)
+# The entries are sorted by (hi, lo), where hi and lo are the two halves of the 128-bit uuid.
+# The file is memory-mapped and searched in place with a binary search, so startup doesn't need to
+# deserialize anything and the OS page cache is shared between processes.
+
+# Padded to 24 bytes so that the arrays are aligned
+HEADER = struct.Struct('=4s4xqQ')
+MAGIC = b'GCUM'
+MASK_64 = (1 << 64) - 1
+
+
+def sidecar_path(folder: str, indexname: str) -> str:
+    return os.path.join(folder, f"{indexname}.uuidmap")
+
+
+def _split_uuid(uuid: str) -> tuple[int, int]:
+    key = int(uuid, 16)
+    return key >> 64, key & MASK_64
+
+
+def index_version(index: FileIndex) -> int:
+    """
+    Identifies the current content of an index, the generation alone isn't enough since it starts again
+    when the index is recreated (ex. reindexing a source), while segment ids are random
+    """
+    segments = ','.join(sorted(segment.segment_id() for segment in index._segments()))
+    digest = hashlib.blake2b(f"{index.latest_generation()}:{segments}".encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1
+
+
+class UuidMap:
+    """
+    Read-only map uuid -> document number of a single index version
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as fd:
+            self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version, count = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"Invalid uuid map: {path}")
+        self._data = memoryview(self._mmap)[HEADER.size:].cast('Q')
+        self._hi = self._data[0:count]
+        self._lo = self._data[count:2 * count]
+        self._docnums = self._data[2 * count:3 * count]
+
+    def __len__(self) -> int:
+        return len(self._hi)
+
+    def document_number(self, uuid: str) -> Optional[int]:
+        """
+        Finds the document number of the game with the given uuid (same as searcher.document_number(uuid=uuid))
+
+        :param uuid: hex encoded UUID of the entity
+        :return: the document number, or None if the uuid is not present in the index
+        """
+        try:
+            hi, lo = _split_uuid(uuid)
+        except ValueError:
+            return None
+        i = bisect.bisect_left(self._hi, hi)
+        # The upper half is practically unique, but let's be correct
+        while i < len(self._hi) and self._hi[i] == hi:
+            if self._lo[i] == lo:
+                return self._docnums[i]
+            i += 1
+        return None
+
+    @staticmethod
+    def build(index: FileIndex, path: str) -> None:
+        """
+        Writes the sidecar of the latest version of the index
+        """
+        version = index_version(index)
+        entries = []
+        with index.reader() as reader:
+            for term in reader.lexicon('uuid'):
+                uuid = term.decode('utf-8')
+                try:
+                    hi, lo = _split_uuid(uuid)
+                except ValueError:
+                    continue
+                try:
+                    docnum = reader.first_id('uuid', uuid)
+                except TermNotFound:
+                    # Deleted documents leave their terms in the lexicon until the segments are merged
+                    continue
+                entries.append((hi, lo, docnum))
+        entries.sort()
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fd:
+            fd.write(HEADER.pack(MAGIC, version, len(entries)))
+            for column in range(3):
+                array('Q', (e[column] for e in entries)).tofile(fd)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def open(index: FileIndex, folder: str) -> Optional['UuidMap']:
+        """
+        Opens the sidecar of an index, None if it's missing or out of date
+        """
+        path = sidecar_path(folder, index.indexname)
+        if not os.path.exists(path):
+            return None
+        umap = UuidMap(path)
+        if umap.version == index_version(index):
+            return umap
+        umap.close()
+        return None
+
+    @staticmethod
+    def open_or_build(index: FileIndex, folder: str) -> 'UuidMap':
+        """
+        Opens the sidecar of an index, (re)building it when it's missing or out of date
+        """
+        umap = UuidMap.open(index, folder)
+        if umap is not None:
+            return umap
+        path = sidecar_path(folder, index.indexname)
+        UuidMap.build(index, path)
+        return UuidMap(path)
+
+    def prefetch(self) -> None:
+        """Loads the whole map in the page cache (it's small, and every random access binary searches it)"""
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            self._mmap.madvise(mmap.MADV_WILLNEED)
+        sum(self._mmap[i] for i in range(0, len(self._mmap), mmap.PAGESIZE))
+
+    def close(self):
+        self._hi.release()
+        self._lo.release()
+        self._docnums.release()
+        self._data.release()
+        self._mmap.close()
+
+
+def _benchmark(folder: str, indexname: str, samples: int = 10000):
+    """
+    Micro-benchmark: compares searcher.document_number to UuidMap lookups on random uuids of an index
+    """
+    from whoosh.filedb.filestore import FileStorage
+
+    index = FileStorage(folder).open_index(indexname)
+    umap = UuidMap.open_or_build(index, folder)
+    with index.searcher() as searcher:
+        uuids = [t.decode('utf-8') for t in searcher.reader().lexicon('uuid')]
+        uuids = random.choices(uuids, k=samples)
+
+        start = time.perf_counter()
+        expected = [searcher.document_number(uuid=u) for u in uuids]
+        term_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        found = [umap.document_number(u) for u in uuids]
+        map_time = time.perf_counter() - start
+
+    if expected != found:
+        raise Exception("UuidMap and document_number disagree!")
+    print(f"{indexname}: {len(umap)} uuids, {samples} lookups")
+    print(f"document_number: {term_time / samples * 1e6:.2f}us/lookup")
+    print(f"UuidMap:         {map_time / samples * 1e6:.2f}us/lookup ({term_time / map_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    # python uuid_map.py indexes steam
+    _benchmark(sys.argv[1], sys.argv[2])